@@ -1,29 +1,141 @@
-﻿__version__ = "2.3"
+﻿__version__ = "3.2"
 # ai_generator.py - Generatore relazioni con Groq AI
 # CODICE UNIVERSALE - Legge template dalla cartella templates/
 # NON contiene nessun riferimento a specialità mediche specifiche
 # Modelli AI qui dentro (aggiornabili da GitHub)
 
-from groq import Groq
 import re
 import os
+import json
+import time
+import weakref
 import importlib
+import threading
 from datetime import datetime
 
 from config import NOMI_FEMMINILI
+from ai_module import (HAS_GEMINI, ProviderGroq, ProviderGemini, RouterTesto, ErroreRichiesta,
+                       client_groq, warm_up, funzioni_tracing)
+
+traccia, evento, chiudi_visita, tracing_abilitato = funzioni_tracing(
+    "traccia", "evento", "chiudi_visita", "abilitato")
 
 # =============================================================================
 # MODELLI AI (aggiornabili da GitHub - MAI in config.py)
 # =============================================================================
 AI_MODEL = "qwen/qwen3.6-27b"
 
+# Istanze vive: dopo un aggiornamento update_from_github le ricollega alla nuova classe
+_ISTANZE = weakref.WeakSet()
+
+# =============================================================================
+# COMPOSIZIONE PROMPT (prefisso stabile per il prompt caching del provider)
+# =============================================================================
+# Il provider riusa il calcolo di un prefisso gia' visto: system message e testo
+# del template restano all'inizio, identici byte per byte tra le visite, mentre
+# dati paziente e trascrizione vanno in fondo al messaggio utente.
+SEGNAPOSTO_DATI_PAZIENTE = "[DATI PAZIENTE: riportati in fondo al messaggio]"
+SEGNAPOSTO_TRASCRIZIONE = "[TRASCRIZIONE: riportata in fondo al messaggio]"
+
+# =============================================================================
+# OUTPUT STRUTTURATO (template con SEZIONI_RELAZIONE)
+# =============================================================================
+# Il template dichiara le sezioni della relazione:
+#   SEZIONI_RELAZIONE = [
+#       {"nome": "anamnesi", "titolo": "Anamnesi", "istruzioni": "...",
+#        "obbligatoria": True, "max_caratteri": 1500},
+#       ...
+#   ]
+# e facoltativamente la lettera in cui inserirle:
+#   LAYOUT_RELAZIONE = "Gentile Collega,\n...{anamnesi}\n\n{terapia}\n\n{medico}"
+#   (campi disponibili: le sezioni, nome_paziente, titolo_paziente, data, medico)
+#   oppure una funzione render_relazione(sezioni, campi) -> str
+#   e un controllo valida_sezione(nome, testo) -> messaggio di errore o None.
+# Il modello risponde con un JSON compatto; le sezioni non valide vengono
+# richieste di nuovo da sole, senza rigenerare tutta la relazione.
+JSON_MODE_ABILITATO = True
+MAX_TOKENS_JSON = 2500
+TENTATIVI_SEZIONE = 2       # nuove richieste per le sezioni non valide
+
+
+class _CampiLayout(dict):
+    """Campi del layout: un segnaposto sconosciuto diventa testo vuoto invece di KeyError."""
+
+    def __missing__(self, chiave):
+        return ""
+
 
 class AIGenerator:
 
-    def __init__(self, api_key):
-        self.client = Groq(api_key=api_key)
+    def __init__(self, api_key, gemini_api_key=None, politica=None, priorita="interattiva"):
+        # Client condiviso (pool keep-alive comune con l'OCR, vedi ai_module.RegistroClient)
+        self.client = client_groq(api_key)
         self.model = AI_MODEL
         self.template = None
+        # "interattiva" (app) o "batch": in coda sul limite della chiave passa prima l'interattiva
+        self.priorita = priorita
+
+        # Token usati dall'avvio (cached_tokens = prompt riusato dalla cache del provider)
+        self.uso_token = {"richieste": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.ultimo_uso = {}
+        # Lo stesso generatore puo' servire piu' thread (es. i worker di batch_relazioni)
+        self._lock_uso = threading.Lock()
+
+        # Groq sempre; Gemini anche, se c'e' la chiave: il router sceglie per latenza ed errori
+        self._init_provider(gemini_api_key, politica)
+        _ISTANZE.add(self)
+
+        # All'avvio dell'app: connessioni TLS aperte in background prima della prima relazione
+        warm_up()
+
+    def _init_provider(self, gemini_api_key=None, politica=None):
+        # Tenuti per ricostruire i provider dopo una ricarica a caldo di ai_module
+        self._gemini_api_key = gemini_api_key
+        self._politica = politica
+        self._provider_groq = ProviderGroq(self.client, self.model, self.priorita)
+        providers = [self._provider_groq]
+        if gemini_api_key and HAS_GEMINI:
+            try:
+                providers.append(ProviderGemini(gemini_api_key))
+            except Exception as e:
+                print(f"Gemini non disponibile per la generazione: {e}")
+        self.router = RouterTesto(providers, politica)
+
+    def _dopo_ricarica(self):
+        """Dopo una ricarica a caldo: crea gli attributi che la versione precedente non aveva."""
+        if not hasattr(self, "uso_token"):
+            self.uso_token = {"richieste": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+            self.ultimo_uso = {}
+        if not hasattr(self, "_lock_uso"):
+            self._lock_uso = threading.Lock()
+        if not hasattr(self, "priorita"):
+            self.priorita = "interattiva"
+        if not hasattr(self, "router"):
+            self._init_provider()
+        elif type(self.router) is not RouterTesto:
+            # ai_module ricaricato: router e provider sono ancora istanze delle classi vecchie
+            self._ricostruisci_provider()
+
+    def _ricostruisci_provider(self):
+        if hasattr(self, "_gemini_api_key"):
+            self._init_provider(self._gemini_api_key, self._politica)
+            return
+        # Creato da una versione che non teneva la chiave Gemini: Groq nuovo, gli altri provider restano
+        vecchio = self.router
+        self._init_provider(None, vecchio.politica)
+        altri = [p for p in vecchio.providers if p.nome != ProviderGroq.nome]
+        if altri:
+            self.router = RouterTesto([self._provider_groq] + altri, vecchio.politica)
+
+    def _genera(self, messages, temperature, max_tokens, reasoning_effort=None, json_mode=False):
+        """Una generazione tramite il router (Groq / Gemini)."""
+        # self.model puo' essere cambiato dall'app dopo la creazione
+        self._provider_groq.model = self.model
+        return self.router.genera(messages, temperature, max_tokens, reasoning_effort, json_mode)
+
+    def get_stato_provider(self):
+        """Latenza media, tasso di errore e stato di ogni provider di generazione."""
+        return self.router.get_statistiche()
 
     def carica_template(self, nome_template):
         """Carica un template dalla cartella templates/."""
@@ -51,11 +163,25 @@ class AIGenerator:
                         templates.append({'file': nome, 'nome': nome})
         return templates
 
+    @traccia("genera_relazione")
     def genera_relazione(self, trascrizione, info_paziente=None, info_medico=None):
         """Genera la relazione usando il template caricato."""
         if not self.template:
             return "ERRORE: Nessun template caricato. Seleziona un tipo di documento."
 
+        esito = "errore"
+        try:
+            relazione = self._scrivi_relazione(trascrizione, info_paziente, info_medico)
+            if not relazione.startswith("ERRORE"):
+                esito = "ok"
+            return relazione
+        finally:
+            # La relazione chiude la visita iniziata con la registrazione, anche se fallisce
+            chiudi_visita(esito=esito)
+
+    def _scrivi_relazione(self, trascrizione, info_paziente, info_medico):
+        t_fase = time.perf_counter()
+
         # Protegge temporaneamente le date con logica universale
         trascrizione_protetta, mappa_date = self._proteggi_date(trascrizione)
 
@@ -64,6 +190,9 @@ class AIGenerator:
         if self.template and hasattr(self.template, 'proteggi_notazioni_specialistiche'):
             trascrizione_protetta, mappa_specialistica = self.template.proteggi_notazioni_specialistiche(trascrizione_protetta)
 
+        evento("protezione", inizio=t_fase, date=len(mappa_date), notazioni=len(mappa_specialistica))
+        t_fase = time.perf_counter()
+
         # 1. Determina Sig. o Sig.ra (vuoto se minorenne, altrimenti da form)
         titolo_paziente = "Sig."
         nome_completo = "Paziente"
@@ -118,49 +247,223 @@ Genere: {"Femminile" if info_paziente.get('titolo', 'Sig.') == "Sig.ra" else "Ma
 {destinatari_extra}
 """
 
-        # 3. Formatta il Prompt dal template
-        ai_system_message = getattr(self.template, 'AI_SYSTEM_MESSAGE', '')
-        relazione_template = getattr(self.template, 'RELAZIONE_TEMPLATE', '')
+        # 3. Compone il Prompt: testo fisso del template prima, dati della visita in fondo
+        messages = self.componi_prompt_relazione(str_dati_paziente, trascrizione_protetta)
 
-        full_prompt = relazione_template.format(
-            dati_paziente=str_dati_paziente,
-            trascrizione=trascrizione_protetta
-        )
+        if tracing_abilitato():
+            # Il prefisso si ricompone solo per la traccia
+            evento("prompt", inizio=t_fase, caratteri=sum(len(m["content"]) for m in messages),
+                   prefisso=len(self.prefisso_relazione()))
+        t_fase = time.perf_counter()
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": ai_system_message
-                    },
-                    {
-                        "role": "user",
-                        "content": full_prompt
+            # Template con sezioni: JSON compatto e lettera composta in locale
+            if self._usa_sezioni():
+                testi = self._genera_sezioni(messages, str_dati_paziente, trascrizione_protetta)
+                if testi is not None:
+                    t_fase = time.perf_counter()
+                    campi = {
+                        "nome_paziente": nome_completo,
+                        "titolo_paziente": titolo_paziente,
+                        "data": datetime.now().strftime("%d/%m/%Y"),
+                        "medico": info_medico.get('nome', '') if isinstance(info_medico, dict) else "",
                     }
-                ],
-                temperature=0.3,
-                max_tokens=4000,
-                reasoning_effort="none"
-            )
+                    relazione = self._componi_lettera(testi, campi, mappa_date, mappa_specialistica)
+                    evento("rendering", inizio=t_fase, sezioni=len(testi))
+                    return relazione
 
-            relazione = response.choices[0].message.content
+                # Sezioni obbligatorie ancora non valide: si ripiega sulla prosa libera
+                print("Output strutturato non valido: rigenero la relazione in prosa")
+                messages = self.componi_prompt_relazione(str_dati_paziente, trascrizione_protetta, strutturato=False)
+                t_fase = time.perf_counter()
+
+            risposta = self._genera(messages, temperature=0.3, max_tokens=4000, reasoning_effort="none")
+
+            relazione = risposta.testo
+            evento("llm", inizio=t_fase, provider=risposta.provider, model=risposta.model,
+                   **self._registra_uso(risposta))
+            t_fase = time.perf_counter()
 
             # Ripristina prima le notazioni specialistiche, poi le date
             if self.template and hasattr(self.template, 'ripristina_notazioni_specialistiche'):
                 relazione = self.template.ripristina_notazioni_specialistiche(relazione, mappa_specialistica)
 
             relazione = self._ripristina_date(relazione, mappa_date)
+            evento("ripristino", inizio=t_fase)
 
             # Applica pulizia post-generazione
-            relazione = self._pulisci_relazione(relazione)
-
-            return relazione
+            return self._pulisci_relazione(relazione)
 
         except Exception as e:
+            evento("errore", inizio=t_fase, errore=e)
             return f"ERRORE AI: {e}\n\nTrascrizione originale salvata:\n{trascrizione}"
 
+    def _usa_sezioni(self):
+        """True se il template dichiara le sezioni (output JSON + lettera composta in locale)."""
+        return JSON_MODE_ABILITATO and bool(getattr(self.template, 'SEZIONI_RELAZIONE', None))
+
+    def _istruzioni_relazione(self, strutturato=None):
+        """System message e testo del template con i segnaposto al posto dei dati."""
+        if strutturato is None:
+            strutturato = self._usa_sezioni()
+        ai_system_message = getattr(self.template, 'AI_SYSTEM_MESSAGE', '')
+        relazione_template = getattr(self.template, 'RELAZIONE_TEMPLATE', '')
+
+        istruzioni = relazione_template.format(
+            dati_paziente=SEGNAPOSTO_DATI_PAZIENTE,
+            trascrizione=SEGNAPOSTO_TRASCRIZIONE
+        ).rstrip()
+        if strutturato:
+            istruzioni += "\n\n" + self._istruzioni_json()
+        return ai_system_message, istruzioni
+
+    def _istruzioni_json(self):
+        """Formato di risposta JSON (fa parte del prefisso stabile)."""
+        righe = [
+            "FORMATO DI RISPOSTA (OBBLIGATORIO):",
+            "Rispondi SOLO con un oggetto JSON, senza testo prima o dopo, con queste chiavi:",
+        ]
+        for sezione in self.template.SEZIONI_RELAZIONE:
+            vincoli = "obbligatoria" if sezione.get("obbligatoria", True) else "facoltativa, \"\" se non pertinente"
+            if sezione.get("max_caratteri"):
+                vincoli += f", max {sezione['max_caratteri']} caratteri"
+            righe.append(f'- "{sezione["nome"]}": {sezione.get("istruzioni", "")} ({vincoli})')
+        righe.append("Ogni valore e' testo semplice in italiano, senza markdown e senza titoli.")
+        righe.append("Intestazione, saluti e firma li aggiunge il programma: non scriverli.")
+        return "\n".join(righe)
+
+    def prefisso_relazione(self, strutturato=None):
+        """Parte del prompt uguale per tutte le visite con lo stesso template."""
+        ai_system_message, istruzioni = self._istruzioni_relazione(strutturato)
+        return ai_system_message + "\n" + istruzioni
+
+    def componi_prompt_relazione(self, dati_paziente, trascrizione, strutturato=None, coda=""):
+        """Messaggi per genera_relazione: prefisso stabile + dati della visita (e coda) in fondo."""
+        ai_system_message, istruzioni = self._istruzioni_relazione(strutturato)
+        relazione_template = getattr(self.template, 'RELAZIONE_TEMPLATE', '')
+
+        # In coda solo i dati che il template chiede davvero
+        dati = ""
+        if "{dati_paziente}" in relazione_template:
+            dati += f"\n\n=== DATI PAZIENTE ===\n{dati_paziente.strip()}"
+        if "{trascrizione}" in relazione_template:
+            dati += f"\n\n=== TRASCRIZIONE ===\n{trascrizione}"
+
+        return [
+            {"role": "system", "content": ai_system_message},
+            {"role": "user", "content": istruzioni + dati + coda},
+        ]
+
+    def _valida_sezioni(self, risposta, sezioni):
+        """Ritorna (testi validi per nome, nomi delle sezioni da richiedere di nuovo)."""
+        validi = {}
+        errate = []
+        valida_sezione = getattr(self.template, 'valida_sezione', None)
+        for sezione in sezioni:
+            nome = sezione["nome"]
+            testo = risposta.get(nome)
+            if testo is None and not sezione.get("obbligatoria", True):
+                testo = ""
+            if not isinstance(testo, str):
+                errate.append(nome)
+                continue
+            testo = testo.strip()
+            if sezione.get("obbligatoria", True) and not testo:
+                errate.append(nome)
+            elif sezione.get("max_caratteri") and len(testo) > sezione["max_caratteri"] * 1.2:
+                errate.append(nome)
+            elif valida_sezione and valida_sezione(nome, testo):
+                errate.append(nome)
+            else:
+                validi[nome] = testo
+        return validi, errate
+
+    def _genera_sezioni(self, messages, dati_paziente, trascrizione):
+        """Sezioni della relazione in JSON; None se restano sezioni obbligatorie non valide."""
+        sezioni = self.template.SEZIONI_RELAZIONE
+        da_generare = [s["nome"] for s in sezioni]
+        testi = {}
+
+        for tentativo in range(1 + TENTATIVI_SEZIONE):
+            if tentativo > 0:
+                # Stesso prefisso e stessi dati: cambia solo la richiesta in coda
+                coda = (f"\n\nRIGENERA SOLO queste sezioni: {', '.join(da_generare)}. "
+                        "Rispondi con un oggetto JSON che contiene solo queste chiavi.")
+                messages = self.componi_prompt_relazione(dati_paziente, trascrizione, strutturato=True, coda=coda)
+
+            t_fase = time.perf_counter()
+            try:
+                generata = self._genera(messages, temperature=0.3, max_tokens=MAX_TOKENS_JSON,
+                                        reasoning_effort="none", json_mode=True)
+                evento("llm", inizio=t_fase, provider=generata.provider, model=generata.model, modo="json",
+                       tentativo=tentativo, sezioni=len(da_generare), **self._registra_uso(generata))
+                risposta = json.loads(generata.testo or "{}")
+            except (ErroreRichiesta, ValueError) as e:
+                # JSON non valido (rifiutato da Groq o Gemini, o illeggibile): si ritenta
+                evento("llm", inizio=t_fase, errore=e, modo="json", tentativo=tentativo)
+                risposta = {}
+            if not isinstance(risposta, dict):
+                risposta = {}
+
+            validi, da_generare = self._valida_sezioni(risposta, [s for s in sezioni if s["nome"] in da_generare])
+            testi.update(validi)
+            if not da_generare:
+                return testi
+
+        print(f"Sezioni non valide dopo {TENTATIVI_SEZIONE} nuovi tentativi: {', '.join(da_generare)}")
+        for sezione in sezioni:
+            if sezione["nome"] in da_generare:
+                if sezione.get("obbligatoria", True):
+                    return None
+                testi[sezione["nome"]] = ""
+        return testi
+
+    def _componi_lettera(self, testi, campi, mappa_date, mappa_specialistica):
+        """Lettera finale: testi delle sezioni dentro il layout del template."""
+        ripristinati = {}
+        for nome, testo in testi.items():
+            if testo and hasattr(self.template, 'ripristina_notazioni_specialistiche'):
+                testo = self.template.ripristina_notazioni_specialistiche(testo, mappa_specialistica)
+            testo = self._ripristina_date(testo, mappa_date)
+            ripristinati[nome] = self._pulisci_relazione(testo) if testo else ""
+
+        if hasattr(self.template, 'render_relazione'):
+            return self.template.render_relazione(ripristinati, campi).strip()
+
+        layout = getattr(self.template, 'LAYOUT_RELAZIONE', None)
+        if layout:
+            valori = dict(campi, **ripristinati)
+            relazione = layout.format_map(_CampiLayout(valori))
+        else:
+            blocchi = []
+            for sezione in self.template.SEZIONI_RELAZIONE:
+                testo = ripristinati.get(sezione["nome"])
+                if testo:
+                    titolo = sezione.get("titolo")
+                    blocchi.append(f"{titolo}:\n{testo}" if titolo else testo)
+            relazione = "\n\n".join(blocchi)
+
+        # Le sezioni facoltative vuote non lasciano righe bianche in piu'
+        return re.sub(r'\n{3,}', '\n\n', relazione).strip()
+
+    def _registra_uso(self, risposta):
+        """Aggiorna i contatori di token e ritorna l'uso della singola richiesta."""
+        uso = dict(risposta.uso)
+        with self._lock_uso:
+            self.ultimo_uso = dict(uso, provider=risposta.provider)
+            self.uso_token["richieste"] += 1
+            for chiave, valore in uso.items():
+                self.uso_token[chiave] += valore
+        return uso
+
+    def get_uso_token(self):
+        """Token usati dall'avvio, con la quota di prompt servita dalla cache del provider."""
+        with self._lock_uso:
+            uso = dict(self.uso_token)
+        uso["cache_ratio"] = uso["cached_tokens"] / uso["prompt_tokens"] if uso["prompt_tokens"] else 0.0
+        return uso
+
+    @traccia("pulizia")
     def _pulisci_relazione(self, testo):
         """Correttore automatico post-generazione. Solo pulizie UNIVERSALI."""
 
@@ -242,6 +545,7 @@ Genere: {"Femminile" if info_paziente.get('titolo', 'Sig.') == "Sig.ra" else "Ma
 
         return testo.strip()
 
+    @traccia("pulisci_appunti")
     def pulisci_appunti(self, testo_grezzo):
         """Step 1: Riscrive appunti grezzi in modo chiaro per la generazione relazione."""
 
@@ -253,14 +557,15 @@ Genere: {"Femminile" if info_paziente.get('titolo', 'Sig.') == "Sig.ra" else "Ma
         else:
             system_message = self._get_default_cleanup_prompt()
 
-        # Inietta anno corrente nel prompt
+        # Inietta anno corrente nel prompt (cambia una volta l'anno: il system
+        # message resta comunque un prefisso stabile per la cache del provider)
         system_message = system_message.replace("{ANNO_CORRENTE}", anno_corrente)
 
         user_message = f"Ecco gli appunti da riscrivere:\n\n{testo_grezzo}"
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
+        t_fase = time.perf_counter()
+        risposta = self._genera(
+            [
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_message}
             ],
@@ -269,7 +574,9 @@ Genere: {"Femminile" if info_paziente.get('titolo', 'Sig.') == "Sig.ra" else "Ma
             reasoning_effort="medium"
         )
 
-        testo_pulito = response.choices[0].message.content.strip()
+        testo_pulito = risposta.testo.strip()
+        evento("llm", inizio=t_fase, provider=risposta.provider, model=risposta.model,
+               **self._registra_uso(risposta))
 
         # Rimuovi eventuale Markdown
         testo_pulito = re.sub(r'^#{1,6}\s+', '', testo_pulito, flags=re.MULTILINE)
@@ -1,9 +1,78 @@
-﻿__version__ = "1.2"
+﻿__version__ = "1.8"
 # ai_module.py - Modulo AI centralizzato
 # Check librerie disponibili + Gemini OCR
 # CODICE UNIVERSALE - Aggiornabile da GitHub
 
-import re
+import os
+import time
+import random
+import weakref
+import importlib
+import contextlib
+import threading
+from urllib.parse import urlsplit
+
+
+# ============================================================================
+# MODULI OPZIONALI
+# ============================================================================
+# File aggiunti di recente: un updater vecchio non li scarica finche' non si
+# e' aggiornato anche lui. Chi li usa li chiede da qui, non con un import diretto.
+
+def modulo_opzionale(nome):
+    """Il modulo, o None se il file non c'e' ancora."""
+    try:
+        return importlib.import_module(nome)
+    except ImportError:
+        return None
+
+
+class _TracingSpento:
+    """Al posto di tracing.py finche' manca: stesse funzioni, nessuna traccia."""
+
+    @staticmethod
+    def abilitato():
+        return False
+
+    @staticmethod
+    def traccia(nome=None, **attributi):
+        return lambda funzione: funzione
+
+    @staticmethod
+    def evento(nome, **attributi):
+        pass
+
+    @staticmethod
+    def chiudi_visita(trace_id=None, **attributi):
+        pass
+
+    @staticmethod
+    def assicura_visita():
+        return None
+
+    @staticmethod
+    def apri_visita(etichetta=None):
+        return None
+
+    @staticmethod
+    def usa_visita(trace_id):
+        return contextlib.nullcontext(trace_id)
+
+    @staticmethod
+    def in_visita(etichetta=None):
+        return contextlib.nullcontext()
+
+
+def funzioni_tracing(*nomi):
+    """Le funzioni di tracing.py richieste, nello stesso ordine (vuote se il file manca)."""
+    sorgente = modulo_opzionale("tracing") or _TracingSpento
+    return tuple(getattr(sorgente, nome) for nome in nomi)
+
+
+traccia, evento = funzioni_tracing("traccia", "evento")
+
+# Senza rate_limiter.py le richieste a Groq partono subito
+rate_limiter = modulo_opzionale("rate_limiter")
 
 # ============================================================================
 # CONFIGURAZIONE LIBRERIE DISPONIBILI
@@ -30,7 +99,7 @@ except ImportError:
 # --- GROQ ---
 HAS_GROQ = False
 try:
-    from groq import Groq
+    from groq import Groq, RateLimitError, APIConnectionError
     HAS_GROQ = True
 except ImportError:
     pass
@@ -47,6 +116,196 @@ except ImportError:
     except ImportError:
         pass
 
+# --- HTTPX (arriva con groq e google-genai) ---
+HAS_HTTPX = False
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:
+    pass
+
+
+# Istanze vive: dopo un aggiornamento update_from_github le ricollega alla nuova classe
+_ISTANZE = weakref.WeakSet()
+
+
+# ============================================================================
+# CLIENT CONDIVISI (pool di connessioni keep-alive tra Groq e Gemini)
+# ============================================================================
+# Un solo httpx.Client sotto tutti i client dei provider: le connessioni TLS
+# restano aperte tra una chiamata e l'altra e tra OCR e generazione.
+# warm_up() le apre in anticipo, cosi' la prima richiesta dopo una pausa
+# non paga l'handshake.
+
+POOL_CONNESSIONI_MAX = 20
+POOL_KEEPALIVE_MAX = 10
+POOL_KEEPALIVE_SCADENZA = 90    # secondi di inattivita' prima di chiudere (default httpx: 5)
+TIMEOUT_CONNESSIONE = 10
+TIMEOUT_WARM_UP = 5
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/"
+
+
+class RegistroClient:
+    """Client Groq/Gemini creati alla prima richiesta, uno per chiave, sullo stesso pool HTTP."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._http = None
+        self._client = {}
+        self._host = {}          # origine -> ultimo uso (monotonic), per warm_up
+        self._warm_up_in_corso = set()
+        self.statistiche = {"richieste": 0, "connessioni_nuove": 0, "connessione_ms": 0.0,
+                            "warm_up": 0, "per_host": {}}
+
+    # --- pool HTTP e statistiche ---
+
+    def _http_client(self):
+        """httpx.Client condiviso (None senza httpx: ogni SDK usa il proprio)."""
+        if not HAS_HTTPX:
+            return None
+        with self._lock:
+            if self._http is None:
+                self._http = httpx.Client(
+                    limits=httpx.Limits(max_connections=POOL_CONNESSIONI_MAX,
+                                        max_keepalive_connections=POOL_KEEPALIVE_MAX,
+                                        keepalive_expiry=POOL_KEEPALIVE_SCADENZA),
+                    timeout=httpx.Timeout(60, connect=TIMEOUT_CONNESSIONE),
+                    event_hooks={"request": [self._su_richiesta]},
+                )
+            return self._http
+
+    def _su_richiesta(self, request):
+        """Conta richieste e connessioni nuove per host (trace di httpcore)."""
+        origine = f"{request.url.scheme}://{request.url.netloc.decode('ascii')}/"
+        with self._lock:
+            self.statistiche["richieste"] += 1
+            per_host = self.statistiche["per_host"].setdefault(
+                request.url.host, {"richieste": 0, "connessioni_nuove": 0})
+            per_host["richieste"] += 1
+            self._host[origine] = time.monotonic()
+        # Connessione pronta: dopo il TLS in https, dopo il TCP in http
+        evento_pronta = "connection.start_tls.complete" if request.url.scheme == "https" else "connection.connect_tcp.complete"
+        inizio = []
+
+        def trace(nome, info):
+            if nome == "connection.connect_tcp.started":
+                inizio.append(time.perf_counter())
+            elif nome == evento_pronta and inizio:
+                with self._lock:
+                    self.statistiche["connessioni_nuove"] += 1
+                    self.statistiche["connessione_ms"] += (time.perf_counter() - inizio[0]) * 1000
+                    per_host["connessioni_nuove"] += 1
+
+        request.extensions["trace"] = trace
+
+    def get_statistiche(self):
+        with self._lock:
+            stat = dict(self.statistiche, per_host={h: dict(v) for h, v in self.statistiche["per_host"].items()})
+        nuove = stat["connessioni_nuove"]
+        stat["connessioni_riusate"] = max(0, stat["richieste"] - nuove)
+        stat["riuso"] = stat["connessioni_riusate"] / stat["richieste"] if stat["richieste"] else None
+        stat["connessione_ms_media"] = stat.pop("connessione_ms") / nuove if nuove else None
+        return stat
+
+    # --- client dei provider ---
+
+    def groq(self, api_key):
+        """Client Groq per la chiave (GROQ_BASE_URL dall'ambiente, come nell'SDK)."""
+        base_url = os.environ.get("GROQ_BASE_URL")
+        chiave = ("groq", api_key, base_url)
+        with self._lock:
+            client = self._client.get(chiave)
+        if client is None:
+            http = self._http_client()
+            client = Groq(api_key=api_key, base_url=base_url, http_client=http)
+            with self._lock:
+                client = self._client.setdefault(chiave, client)
+                self._host.setdefault(str(client.base_url.copy_with(path="/")), 0.0)
+        return client
+
+    def gemini(self, api_key, timeout_ms=None, base_url=None):
+        """Client google-genai per la chiave (None con la libreria vecchia, che non ha client)."""
+        if GEMINI_VERSION != "new":
+            return None
+        chiave = ("gemini", api_key, timeout_ms, base_url)
+        with self._lock:
+            client = self._client.get(chiave)
+        if client is None:
+            opzioni = {}
+            if timeout_ms:
+                opzioni["timeout"] = timeout_ms
+            if base_url:
+                opzioni["base_url"] = base_url
+            http = self._http_client()
+            try:
+                client = genai.Client(api_key=api_key,
+                                      http_options=dict(opzioni, httpx_client=http) if http is not None else opzioni)
+            except Exception:
+                # Versioni di google-genai senza httpx_client: client con il proprio pool
+                client = genai.Client(api_key=api_key, http_options=opzioni or None)
+            parti = urlsplit(base_url or GEMINI_BASE_URL)
+            with self._lock:
+                client = self._client.setdefault(chiave, client)
+                self._host.setdefault(f"{parti.scheme}://{parti.netloc}/", 0.0)
+        return client
+
+    # --- warm-up ---
+
+    def warm_up(self, attendi=False):
+        """Apre in background una connessione verso ogni host dei client creati, se non c'e' gia'."""
+        http = self._http_client()
+        if http is None:
+            return []
+        adesso = time.monotonic()
+        with self._lock:
+            # Usato da poco: la connessione e' ancora nel pool
+            origini = [o for o, t in self._host.items()
+                       if adesso - t > POOL_KEEPALIVE_SCADENZA / 2 and o not in self._warm_up_in_corso]
+            self._warm_up_in_corso.update(origini)
+        threads = []
+        for origine in origini:
+            thread = threading.Thread(target=self._warm_up_host, args=(http, origine), daemon=True)
+            thread.start()
+            threads.append(thread)
+        if attendi:
+            for thread in threads:
+                thread.join(TIMEOUT_WARM_UP + 1)
+        return origini
+
+    def _warm_up_host(self, http, origine):
+        t_inizio = time.perf_counter()
+        try:
+            # Qualsiasi risposta va bene (anche 404): conta la connessione rimasta nel pool
+            http.head(origine, timeout=TIMEOUT_WARM_UP)
+            with self._lock:
+                self.statistiche["warm_up"] += 1
+            evento("warm_up", inizio=t_inizio, host=urlsplit(origine).hostname)
+        except Exception as e:
+            evento("warm_up", inizio=t_inizio, errore=e, host=urlsplit(origine).hostname)
+        finally:
+            with self._lock:
+                self._warm_up_in_corso.discard(origine)
+
+
+_REGISTRO = RegistroClient()
+
+
+def client_groq(api_key):
+    return _REGISTRO.groq(api_key)
+
+
+def client_gemini(api_key, timeout_ms=None, base_url=None):
+    return _REGISTRO.gemini(api_key, timeout_ms, base_url)
+
+
+def warm_up(attendi=False):
+    """Da chiamare all'avvio dell'app o all'apertura di una visita; non blocca (salvo attendi=True)."""
+    return _REGISTRO.warm_up(attendi)
+
+
+def get_statistiche_connessioni():
+    return _REGISTRO.get_statistiche()
+
 
 # ============================================================================
 # CLASSE GEMINI OCR (Lettura Foto)
@@ -65,21 +324,25 @@ class GeminiOCR:
     def __init__(self, api_key):
         self.api_key = api_key
         self.model_name = None
+        _ISTANZE.add(self)
         
         if not HAS_GEMINI:
             raise ImportError("Nessuna libreria Gemini installata. Installa: pip install google-generativeai")
         
         # Configura in base alla versione
         if GEMINI_VERSION == "new":
-            self.client = genai.Client(api_key=api_key)
+            self.client = client_gemini(api_key)
         else:
             genai_old.configure(api_key=api_key)
             self.client = None
     
+    @traccia("ocr")
     def read_image(self, image_path, prompt=None):
         """Legge il testo da un'immagine."""
         from PIL import Image
+        t_fase = time.perf_counter()
         img = Image.open(image_path)
+        evento("caricamento_immagine", inizio=t_fase, dimensioni=f"{img.width}x{img.height}")
         
         if prompt is None:
             prompt = self._get_default_prompt()
@@ -106,14 +369,17 @@ REGOLE RIGIDE:
         last_error = None
         
         for model_name in self.MODELS_PRIORITY:
+            t_fase = time.perf_counter()
             try:
                 response = self.client.models.generate_content(
                     model=model_name,
                     contents=[prompt, img]
                 )
                 self.model_name = model_name
+                evento("llm", inizio=t_fase, model=model_name)
                 return response.text
             except Exception as e:
+                evento("llm", inizio=t_fase, errore=e, model=model_name)
                 last_error = e
                 continue
         
@@ -141,18 +407,323 @@ REGOLE RIGIDE:
                 models_to_try.insert(0, model)
         
         for model_name in models_to_try:
+            t_fase = time.perf_counter()
             try:
                 model = genai_old.GenerativeModel(model_name)
                 response = model.generate_content([prompt, img])
                 self.model_name = model_name
+                evento("llm", inizio=t_fase, model=model_name)
                 return response.text
             except Exception as e:
+                evento("llm", inizio=t_fase, errore=e, model=model_name)
                 last_error = e
                 continue
         
         raise Exception(f"Nessun modello Gemini disponibile. Ultimo errore: {last_error}")
 
 
+# ============================================================================
+# GENERAZIONE TESTO: PROVIDER E ROUTER (Groq / Gemini)
+# ============================================================================
+# AIGenerator non parla direttamente con un SDK: chiede al router, che sceglie
+# il provider in base a latenza e tasso di errore misurati (medie mobili
+# esponenziali) e passa all'altro se il primo fallisce o e' degradato.
+
+GEMINI_TEXT_MODEL = "gemini-2.5-flash"
+TIMEOUT_TESTO = 60              # secondi per una generazione (poi si passa all'altro provider)
+
+ROUTER_ALPHA = 0.2              # peso dell'ultima misura nelle medie mobili
+ROUTER_ERRORI_MAX = 0.5         # tasso di errore oltre cui il provider e' considerato degradato
+ROUTER_FALLIMENTI_MAX = 3       # errori consecutivi che lo mettono in pausa
+ROUTER_PAUSA = 60               # secondi di pausa prima di riprovare un provider degradato
+ROUTER_ESPLORAZIONE = 0.05      # quota di richieste al provider non preferito (misure aggiornate)
+
+# Politica: peso della latenza rispetto al costo (1 = solo latenza, 0 = solo costo)
+ROUTER_POLITICA = "latenza"
+POLITICHE = {"latenza": 1.0, "bilanciata": 0.5, "costo": 0.0}
+
+# Costo relativo per richiesta (aggiornabile da GitHub se cambiano i listini)
+COSTO_RELATIVO = {
+    "groq": 1.0,
+    "gemini": 1.5,
+}
+
+# Errori senza codice HTTP che dicono "provider irraggiungibile" (rete, timeout)
+_ERRORI_DI_RETE = ((OSError,) + ((httpx.TransportError,) if HAS_HTTPX else ())
+                   + ((APIConnectionError,) if HAS_GROQ else ()))
+
+# Coda condivisa tra i processi che usano la stessa chiave Groq (vedi rate_limiter.py)
+RATE_LIMIT_CONDIVISO = True
+RATE_LIMIT_TENTATIVI = 3        # nuovi tentativi dopo un 429, aspettando retry-after
+
+
+class ErroreRichiesta(Exception):
+    """Richiesta rifiutata dal provider (4xx) o non partita (errore locale).
+
+    Non dipende dal provider: il router non passa all'altro e non la conta
+    come errore del provider. L'eccezione originale e' in .originale (e __cause__).
+    """
+
+    def __init__(self, provider, originale):
+        super().__init__(f"{provider}: {originale}")
+        self.provider = provider
+        self.originale = originale
+
+
+def _errore_del_provider(errore):
+    """True se l'errore dice che il provider non sta bene: rete, timeout, 5xx, 429."""
+    # Codice HTTP: status_code (groq), response.status_code (httpx), code (google-genai, api_core)
+    stato = getattr(errore, "status_code", None)
+    if stato is None:
+        stato = getattr(getattr(errore, "response", None), "status_code", None)
+    if stato is None and isinstance(getattr(errore, "code", None), int):
+        stato = errore.code
+    if stato is not None:
+        return stato == 429 or stato >= 500
+    # Coda del rate limiter oltre ATTESA_MAX: come un 429, meglio passare all'altro provider
+    if rate_limiter is not None and isinstance(errore, rate_limiter.AttesaScaduta):
+        return True
+    return isinstance(errore, _ERRORI_DI_RETE)
+
+
+class RispostaTesto:
+    """Testo generato con provider, modello e token usati."""
+
+    def __init__(self, testo, provider, model, prompt_tokens=0, cached_tokens=0, completion_tokens=0):
+        self.testo = testo
+        self.provider = provider
+        self.model = model
+        self.uso = {
+            "prompt_tokens": prompt_tokens or 0,
+            "cached_tokens": cached_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+        }
+
+
+class ProviderGroq:
+    """Chat completions Groq (formato messaggi OpenAI)."""
+
+    nome = "groq"
+
+    def __init__(self, client, model, priorita="interattiva"):
+        self.client = client
+        self.model = model
+        self.priorita = priorita
+        self.limiter = None
+        if RATE_LIMIT_CONDIVISO and rate_limiter is not None:
+            self.limiter = rate_limiter.limiter_per_chiave("groq", client.api_key)
+            # I 429 li gestisce il limiter (attesa condivisa), non i retry interni dell'SDK
+            self.client = client.with_options(max_retries=0)
+
+    def genera(self, messages, temperature, max_tokens, reasoning_effort=None, json_mode=False):
+        parametri = {}
+        if reasoning_effort:
+            parametri["reasoning_effort"] = reasoning_effort
+        if json_mode:
+            parametri["response_format"] = {"type": "json_object"}
+
+        if self.limiter is None:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **parametri
+            )
+        else:
+            response = self._genera_in_coda(messages, temperature, max_tokens, parametri)
+
+        usage = getattr(response, "usage", None)
+        dettagli = getattr(usage, "prompt_tokens_details", None)
+        return RispostaTesto(
+            response.choices[0].message.content or "", self.nome, self.model,
+            getattr(usage, "prompt_tokens", 0), getattr(dettagli, "cached_tokens", 0),
+            getattr(usage, "completion_tokens", 0)
+        )
+
+    def _genera_in_coda(self, messages, temperature, max_tokens, parametri):
+        """Aspetta il turno nel rate limiter condiviso e ritenta dopo i 429."""
+        stima = rate_limiter.stima_token(messages, max_tokens)
+        for tentativo in range(RATE_LIMIT_TENTATIVI + 1):
+            attesa = self.limiter.acquisisci(stima, self.priorita)
+            if attesa > 1:
+                evento("attesa_rate_limit", inizio=time.perf_counter() - attesa, priorita=self.priorita)
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    **parametri
+                )
+            except RateLimitError as e:
+                self.limiter.aggiorna_da_headers(e.response.headers)
+                attesa = self.limiter.segnala_429(e.response.headers.get("retry-after"))
+                if tentativo == RATE_LIMIT_TENTATIVI:
+                    raise
+                print(f"Groq: limite di richieste raggiunto, nuovo tentativo tra {attesa:.0f} s")
+                continue
+            self.limiter.aggiorna_da_headers(raw.headers)
+            return raw.parse()
+
+
+class ProviderGemini:
+    """Generazione testo con Gemini (supporta entrambe le librerie)."""
+
+    nome = "gemini"
+
+    def __init__(self, api_key, model=GEMINI_TEXT_MODEL, client=None):
+        if not HAS_GEMINI:
+            raise ImportError("Nessuna libreria Gemini installata. Installa: pip install google-genai")
+        self.model = model
+        self.client = client
+        if GEMINI_VERSION == "new" and client is None:
+            self.client = client_gemini(api_key, TIMEOUT_TESTO * 1000)
+        elif GEMINI_VERSION == "old":
+            genai_old.configure(api_key=api_key)
+
+    def genera(self, messages, temperature, max_tokens, reasoning_effort=None, json_mode=False):
+        system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        contenuti = [
+            {"role": "model" if m["role"] == "assistant" else "user", "parts": [{"text": m["content"]}]}
+            for m in messages if m["role"] != "system"
+        ]
+        config = {"temperature": temperature, "max_output_tokens": max_tokens}
+        if json_mode:
+            config["response_mime_type"] = "application/json"
+
+        if GEMINI_VERSION == "new":
+            if system:
+                config["system_instruction"] = system
+            # Come reasoning_effort="none" su Groq: niente ragionamento interno
+            if reasoning_effort == "none":
+                config["thinking_config"] = {"thinking_budget": 0}
+            response = self.client.models.generate_content(model=self.model, contents=contenuti, config=config)
+            usage = response.usage_metadata
+        else:
+            modello = genai_old.GenerativeModel(self.model, system_instruction=system or None)
+            response = modello.generate_content(contenuti, generation_config=config,
+                                                request_options={"timeout": TIMEOUT_TESTO})
+            usage = getattr(response, "usage_metadata", None)
+
+        return RispostaTesto(
+            response.text or "", self.nome, self.model,
+            getattr(usage, "prompt_token_count", 0), getattr(usage, "cached_content_token_count", 0),
+            getattr(usage, "candidates_token_count", 0)
+        )
+
+
+class _StatoProvider:
+    """Medie mobili di latenza ed errori di un provider."""
+
+    def __init__(self):
+        self.latenza = None         # secondi (EWMA), None = mai misurata
+        self.errori = 0.0           # tasso di errore (EWMA)
+        self.fallimenti = 0         # errori consecutivi
+        self.pausa_fino = 0.0       # time.monotonic() fino a cui il provider e' escluso
+        self.richieste = 0
+
+    def sano(self, adesso):
+        return adesso >= self.pausa_fino
+
+
+class RouterTesto:
+    """Sceglie il provider per ogni generazione e ripiega sugli altri se fallisce."""
+
+    def __init__(self, providers, politica=None):
+        self.providers = list(providers)
+        self.politica = politica if politica is not None else ROUTER_POLITICA
+        self._stato = {p.nome: _StatoProvider() for p in self.providers}
+        self._lock = threading.Lock()
+
+    def _peso_latenza(self):
+        if isinstance(self.politica, (int, float)):
+            return min(1.0, max(0.0, float(self.politica)))
+        return POLITICHE.get(self.politica, 1.0)
+
+    def _ordine(self):
+        """Provider in ordine di preferenza: prima i sani, per punteggio (piu' basso = meglio)."""
+        adesso = time.monotonic()
+        peso = self._peso_latenza()
+        with self._lock:
+            latenze = [s.latenza for s in self._stato.values() if s.latenza]
+            latenza_min = min(latenze) if latenze else 1.0
+            costo_min = min(COSTO_RELATIVO.get(p.nome, 1.0) for p in self.providers)
+
+            def punteggio(provider):
+                stato = self._stato[provider.nome]
+                # Un provider mai misurato va provato subito (se la latenza conta)
+                latenza = stato.latenza / latenza_min if stato.latenza else 0.0
+                costo = COSTO_RELATIVO.get(provider.nome, 1.0) / costo_min
+                return (peso * latenza + (1 - peso) * costo) * (1 + 4 * stato.errori)
+
+            sani = sorted((p for p in self.providers if self._stato[p.nome].sano(adesso)), key=punteggio)
+            in_pausa = sorted((p for p in self.providers if not self._stato[p.nome].sano(adesso)),
+                              key=lambda p: self._stato[p.nome].pausa_fino)
+
+        # Ogni tanto si prova il secondo, cosi' la sua latenza resta aggiornata
+        if len(sani) > 1 and random.random() < ROUTER_ESPLORAZIONE:
+            sani[0], sani[1] = sani[1], sani[0]
+        # Quelli in pausa restano come ultima risorsa
+        return sani + in_pausa
+
+    def _registra(self, nome, durata=None, errore=False):
+        with self._lock:
+            stato = self._stato[nome]
+            stato.richieste += 1
+            stato.errori = (1 - ROUTER_ALPHA) * stato.errori + ROUTER_ALPHA * (1.0 if errore else 0.0)
+            if errore:
+                stato.fallimenti += 1
+                if stato.fallimenti >= ROUTER_FALLIMENTI_MAX or stato.errori > ROUTER_ERRORI_MAX:
+                    stato.pausa_fino = time.monotonic() + ROUTER_PAUSA
+            else:
+                stato.fallimenti = 0
+                stato.pausa_fino = 0.0
+                if stato.latenza is None:
+                    stato.latenza = durata
+                else:
+                    stato.latenza = (1 - ROUTER_ALPHA) * stato.latenza + ROUTER_ALPHA * durata
+
+    def genera(self, messages, temperature=0.3, max_tokens=4000, reasoning_effort=None, json_mode=False):
+        """Ritorna una RispostaTesto; solleva l'ultimo errore se nessun provider risponde.
+
+        Una richiesta rifiutata (4xx) o non partita solleva subito ErroreRichiesta:
+        l'altro provider non farebbe meglio e questo non e' degradato.
+        """
+        ultimo_errore = RuntimeError("Nessun provider di generazione configurato")
+        for provider in self._ordine():
+            t0 = time.monotonic()
+            try:
+                risposta = provider.genera(messages, temperature, max_tokens, reasoning_effort, json_mode)
+            except Exception as e:
+                if not _errore_del_provider(e):
+                    evento("richiesta_rifiutata", errore=e, provider=provider.nome)
+                    raise ErroreRichiesta(provider.nome, e) from e
+                self._registra(provider.nome, errore=True)
+                evento("provider_fallito", errore=e, provider=provider.nome)
+                if len(self.providers) > 1:
+                    print(f"Provider {provider.nome} non disponibile ({e}), provo il successivo")
+                ultimo_errore = e
+                continue
+            self._registra(provider.nome, time.monotonic() - t0)
+            return risposta
+        raise ultimo_errore
+
+    def get_statistiche(self):
+        """Latenza media (ms), tasso di errore e stato di ogni provider."""
+        adesso = time.monotonic()
+        with self._lock:
+            return {
+                nome: {
+                    "latenza_ms": round(s.latenza * 1000, 1) if s.latenza is not None else None,
+                    "errori": round(s.errori, 3),
+                    "sano": s.sano(adesso),
+                    "richieste": s.richieste,
+                }
+                for nome, s in self._stato.items()
+            }
+
+
 # ============================================================================
 # UTILITY FUNCTIONS
 # ============================================================================
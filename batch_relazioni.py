@@ -0,0 +1,370 @@
+__version__ = "1.2"
+# batch_relazioni.py - Rigenerazione in blocco delle relazioni archiviate
+# CODICE UNIVERSALE - Aggiornabile da GitHub
+# Per quando cambiano template o AI_MODEL: OCR + pulizia + relazione per ogni
+# visita, con un journal che permette di riprendere un'esecuzione interrotta.
+#
+# Uso:
+#   python batch_relazioni.py ARCHIVIO --template dentista --output relazioni/
+#   python batch_relazioni.py visite.jsonl --template dentista --output relazioni/ --workers 8 --max-llm 4
+#
+# ARCHIVIO puo' essere:
+#   - una cartella con una sottocartella per visita (file .txt = trascrizione,
+#     immagini = foto degli appunti, paziente.json / medico.json facoltativi)
+#     oppure un file .txt per visita
+#   - un manifest .json (lista) o .jsonl (una visita per riga):
+#     {"id": "...", "trascrizione": "file.txt", "foto": ["a.jpg"], "paziente": {...}, "medico": {...}}
+#     (percorsi relativi al manifest)
+# Chiavi API: GROQ_API_KEY e GEMINI_API_KEY (o --groq-key / --gemini-key).
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ai_module import funzioni_tracing
+
+in_visita, = funzioni_tracing("in_visita")
+
+# =============================================================================
+# CONFIGURAZIONE
+# =============================================================================
+WORKERS = 4                 # visite elaborate in parallelo
+MAX_LLM_IN_VOLO = 2         # chiamate AI contemporanee (OCR, pulizia, relazione)
+ESTENSIONI_FOTO = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+FILE_JOURNAL = "batch_journal.jsonl"
+
+
+# =============================================================================
+# LETTURA ARCHIVIO
+# =============================================================================
+
+def _leggi_json(percorso):
+    try:
+        with open(percorso, "r", encoding="utf-8-sig") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: {percorso} ignorato: {e}")
+        return None
+
+
+def _visita_da_cartella(cartella):
+    nomi = sorted(os.listdir(cartella))
+    return {
+        "id": os.path.basename(cartella),
+        "trascrizioni": [os.path.join(cartella, n) for n in nomi if n.lower().endswith(".txt")],
+        "foto": [os.path.join(cartella, n) for n in nomi if n.lower().endswith(ESTENSIONI_FOTO)],
+        "paziente": _leggi_json(os.path.join(cartella, "paziente.json")) if "paziente.json" in nomi else None,
+        "medico": _leggi_json(os.path.join(cartella, "medico.json")) if "medico.json" in nomi else None,
+    }
+
+
+def _visita_da_manifest(voce, base):
+    def _percorsi(valore):
+        if not valore:
+            return []
+        if isinstance(valore, str):
+            valore = [valore]
+        return [os.path.join(base, p) for p in valore]
+
+    return {
+        "id": str(voce["id"]),
+        "trascrizioni": _percorsi(voce.get("trascrizione")),
+        "foto": _percorsi(voce.get("foto")),
+        "paziente": voce.get("paziente"),
+        "medico": voce.get("medico"),
+    }
+
+
+def carica_visite(sorgente):
+    """Lista delle visite da una cartella o da un manifest .json/.jsonl."""
+    if os.path.isdir(sorgente):
+        visite = []
+        for nome in sorted(os.listdir(sorgente)):
+            percorso = os.path.join(sorgente, nome)
+            if os.path.isdir(percorso):
+                visite.append(_visita_da_cartella(percorso))
+            elif nome.lower().endswith(".txt"):
+                visite.append({"id": os.path.splitext(nome)[0], "trascrizioni": [percorso],
+                               "foto": [], "paziente": None, "medico": None})
+        return visite
+
+    base = os.path.dirname(os.path.abspath(sorgente))
+    if sorgente.lower().endswith(".jsonl"):
+        voci = []
+        with open(sorgente, "r", encoding="utf-8-sig") as f:
+            for numero, riga in enumerate(f, 1):
+                if riga.strip():
+                    try:
+                        voci.append(json.loads(riga))
+                    except ValueError as e:
+                        print(f"Warning: riga {numero} del manifest ignorata: {e}")
+    else:
+        voci = _leggi_json(sorgente) or []
+    return [_visita_da_manifest(v, base) for v in voci if isinstance(v, dict) and "id" in v]
+
+
+def _impronta(visita, firma):
+    """Hash di input e configurazione: se cambia qualcosa la visita va rifatta."""
+    h = hashlib.sha256(firma.encode("utf-8"))
+    for percorso in visita["trascrizioni"] + visita["foto"]:
+        h.update(percorso.encode("utf-8"))
+        with open(percorso, "rb") as f:
+            for blocco in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(blocco)
+    h.update(json.dumps([visita["paziente"], visita["medico"]], sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _impronta_template(template):
+    """Hash del sorgente del template: se il template cambia, le relazioni vanno rifatte."""
+    h = hashlib.sha256(getattr(template, "__name__", "").encode("utf-8"))
+    percorso = getattr(template, "__file__", None)
+    if percorso and os.path.exists(percorso):
+        with open(percorso, "rb") as f:
+            h.update(f.read())
+    else:
+        for nome in ("AI_SYSTEM_MESSAGE", "RELAZIONE_TEMPLATE", "SEZIONI_RELAZIONE", "LAYOUT_RELAZIONE"):
+            h.update(repr(getattr(template, nome, None)).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+# =============================================================================
+# JOURNAL E SCRITTURA ATOMICA
+# =============================================================================
+
+class Journal:
+    """Registro append-only delle visite completate (una riga JSON per evento)."""
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self.completate = {}
+        if os.path.exists(percorso):
+            with open(percorso, "r", encoding="utf-8") as f:
+                for riga in f:
+                    try:
+                        voce = json.loads(riga)
+                    except ValueError:
+                        continue    # riga troncata da un'interruzione
+                    if voce.get("stato") == "ok":
+                        self.completate[voce["id"]] = voce
+                    else:
+                        self.completate.pop(voce.get("id"), None)
+        self._file = open(percorso, "a", encoding="utf-8")
+
+    def gia_fatta(self, visita_id, impronta, uscita):
+        voce = self.completate.get(visita_id)
+        return bool(voce) and voce.get("impronta") == impronta and os.path.exists(uscita)
+
+    def registra(self, **voce):
+        voce["ts"] = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            self._file.write(json.dumps(voce, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def chiudi(self):
+        self._file.close()
+
+
+def scrivi_atomico(percorso, testo):
+    """Scrive su un file temporaneo nella stessa cartella e poi lo sostituisce (os.replace)."""
+    cartella = os.path.dirname(percorso) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".batch.", suffix=".tmp", dir=cartella)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(testo)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, percorso)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# =============================================================================
+# ELABORAZIONE
+# =============================================================================
+
+class BatchRelazioni:
+    """OCR -> pulizia -> relazione per ogni visita, con un tetto alle chiamate AI in volo."""
+
+    def __init__(self, generatore, ocr=None, cartella_uscita="relazioni", workers=WORKERS,
+                 max_llm=MAX_LLM_IN_VOLO, pulizia=True, forza=False):
+        self.generatore = generatore
+        self.ocr = ocr
+        self.cartella_uscita = cartella_uscita
+        self.workers = workers
+        self.pulizia = pulizia
+        self.forza = forza
+        self._llm = threading.BoundedSemaphore(max_llm)
+        self._interrotto = threading.Event()
+
+        self.firma = "|".join([
+            _impronta_template(generatore.template),
+            generatore.model,
+            getattr(sys.modules.get(type(generatore).__module__), "__version__", ""),
+            "pulizia" if pulizia else "grezzo",
+        ])
+
+    def _uscita(self, visita):
+        nome = "".join(c if c.isalnum() or c in "-_." else "_" for c in visita["id"])
+        return os.path.join(self.cartella_uscita, nome + ".txt")
+
+    def _elabora(self, visita):
+        if self._interrotto.is_set():
+            return None
+        parti = []
+        for percorso in visita["trascrizioni"]:
+            with open(percorso, "r", encoding="utf-8-sig") as f:
+                parti.append(f.read().strip())
+        for percorso in visita["foto"]:
+            if self.ocr is None:
+                raise RuntimeError("visita con foto ma OCR non disponibile (GEMINI_API_KEY)")
+            with self._llm:
+                parti.append(self.ocr.read_image(percorso).strip())
+        testo = "\n\n".join(p for p in parti if p)
+        if not testo:
+            raise ValueError("nessun testo (trascrizione vuota e nessuna foto)")
+
+        if self.pulizia:
+            with self._llm:
+                testo = self.generatore.pulisci_appunti(testo)
+        with self._llm:
+            relazione = self.generatore.genera_relazione(testo, visita["paziente"], visita["medico"])
+        # genera_relazione non solleva eccezioni: segnala gli errori nel testo
+        if relazione.startswith("ERRORE"):
+            raise RuntimeError(relazione.split("\n", 1)[0])
+        return relazione
+
+    def _esegui_visita(self, visita, impronta, journal):
+        """Elabora, scrive e registra una visita; il journal viene scritto dal worker
+        stesso, cosi' un'interruzione non perde le visite gia' concluse."""
+        try:
+            # Una traccia per visita: i worker in parallelo non finiscono nella stessa
+            with in_visita(visita["id"]):
+                relazione = self._elabora(visita)
+            if relazione is None:
+                return None
+            uscita = self._uscita(visita)
+            scrivi_atomico(uscita, relazione)
+            journal.registra(id=visita["id"], stato="ok", impronta=impronta, file=os.path.basename(uscita))
+            return "ok"
+        except Exception as e:
+            journal.registra(id=visita["id"], stato="errore", errore=str(e))
+            return f"ERRORE: {e}"
+
+    def esegui(self, visite):
+        """Elabora le visite non ancora fatte. Ritorna il riepilogo (dict)."""
+        os.makedirs(self.cartella_uscita, exist_ok=True)
+        journal = Journal(os.path.join(self.cartella_uscita, FILE_JOURNAL))
+
+        da_fare = []
+        saltate = 0
+        illeggibili = 0
+        for visita in visite:
+            try:
+                impronta = _impronta(visita, self.firma)
+            except OSError as e:
+                # Visita non elaborabile: conta tra gli errori, cosi' il batch non risulta riuscito
+                illeggibili += 1
+                journal.registra(id=visita["id"], stato="errore", errore=f"input illeggibile: {e}")
+                print(f"{visita['id']}: ERRORE: input illeggibile: {e}")
+                continue
+            if not self.forza and journal.gia_fatta(visita["id"], impronta, self._uscita(visita)):
+                saltate += 1
+            else:
+                da_fare.append((visita, impronta))
+
+        totale = len(da_fare)
+        print(f"Visite: {len(visite)}  gia' fatte: {saltate}  illeggibili: {illeggibili}  da elaborare: {totale}")
+        riepilogo = {"totale": len(visite), "saltate": saltate, "illeggibili": illeggibili,
+                     "ok": 0, "errori": illeggibili, "interrotto": False}
+        t0 = time.perf_counter()
+
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {pool.submit(self._esegui_visita, v, imp, journal): v for v, imp in da_fare}
+        try:
+            for fatte, future in enumerate(as_completed(futures), 1):
+                visita = futures[future]
+                esito = future.result()
+                if esito is None:
+                    continue
+                riepilogo["ok" if esito == "ok" else "errori"] += 1
+
+                trascorso = time.perf_counter() - t0
+                al_minuto = fatte / trascorso * 60 if trascorso > 0 else 0.0
+                eta = (totale - fatte) * trascorso / fatte
+                print(f"[{fatte}/{totale}] {al_minuto:5.1f} visite/min  "
+                      f"ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}  {visita['id']}: {esito}", flush=True)
+        except KeyboardInterrupt:
+            # Le visite gia' nel journal restano fatte: basta rilanciare lo stesso comando
+            self._interrotto.set()
+            riepilogo["interrotto"] = True
+            print("\nInterrotto: attendo le visite in corso, poi rilancia lo stesso comando per riprendere")
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            journal.chiudi()
+
+        riepilogo["secondi"] = round(time.perf_counter() - t0, 1)
+        return riepilogo
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rigenera in blocco le relazioni archiviate")
+    parser.add_argument("sorgente", help="cartella delle visite o manifest .json/.jsonl")
+    parser.add_argument("--template", required=True, help="nome del template (cartella templates/)")
+    parser.add_argument("--output", default="relazioni", help="cartella delle relazioni e del journal")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--max-llm", type=int, default=MAX_LLM_IN_VOLO, help="chiamate AI contemporanee")
+    parser.add_argument("--no-cleanup", action="store_true", help="salta pulisci_appunti")
+    parser.add_argument("--force", action="store_true", help="rifa' anche le visite gia' nel journal")
+    parser.add_argument("--groq-key", default=os.environ.get("GROQ_API_KEY"))
+    parser.add_argument("--gemini-key", default=os.environ.get("GEMINI_API_KEY"))
+    args = parser.parse_args(argv)
+
+    if not args.groq_key:
+        print("Errore: chiave Groq mancante (GROQ_API_KEY o --groq-key)")
+        return 2
+
+    from ai_generator import AIGenerator
+    # Priorita' batch: le relazioni generate dall'app nel frattempo passano prima
+    generatore = AIGenerator(args.groq_key, priorita="batch")
+    if not generatore.carica_template(args.template):
+        return 2
+
+    ocr = None
+    if args.gemini_key:
+        try:
+            from ai_module import GeminiOCR
+            ocr = GeminiOCR(args.gemini_key)
+        except ImportError as e:
+            print(f"Warning: OCR non disponibile: {e}")
+
+    visite = carica_visite(args.sorgente)
+    batch = BatchRelazioni(generatore, ocr, args.output, args.workers, args.max_llm,
+                           pulizia=not args.no_cleanup, forza=args.force)
+    riepilogo = batch.esegui(visite)
+    print(f"Completate: {riepilogo['ok']}  errori: {riepilogo['errori']}  "
+          f"saltate: {riepilogo['saltate']}  tempo: {riepilogo['secondi']} s")
+    if riepilogo["interrotto"]:
+        return 130
+    return 1 if riepilogo["errori"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1050 @@
+# benchmark.py - Benchmark con servizi finti in locale
+# Strumento per sviluppatori: NON viene distribuito tramite versions.txt
+# Da lanciare prima di pubblicare un modulo aggiornato:
+#   python benchmark.py all --output bench.json --baseline bench_precedente.json
+#   python benchmark.py manager --max-sessions 200 --step 20 --duration 10
+#   python benchmark.py pool     (solo controlli: connessioni HTTP dell'updater)
+# Latenza, banda ed errori dei servizi finti: --latency, --throughput, --error-rate
+
+import os
+import sys
+import re
+import gzip
+import json
+import time
+import types
+import random
+import shutil
+import hashlib
+import tempfile
+import statistics
+import struct
+import base64
+import argparse
+import contextlib
+import threading
+import socketserver
+import multiprocessing
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHUNK_SECONDI = 0.1
+TOLLERANZA = 0.2        # +20% rispetto al riferimento = regressione
+
+# Metriche confrontate con il riferimento: (percorso, True se piu' alto e' meglio)
+METRICHE_CONFRONTO = [
+    ("generazione.genera_relazione_ms.p95", False),
+    ("generazione.genera_relazione_json_ms.p95", False),
+    ("generazione.pulisci_appunti_ms.p95", False),
+    ("generazione.post_processing_ms.p50", False),
+    ("generazione.cache_ratio", True),
+    ("generazione.connection_reuse", True),
+    ("ratelimit.shared.server_429", False),
+    ("ratelimit.shared.interactive_ms.p95", False),
+    ("ocr.images_per_s", True),
+    ("ocr.read_image_ms.p95", False),
+    ("audio.cpu_fraction", False),
+    ("audio.queue_lag_ms.p95", False),
+    ("audio.first_byte_ms", False),
+    ("update.check_ms", False),
+    ("update.download_ms", False),
+    ("update.recheck_ms", False),
+    ("manager.max_sessions_one_core", True),
+]
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+
+# =============================================================================
+# DEEPGRAM FINTO (websocket minimale, RFC 6455)
+# =============================================================================
+
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def _ricevi_esatti(sock, n):
+    dati = b""
+    while len(dati) < n:
+        parte = sock.recv(n - len(dati))
+        if not parte:
+            raise ConnectionError("connessione chiusa dal client")
+        dati += parte
+    return dati
+
+
+def _leggi_frame(sock):
+    testa = _ricevi_esatti(sock, 2)
+    opcode = testa[0] & 0x0F
+    lunghezza = testa[1] & 0x7F
+    if lunghezza == 126:
+        lunghezza = struct.unpack(">H", _ricevi_esatti(sock, 2))[0]
+    elif lunghezza == 127:
+        lunghezza = struct.unpack(">Q", _ricevi_esatti(sock, 8))[0]
+    maschera = _ricevi_esatti(sock, 4) if testa[1] & 0x80 else None
+    dati = _ricevi_esatti(sock, lunghezza)
+    if maschera:
+        dati = (int.from_bytes(dati, "big") ^ int.from_bytes((maschera * (lunghezza // 4 + 1))[:lunghezza], "big")).to_bytes(lunghezza, "big")
+    return opcode, dati
+
+
+def _scrivi_frame(sock, opcode, dati):
+    lunghezza = len(dati)
+    if lunghezza < 126:
+        testa = bytes([0x80 | opcode, lunghezza])
+    elif lunghezza < 65536:
+        testa = bytes([0x80 | opcode, 126]) + struct.pack(">H", lunghezza)
+    else:
+        testa = bytes([0x80 | opcode, 127]) + struct.pack(">Q", lunghezza)
+    sock.sendall(testa + dati)
+
+
+def _risultato_deepgram(testo):
+    return json.dumps({
+        "type": "Results",
+        "is_final": True,
+        "channel": {"alternatives": [{"transcript": testo}]},
+    }).encode("utf-8")
+
+
+class _GestoreDeepgram(socketserver.BaseRequestHandler):
+    """Accetta l'upgrade websocket, conta l'audio e risponde con risultati finali."""
+
+    def handle(self):
+        opzioni = self.server.opzioni
+        sock = self.request
+        richiesta = b""
+        while b"\r\n\r\n" not in richiesta:
+            parte = sock.recv(4096)
+            if not parte:
+                return
+            richiesta += parte
+
+        time.sleep(opzioni.get("latenza", 0))
+        if random.random() < opzioni.get("errori", 0):
+            sock.sendall(b"HTTP/1.1 429 Too Many Requests\r\nContent-Length: 0\r\n\r\n")
+            return
+
+        chiave = b""
+        for riga in richiesta.split(b"\r\n"):
+            if riga.lower().startswith(b"sec-websocket-key:"):
+                chiave = riga.split(b":", 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1(chiave + _WS_GUID).digest())
+        sock.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                     b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+        byte_per_risultato = opzioni.get("byte_per_risultato", 32000)
+        ricevuti = 0
+        try:
+            while True:
+                opcode, dati = _leggi_frame(sock)
+                if opcode == 0x2:
+                    ricevuti += len(dati)
+                    if ricevuti >= byte_per_risultato:
+                        ricevuti = 0
+                        _scrivi_frame(sock, 0x1, _risultato_deepgram("paziente riferisce dolore"))
+                elif opcode == 0x1 and b"CloseStream" in dati:
+                    _scrivi_frame(sock, 0x1, _risultato_deepgram("fine registrazione"))
+                    _scrivi_frame(sock, 0x8, struct.pack(">H", 1000))
+                    return
+                elif opcode == 0x8:
+                    _scrivi_frame(sock, 0x8, struct.pack(">H", 1000))
+                    return
+                elif opcode == 0x9:
+                    _scrivi_frame(sock, 0xA, dati)
+        except (ConnectionError, OSError):
+            pass
+
+
+def avvia_deepgram_finto(opzioni=None):
+    """Avvia il Deepgram finto in un thread e ritorna il server (porta in server_address)."""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _GestoreDeepgram)
+    server.daemon_threads = True
+    server.opzioni = opzioni or {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _processo_deepgram_finto(opzioni, coda_porta):
+    server = avvia_deepgram_finto(opzioni)
+    coda_porta.put(server.server_address[1])
+    threading.Event().wait()
+
+
+def avvia_deepgram_finto_processo(opzioni=None):
+    """Come avvia_deepgram_finto ma in un processo separato, per non sporcare le misure di CPU."""
+    coda_porta = multiprocessing.Queue()
+    processo = multiprocessing.Process(target=_processo_deepgram_finto, args=(opzioni or {}, coda_porta), daemon=True)
+    processo.start()
+    return processo, coda_porta.get(timeout=10)
+
+
+# =============================================================================
+# HTTP FINTO (Groq, Gemini, GitHub raw)
+# =============================================================================
+
+RELAZIONE_FINTA = """## Relazione clinica
+
+Gentile Collega, ho visitato in data {date} **il Sig. Rossi** che riferisce dolore.
+E' stato eseguito un esame obiettivo; il paziente e' stato prescritto un'antibiotico.
+Si consiglia un po di riposo e controllo su il lato destro.
+"""
+
+
+class _GestoreHTTP(http.server.BaseHTTPRequestHandler):
+    """Groq (chat completions), Gemini (generateContent) e GitHub raw con ETag."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _rispondi(self, status, corpo, headers=None, tipo="application/json"):
+        opzioni = self.server.opzioni
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        for nome, valore in (headers or {}).items():
+            self.send_header(nome, valore)
+        self.end_headers()
+
+        # Banda limitata: il corpo esce a blocchi
+        throughput = opzioni.get("throughput")
+        if not throughput:
+            self.wfile.write(corpo)
+            return
+        blocco = 4096
+        for i in range(0, len(corpo), blocco):
+            self.wfile.write(corpo[i:i + blocco])
+            time.sleep(min(len(corpo) - i, blocco) / throughput)
+
+    def _errore_iniettato(self):
+        opzioni = self.server.opzioni
+        time.sleep(opzioni.get("latenza", 0))
+        if random.random() < opzioni.get("errori", 0):
+            self.server.conteggi["errori"] += 1
+            corpo = json.dumps({"error": {"message": "errore iniettato", "type": "rate_limit"}}).encode()
+            self._rispondi(opzioni.get("status_errore", 429), corpo, {"Retry-After": "0"})
+            return True
+        return False
+
+    def do_POST(self):
+        lunghezza = int(self.headers.get("Content-Length", 0))
+        dati = self.rfile.read(lunghezza)
+        self.server.conteggi["richieste"] += 1
+        if self._errore_iniettato():
+            return
+        if self.path.startswith("/v1/listen"):
+            self._rispondi(200, json.dumps(self._trascrizione_file(dati)).encode("utf-8"))
+            return
+        richiesta = json.loads(dati or b"{}")
+
+        testo = RELAZIONE_FINTA * self.server.opzioni.get("ripeti", 4)
+        if self.path.endswith("/chat/completions"):
+            if self.server.opzioni.get("registra_corpi"):
+                self.server.corpi_chat.append(dati)
+            # I token delle date protette tornano indietro come farebbe il modello
+            prompt = " ".join(m.get("content") or "" for m in richiesta.get("messages", []))
+            accettata, limiti = self.server.consuma_limite(len(prompt) // 4 + (richiesta.get("max_tokens") or 0))
+            if not accettata:
+                corpo = json.dumps({"error": {"message": "rate limit", "type": "tokens"}}).encode()
+                self._rispondi(429, corpo, limiti)
+                return
+            cached = self.server.prefisso_in_cache(prompt) // 4
+            date = " ".join(re.findall(r"§§DATA\d+§§", prompt)) or "12/03/2025"
+            if (richiesta.get("response_format") or {}).get("type") == "json_object":
+                testo = json.dumps(self._sezioni_json(prompt, date), ensure_ascii=False)
+            else:
+                testo = testo.format(date=date)
+            corpo = {
+                "id": "chatcmpl-finto",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": richiesta.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": testo},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(testo) // 4,
+                          "total_tokens": (len(prompt) + len(testo)) // 4,
+                          "prompt_tokens_details": {"cached_tokens": cached}},
+            }
+            self._rispondi(200, json.dumps(corpo).encode("utf-8"), limiti)
+            return
+        elif ":generateContent" in self.path:
+            corpo = {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": "Email: mario.rossi@example.com\nOrari 8:30 - 12:30"}]},
+                    "finishReason": "STOP",
+                }],
+                "usageMetadata": {"promptTokenCount": 300, "candidatesTokenCount": 20, "totalTokenCount": 320},
+            }
+        else:
+            self._rispondi(404, b"{}")
+            return
+        self._rispondi(200, json.dumps(corpo).encode("utf-8"))
+
+    def _trascrizione_file(self, dati):
+        """Risposta Deepgram REST: un segmento per ogni secondo di audio ricevuto (WAV 16 bit mono)."""
+        secondi = max(0, len(dati) - 44) // (2 * 16000)
+        testo = " ".join(["Il paziente riferisce dolore al ginocchio."] * secondi)
+        return {"results": {"channels": [{"alternatives": [{"transcript": testo, "confidence": 0.99}]}]}}
+
+    def _sezioni_json(self, prompt, date):
+        """Risposta in modo JSON: le chiavi chieste dal prompt (solo quelle da rigenerare, se indicate)."""
+        rigenera = re.search(r"RIGENERA SOLO queste sezioni: ([\w, ]+)\.", prompt)
+        if rigenera:
+            chiavi = [c.strip() for c in rigenera.group(1).split(",")]
+        else:
+            chiavi = re.findall(r'^- "(\w+)":', prompt, flags=re.MULTILINE)
+        errori = self.server.opzioni.get("errori_sezione", 0)
+        return {
+            chiave: "" if random.random() < errori else
+            f"Il paziente e' stato visitato in data {date} e riferisce dolore su il lato destro."
+            for chiave in chiavi
+        }
+
+    def do_HEAD(self):
+        # Warm-up delle connessioni: risposta vuota, connessione lasciata aperta
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.conteggi["richieste"] += 1
+        radice = self.server.opzioni.get("radice")
+        nome = self.path.split("?")[0].lstrip("/")
+        if nome.startswith("redirect/"):
+            # Come raw.githubusercontent.com dopo un cambio di nome del repository
+            self.send_response(302)
+            self.send_header("Location", "/" + nome[len("redirect/"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        percorso = os.path.join(radice, nome) if radice else None
+        if not percorso or not os.path.isfile(percorso):
+            self._rispondi(404, b"", tipo="text/plain")
+            return
+        if self._errore_iniettato():
+            return
+        with open(percorso, "rb") as f:
+            corpo = f.read()
+        etag = '"%s"' % hashlib.sha256(corpo).hexdigest()[:32]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        headers = {"ETag": etag}
+        if self.server.opzioni.get("gzip") and "gzip" in self.headers.get("Accept-Encoding", ""):
+            corpo = gzip.compress(corpo)
+            headers["Content-Encoding"] = "gzip"
+        self._rispondi(200, corpo, headers, tipo="text/plain")
+
+
+class _ServerHTTPFinto(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    BLOCCO_CACHE = 512   # caratteri (~128 token): la cache del provider lavora a blocchi
+
+    def __init__(self, opzioni):
+        super().__init__(("127.0.0.1", 0), _GestoreHTTP)
+        self.opzioni = opzioni
+        self.conteggi = {"richieste": 0, "errori": 0, "errori_429": 0}
+        self._prompt_visti = []
+        self._lock_cache = threading.Lock()
+        self.corpi_chat = []     # corpi delle chat completions ricevute, con opzioni["registra_corpi"]
+        # Limiti alla Groq: limite_richieste / limite_token per finestra (secondi), ricaricati con continuita'
+        self._limite = {"richieste": opzioni.get("limite_richieste"), "token": opzioni.get("limite_token")}
+        self._disponibili = dict(self._limite)
+        self._limite_t = time.monotonic()
+        self._lock_limite = threading.Lock()
+
+    def consuma_limite(self, token):
+        """Ritorna (accettata, header x-ratelimit-*); se rifiutata gli header includono retry-after."""
+        if not any(self._limite.values()):
+            return True, {}
+        finestra = self.opzioni.get("finestra", 60)
+        with self._lock_limite:
+            adesso = time.monotonic()
+            trascorso, self._limite_t = adesso - self._limite_t, adesso
+            for nome, limite in self._limite.items():
+                if limite:
+                    self._disponibili[nome] = min(limite, self._disponibili[nome] + trascorso * limite / finestra)
+            necessari = {"richieste": 1, "token": token}
+            attesa = max((necessari[n] - self._disponibili[n]) * finestra / l
+                         for n, l in self._limite.items() if l)
+            accettata = attesa <= 0
+            if accettata:
+                for nome, limite in self._limite.items():
+                    if limite:
+                        self._disponibili[nome] -= necessari[nome]
+            else:
+                self.conteggi["errori_429"] += 1
+            headers = {}
+            for nome, chiave in (("richieste", "requests"), ("token", "tokens")):
+                limite = self._limite[nome]
+                if limite:
+                    rimasti = max(0, int(self._disponibili[nome]))
+                    headers[f"x-ratelimit-limit-{chiave}"] = str(limite)
+                    headers[f"x-ratelimit-remaining-{chiave}"] = str(rimasti)
+                    headers[f"x-ratelimit-reset-{chiave}"] = f"{(limite - rimasti) * finestra / limite:.2f}s"
+            if not accettata:
+                headers["retry-after"] = str(max(1, round(attesa)))
+        return accettata, headers
+
+    def prefisso_in_cache(self, prompt):
+        """Caratteri iniziali gia' visti in un prompt precedente (simula il prefix caching)."""
+        with self._lock_cache:
+            migliore = 0
+            for visto in self._prompt_visti:
+                comune = len(os.path.commonprefix([visto, prompt]))
+                migliore = max(migliore, comune - comune % self.BLOCCO_CACHE)
+            self._prompt_visti = (self._prompt_visti + [prompt])[-32:]
+        return migliore
+
+
+def avvia_http_finto(opzioni=None):
+    """Avvia il server HTTP finto in un thread.
+
+    opzioni: latenza, throughput, errori, radice, gzip, registra_corpi,
+    limite_richieste/limite_token/finestra."""
+    server = _ServerHTTPFinto(opzioni or {})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _percentili(valori):
+    valori = sorted(valori)
+    if not valori:
+        return {"p50": None, "p95": None, "max": None}
+    return {
+        "p50": statistics.median(valori),
+        "p95": valori[min(len(valori) - 1, int(len(valori) * 0.95))],
+        "max": valori[-1],
+    }
+
+
+# =============================================================================
+# BENCHMARK: generazione relazione (Groq finto + post-processing)
+# =============================================================================
+
+TRASCRIZIONE_FINTA = (
+    "Paziente riferisce dolore al 36 dal 6/2, assume amoxicillina x 3 per 5 gg. "
+    "Visto il 18/2/2025, RX endorale, proposta terapia canalare e controllo il 9/3. "
+) * 20
+
+
+def _template_finto(sezioni=False):
+    template = types.ModuleType("template_benchmark")
+    template.NOME = "Benchmark"
+    template.AI_SYSTEM_MESSAGE = "Sei un medico che scrive relazioni cliniche in italiano. " * 40
+    template.RELAZIONE_TEMPLATE = ("Scrivi una relazione clinica formale.\n" * 30
+                                   + "DATI PAZIENTE:\n{dati_paziente}\nTRASCRIZIONE:\n{trascrizione}\n")
+    template.CORREZIONI_FARMACI = ["Amoxicillina", "Ibuprofene", "Augmentin"]
+    if sezioni:
+        template.SEZIONI_RELAZIONE = [
+            {"nome": "anamnesi", "titolo": "Anamnesi", "istruzioni": "motivo della visita e storia", "max_caratteri": 1500},
+            {"nome": "esame", "titolo": "Esame obiettivo", "istruzioni": "reperti della visita", "max_caratteri": 1500},
+            {"nome": "terapia", "titolo": "Terapia", "istruzioni": "farmaci e trattamenti proposti", "max_caratteri": 1000},
+            {"nome": "note", "istruzioni": "indicazioni aggiuntive", "obbligatoria": False},
+        ]
+        template.LAYOUT_RELAZIONE = ("Gentile Collega,\nho visitato in data {data} {titolo_paziente} {nome_paziente}.\n\n"
+                                     "{anamnesi}\n\n{esame}\n\n{terapia}\n\n{note}\n\nCordiali saluti\n{medico}")
+    return template
+
+
+def bench_generazione(opzioni, iterazioni=20):
+    """Latenza di genera_relazione e pulisci_appunti, incluso il post-processing locale."""
+    server, url = avvia_http_finto(opzioni)
+    os.environ["GROQ_BASE_URL"] = url
+    try:
+        import ai_module
+        import ai_generator
+    except ImportError as e:
+        server.shutdown()
+        return {"skipped": f"ai_generator non importabile: {e}"}
+
+    generatore = ai_generator.AIGenerator("chiave-finta")
+    generatore.template = _template_finto()
+    strutturato = ai_generator.AIGenerator("chiave-finta")
+    strutturato.template = _template_finto(sezioni=True)
+
+    relazione_ms, json_ms, pulizia_ms, post_ms = [], [], [], []
+    errori = 0
+    for i in range(iterazioni):
+        # Ogni visita ha dati diversi: solo il prefisso fisso puo' finire in cache
+        paziente = {"nome": f"Paziente {i}", "titolo": "Sig.ra" if i % 2 else "Sig."}
+        t0 = time.perf_counter()
+        relazione = generatore.genera_relazione(f"Visita {i}. " + TRASCRIZIONE_FINTA, paziente)
+        relazione_ms.append((time.perf_counter() - t0) * 1000)
+        errori += relazione.startswith("ERRORE")
+
+        t0 = time.perf_counter()
+        relazione = strutturato.genera_relazione(f"Visita {i}. " + TRASCRIZIONE_FINTA, paziente, {"nome": "Dr. Bianchi"})
+        json_ms.append((time.perf_counter() - t0) * 1000)
+        errori += relazione.startswith("ERRORE") or "Cordiali saluti" not in relazione
+
+        t0 = time.perf_counter()
+        try:
+            generatore.pulisci_appunti(TRASCRIZIONE_FINTA)
+        except Exception:
+            errori += 1
+        pulizia_ms.append((time.perf_counter() - t0) * 1000)
+
+        # Solo la parte locale, per separarla dalla rete
+        testo = RELAZIONE_FINTA.format(date="12/03/2025") * opzioni.get("ripeti", 4)
+        t0 = time.perf_counter()
+        generatore._pulisci_relazione(testo)
+        post_ms.append((time.perf_counter() - t0) * 1000)
+
+    server.shutdown()
+    uso_prosa, uso_json = generatore.get_uso_token(), strutturato.get_uso_token()
+    connessioni = ai_module.get_statistiche_connessioni()
+    # Con le sezioni: richieste per relazione (>1 = sezioni richieste di nuovo)
+    return {
+        "genera_relazione_ms": _percentili(relazione_ms),
+        "genera_relazione_json_ms": _percentili(json_ms),
+        "json_requests_per_report": uso_json["richieste"] / max(1, iterazioni),
+        "pulisci_appunti_ms": _percentili(pulizia_ms),
+        "post_processing_ms": _percentili(post_ms),
+        "errors": errori,
+        "requests": server.conteggi["richieste"],
+        "cache_ratio": uso_prosa["cache_ratio"],
+        "connection_reuse": connessioni["riuso"],
+        "new_connections": connessioni["connessioni_nuove"],
+    }
+
+
+VISITE_PREFISSO = [
+    ({"nome": "Mario Rossi", "titolo": "Sig."}, "Visto il 18/2/2025, dolore al 36 dal 6/2. "),
+    ({"nome": "Anna Bianchi", "titolo": "Sig.ra"}, "Controllo del 3/11/2024, dolore dal 28/10. "),
+]
+
+
+def _fine_nel_corpo(corpo, testo):
+    """Byte del corpo JSON fino alla fine di testo (cercato per la sua coda, come la serializza l'SDK)."""
+    coda = testo[-80:]
+    for ascii_ in (False, True):
+        cercato = json.dumps(coda, ensure_ascii=ascii_)[1:-1].encode("utf-8")
+        posizione = corpo.find(cercato)
+        if posizione >= 0:
+            return posizione + len(cercato)
+    return None
+
+
+def verifica_prefisso_prompt():
+    """Controlla sulle richieste inviate davvero (server finto) che il prefisso del prompt
+    sia identico byte per byte tra due visite con pazienti e date diversi."""
+    server, url = avvia_http_finto({"registra_corpi": True})
+    os.environ["GROQ_BASE_URL"] = url
+    try:
+        import ai_generator
+    except ImportError as e:
+        server.shutdown()
+        return {"skipped": f"ai_generator non importabile: {e}"}
+
+    risultato = {"visits": len(VISITE_PREFISSO)}
+    problemi = []
+    try:
+        for modo, sezioni in (("prose", False), ("json", True)):
+            generatore = ai_generator.AIGenerator("chiave-finta")
+            generatore.template = _template_finto(sezioni)
+            _, istruzioni = generatore._istruzioni_relazione()
+            corpi = []
+            for paziente, inizio in VISITE_PREFISSO:
+                server.corpi_chat.clear()
+                relazione = generatore.genera_relazione(inizio + TRASCRIZIONE_FINTA, paziente, {"nome": "Dr. Verdi"})
+                if relazione.startswith("ERRORE") or not server.corpi_chat:
+                    problemi.append(f"{modo}, {paziente['nome']}: relazione non generata")
+                    continue
+                # La prima richiesta della visita (le successive sono nuovi tentativi delle sezioni)
+                corpi.append(server.corpi_chat[0])
+            if len(corpi) != len(VISITE_PREFISSO):
+                continue
+
+            fine = [_fine_nel_corpo(corpo, istruzioni) for corpo in corpi]
+            comune = len(os.path.commonprefix(corpi))
+            risultato[modo] = {"prefix_bytes": fine[0], "common_bytes": comune}
+            if None in fine:
+                problemi.append(f"{modo}: istruzioni del template non trovate nella richiesta")
+            elif len(set(fine)) > 1 or comune < fine[0]:
+                problemi.append(f"{modo}: prefisso diverso tra le visite dal byte {comune} "
+                                f"(atteso uguale fino al byte {fine[0]})")
+            for corpo, (paziente, _) in zip(corpi, VISITE_PREFISSO):
+                if paziente["nome"].encode("utf-8") in corpo[:comune]:
+                    problemi.append(f"{modo}: dati di {paziente['nome']} dentro il prefisso comune")
+    finally:
+        server.shutdown()
+
+    risultato.update(ok=not problemi, problems=problemi)
+    return risultato
+
+
+def _processo_ratelimit(url, cartella, condiviso, priorita, richieste, coda):
+    """Un processo (app o batch) che chiama Groq con la stessa chiave degli altri."""
+    os.environ["GROQ_BASE_URL"] = url
+    with contextlib.redirect_stdout(sys.stderr):
+        import ai_module
+        import ai_generator
+        ai_module.RATE_LIMIT_CONDIVISO = condiviso
+        if ai_module.rate_limiter is not None:
+            ai_module.rate_limiter.BASE_DIR = cartella
+        generatore = ai_generator.AIGenerator("chiave-finta", priorita=priorita)
+        tempi, errori = [], 0
+        for _ in range(richieste):
+            t0 = time.perf_counter()
+            try:
+                generatore.pulisci_appunti(TRASCRIZIONE_FINTA)
+            except Exception:
+                errori += 1
+            tempi.append((time.perf_counter() - t0) * 1000)
+    coda.put((priorita, tempi, errori))
+
+
+def bench_ratelimit(opzioni, processi_batch=2, richieste=6):
+    """Piu' processi sulla stessa chiave con limiti alla Groq: 429 e latenza interattiva, con e senza coda condivisa."""
+    risultato = {}
+    for modo, condiviso in (("shared", True), ("independent", False)):
+        server, url = avvia_http_finto(dict(opzioni, limite_richieste=20, limite_token=20000, finestra=2))
+        cartella = tempfile.mkdtemp(prefix="docai_ratelimit_")
+        contesto = multiprocessing.get_context("spawn")
+        coda = contesto.Queue()
+        priorita = ["interattiva"] + ["batch"] * processi_batch
+        processi = [contesto.Process(target=_processo_ratelimit,
+                                     args=(url, cartella, condiviso, p, richieste, coda), daemon=True)
+                    for p in priorita]
+        t0 = time.perf_counter()
+        for processo in processi:
+            processo.start()
+        esiti = [coda.get(timeout=300) for _ in processi]
+        for processo in processi:
+            processo.join()
+        durata = time.perf_counter() - t0
+        server.shutdown()
+        shutil.rmtree(cartella, ignore_errors=True)
+
+        interattiva = [t for p, tempi, _ in esiti if p == "interattiva" for t in tempi]
+        batch = [t for p, tempi, _ in esiti if p == "batch" for t in tempi]
+        risultato[modo] = {
+            "server_429": server.conteggi["errori_429"],
+            "errors": sum(e for _, _, e in esiti),
+            "interactive_ms": _percentili(interattiva),
+            "batch_ms": _percentili(batch),
+            "total_s": round(durata, 2),
+        }
+    return risultato
+
+
+# =============================================================================
+# BENCHMARK: OCR (Gemini finto)
+# =============================================================================
+
+def bench_ocr(opzioni, iterazioni=20, concorrenza=4):
+    """Foto lette al secondo con piu' letture in parallelo."""
+    try:
+        import ai_module
+        from PIL import Image
+    except ImportError as e:
+        return {"skipped": f"dipendenze OCR mancanti: {e}"}
+    if ai_module.GEMINI_VERSION != "new":
+        return {"skipped": "serve google-genai (la libreria vecchia non accetta un base_url)"}
+
+    server, url = avvia_http_finto(opzioni)
+    cartella = tempfile.mkdtemp(prefix="bench_ocr_")
+    foto = os.path.join(cartella, "appunto.png")
+    Image.new("RGB", (1200, 1600), "white").save(foto)
+
+    ocr = ai_module.GeminiOCR("chiave-finta")
+    ocr.client = ai_module.client_gemini("chiave-finta", base_url=url)
+    connessioni_prima = ai_module.get_statistiche_connessioni()
+
+    durate = []
+    errori = [0]
+
+    def _leggi(_):
+        t0 = time.perf_counter()
+        try:
+            ocr.read_image(foto)
+        except Exception:
+            errori[0] += 1
+        durate.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrenza) as pool:
+        list(pool.map(_leggi, range(iterazioni)))
+    parete = time.perf_counter() - t0
+
+    server.shutdown()
+    shutil.rmtree(cartella, ignore_errors=True)
+    connessioni = ai_module.get_statistiche_connessioni()
+    return {
+        "images_per_s": iterazioni / parete,
+        "read_image_ms": _percentili(durate),
+        "concurrency": concorrenza,
+        "errors": errori[0],
+        "new_connections": connessioni["connessioni_nuove"] - connessioni_prima["connessioni_nuove"],
+    }
+
+
+# =============================================================================
+# BENCHMARK: invio audio (Transcriber su Deepgram finto)
+# =============================================================================
+
+class _RegistratoreFinto:
+    """Produce chunk float32 a velocita' reale, come il registratore dell'app."""
+
+    def __init__(self, sample_rate, durata):
+        import numpy as np
+        self.chunk = (np.random.default_rng(0).standard_normal(int(sample_rate * CHUNK_SECONDI)) * 0.1).astype(np.float32)
+        self.fine = time.perf_counter() + durata
+        self.prossimo = time.perf_counter()
+
+    def get_audio_chunk(self, timeout=0.5):
+        if time.perf_counter() > self.fine:
+            time.sleep(timeout)
+            return None
+        time.sleep(max(0.0, self.prossimo - time.perf_counter()))
+        self.prossimo += CHUNK_SECONDI
+        return self.chunk
+
+
+def bench_audio(opzioni, durata=10):
+    """CPU del processo e ritardo della coda audio durante una registrazione."""
+    try:
+        import transcriber
+    except ImportError as e:
+        return {"skipped": f"transcriber non importabile: {e}"}
+
+    processo, porta = avvia_deepgram_finto_processo(opzioni)
+    transcriber.DEEPGRAM_URL = f"ws://127.0.0.1:{porta}/v1/listen"
+    # Con l'archivio attivo: la scrittura su disco non deve pesare sull'invio
+    transcriber.CARTELLA_ARCHIVIO = tempfile.mkdtemp(prefix="bench_archivio_")
+    t = transcriber.Transcriber("chiave-finta", archivia=True)
+    registratore = _RegistratoreFinto(transcriber.SAMPLE_RATE, durata)
+
+    campioni = []
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    t.start_realtime_transcription(registratore)
+    while time.perf_counter() - t0 < durata:
+        # Ogni chunk in coda e' audio non ancora inviato
+        campioni.append(t.audio_queue.qsize() * CHUNK_SECONDI * 1000)
+        time.sleep(0.05)
+    cpu = (time.process_time() - cpu0) / (time.perf_counter() - t0)
+    archivio = t.archivio
+    t.stop_transcription()
+    processo.terminate()
+    archivio.chiudi(timeout=10)
+
+    # L'archivio si rilegge con la trascrizione da file (Deepgram REST finto)
+    import wave
+    with wave.open(archivio.percorso, "rb") as wav:
+        secondi_archiviati = wav.getnframes() / wav.getframerate()
+    server, url = avvia_http_finto(opzioni)
+    transcriber.DEEPGRAM_URL_FILE = f"{url}/v1/listen"
+    t1 = time.perf_counter()
+    try:
+        testo_file = transcriber.trascrivi_file("chiave-finta", archivio.percorso)
+    except Exception:
+        testo_file = ""
+    file_ms = (time.perf_counter() - t1) * 1000
+    server.shutdown()
+    shutil.rmtree(transcriber.CARTELLA_ARCHIVIO, ignore_errors=True)
+
+    return {
+        "cpu_fraction": cpu,
+        "queue_lag_ms": _percentili(campioni),
+        "first_byte_ms": t.first_byte_ms,
+        "finals": len(t.full_transcription),
+        "archive_seconds": round(secondi_archiviati, 2),
+        "archive_dropped": archivio.metrics["chunks_dropped"],
+        "archive_writes": archivio.metrics["writes"],
+        "file_transcription_ms": file_ms,
+        "file_transcription_ok": bool(testo_file),
+    }
+
+
+# =============================================================================
+# BENCHMARK: aggiornamento (GitHub raw finto)
+# =============================================================================
+
+def bench_update(opzioni):
+    """Tempo di controllo + download di tutti i file, poi di un controllo senza novita' (304)."""
+    import update_from_github as updater
+
+    remoto = tempfile.mkdtemp(prefix="bench_remoto_")
+    locale = tempfile.mkdtemp(prefix="bench_locale_")
+    for nome in list(updater.FILE_AGGIORNABILI.values()) + ["versions.txt", updater.MANIFEST_FILE]:
+        if os.path.exists(os.path.join(BASE_DIR, nome)):
+            shutil.copy(os.path.join(BASE_DIR, nome), remoto)
+    for nome in updater.FILE_AGGIORNABILI.values():
+        with open(os.path.join(locale, nome), "w", encoding="utf-8") as f:
+            f.write('__version__ = "0.1"\n')
+
+    server, url = avvia_http_finto(dict(opzioni, radice=remoto))
+    originali = (updater.GITHUB_BASE_URL, updater.BASE_DIR, updater.STATE_FILE)
+    updater.GITHUB_BASE_URL = url + "/"
+    updater.BASE_DIR = locale
+    updater.STATE_FILE = os.path.join(locale, "update_state.json")
+    try:
+        t0 = time.perf_counter()
+        risultato = updater.check_updates(forza=True)
+        controllo_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        successi, errori = updater.download_updates(risultato["updates"])
+        download_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        secondo = updater.check_updates(forza=True)
+        ricontrollo_ms = (time.perf_counter() - t0) * 1000
+    finally:
+        updater.GITHUB_BASE_URL, updater.BASE_DIR, updater.STATE_FILE = originali
+        server.shutdown()
+        shutil.rmtree(remoto, ignore_errors=True)
+        shutil.rmtree(locale, ignore_errors=True)
+
+    return {
+        "check_ms": controllo_ms,
+        "download_ms": download_ms,
+        "recheck_ms": ricontrollo_ms,
+        "files": len(successi),
+        "errors": len(errori) + (1 if risultato["error"] else 0) + len(secondo["updates"]),
+        "requests": server.conteggi["richieste"],
+    }
+
+
+def verifica_pool_http():
+    """Controlla _PoolConnessioni dell'updater: GET gzip, 304, redirect, download a blocchi, keep-alive."""
+    import update_from_github as updater
+
+    radice = tempfile.mkdtemp(prefix="bench_pool_")
+    contenuto = ("# modulo di prova\n" * 4000).encode("utf-8")
+    with open(os.path.join(radice, "modulo.py"), "wb") as f:
+        f.write(contenuto)
+    server, url = avvia_http_finto({"radice": radice, "gzip": True})
+    pool = updater._PoolConnessioni()
+    problemi = []
+    try:
+        status, headers, corpo = pool.get(url + "/modulo.py")
+        if status != 200 or corpo != contenuto:
+            problemi.append(f"GET: status {status}, contenuto {'uguale' if corpo == contenuto else 'diverso'}")
+        if headers.get("Content-Encoding") != "gzip":
+            problemi.append("GET: risposta non compressa (Accept-Encoding: gzip non inviato?)")
+
+        status, _, corpo = pool.get(url + "/modulo.py", {"If-None-Match": headers.get("ETag", "")})
+        if status != 304 or corpo:
+            problemi.append(f"GET condizionale: status {status} invece di 304")
+
+        status, _, corpo = pool.get(url + "/redirect/modulo.py")
+        if status != 200 or corpo != contenuto:
+            problemi.append(f"redirect: status {status}, contenuto {'uguale' if corpo == contenuto else 'diverso'}")
+
+        blocchi = []
+        status, _, corpo = pool.get(url + "/modulo.py", destinazione=blocchi.append)
+        if status != 200 or corpo is not None or b"".join(blocchi) != contenuto:
+            problemi.append("download a blocchi: contenuto diverso")
+    except Exception as e:
+        problemi.append(f"{type(e).__name__}: {e}")
+    finally:
+        pool.chiudi()
+        server.shutdown()
+        shutil.rmtree(radice, ignore_errors=True)
+
+    # Tutte le richieste (redirect compreso) sulla stessa connessione keep-alive
+    if pool.stats["nuove"] != 1:
+        problemi.append(f"keep-alive: {pool.stats['nuove']} connessioni per {pool.stats['richieste']} richieste")
+    return {
+        "requests": pool.stats["richieste"],
+        "new_connections": pool.stats["nuove"],
+        "reused_connections": pool.stats["riusate"],
+        "ok": not problemi,
+        "problems": problemi,
+    }
+
+
+# =============================================================================
+# BENCHMARK: TranscriptionManager (quante sessioni regge un core)
+# =============================================================================
+
+def _misura_sessioni(transcriber, n_sessioni, durata):
+    manager = transcriber.TranscriptionManager("chiave-finta")
+    chunk = b"\x00\x00" * int(transcriber.SAMPLE_RATE * CHUNK_SECONDI)
+    ids = [manager.start_session() for _ in range(n_sessioni)]
+
+    # Un solo thread alimenta tutte le sessioni a velocita' reale
+    t0 = time.perf_counter()
+    cpu0 = manager.get_metrics()["loop_cpu_s"]
+    prossimo = t0
+    while time.perf_counter() - t0 < durata:
+        for sid in ids:
+            manager.feed(sid, chunk)
+        prossimo += CHUNK_SECONDI
+        time.sleep(max(0.0, prossimo - time.perf_counter()))
+    metriche = manager.get_metrics()
+    parete = time.perf_counter() - t0
+    manager.shutdown()
+
+    sessioni = metriche["sessions"].values()
+    return {
+        "sessions": n_sessioni,
+        "loop_cpu": (metriche["loop_cpu_s"] - cpu0) / parete,
+        "send_lag_ms_avg": sum(s["send_lag_ms_avg"] for s in sessioni) / n_sessioni,
+        "send_lag_ms_max": max(s["send_lag_ms_max"] for s in sessioni),
+        "chunks_dropped": sum(s["chunks_dropped"] for s in sessioni),
+        "errors": sum(1 for s in sessioni if s["errore"]),
+        "connect_ms_max": max((s["connect_ms"] or 0) for s in sessioni),
+    }
+
+
+def bench_manager(max_sessioni=200, passo=20, durata=10, cpu_max=0.8, lag_max_ms=500):
+    """Aumenta le sessioni finche' il loop di I/O non supera la CPU o la latenza ammesse."""
+    import transcriber
+
+    processo, porta = avvia_deepgram_finto_processo()
+    transcriber.DEEPGRAM_URL = f"ws://127.0.0.1:{porta}/v1/listen"
+    risultati = []
+    sostenute = 0
+    try:
+        for n in range(passo, max_sessioni + 1, passo):
+            r = _misura_sessioni(transcriber, n, durata)
+            # Il lag massimo include l'attesa della connessione: si valuta il lag medio
+            r["ok"] = (r["loop_cpu"] < cpu_max and r["send_lag_ms_avg"] < lag_max_ms
+                       and r["chunks_dropped"] == 0 and r["errors"] == 0)
+            risultati.append(r)
+            print(f"  {n:4d} sessioni: cpu loop {r['loop_cpu'] * 100:5.1f}%  "
+                  f"lag medio {r['send_lag_ms_avg']:6.1f} ms  persi {r['chunks_dropped']}  "
+                  f"errori {r['errors']}", file=sys.stderr)
+            if not r["ok"]:
+                break
+            sostenute = n
+    finally:
+        processo.terminate()
+    return {"max_sessions_one_core": sostenute, "steps": risultati}
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def _versioni_moduli():
+    import update_from_github as updater
+    try:
+        return updater.get_local_versions()
+    except Exception as e:
+        return {"errore": str(e)}
+
+
+def _valore(risultato, percorso):
+    for chiave in percorso.split("."):
+        if not isinstance(risultato, dict) or chiave not in risultato:
+            return None
+        risultato = risultato[chiave]
+    return risultato if isinstance(risultato, (int, float)) else None
+
+
+def confronta_con_riferimento(risultato, riferimento, tolleranza=TOLLERANZA):
+    """Ritorna la lista delle metriche peggiorate oltre la tolleranza."""
+    regressioni = []
+    for percorso, alto_meglio in METRICHE_CONFRONTO:
+        attuale, prima = _valore(risultato, percorso), _valore(riferimento, percorso)
+        if attuale is None or not prima:
+            continue
+        variazione = (attuale - prima) / prima
+        if (-variazione if alto_meglio else variazione) > tolleranza:
+            regressioni.append({"metric": percorso, "baseline": prima, "current": attuale,
+                                "change": round(variazione, 3)})
+    return regressioni
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DOCai con servizi finti in locale")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    comuni = argparse.ArgumentParser(add_help=False)
+    comuni.add_argument("--latency", type=float, default=0.0, help="secondi di attesa per risposta")
+    comuni.add_argument("--throughput", type=float, default=0, help="byte/s delle risposte (0 = illimitato)")
+    comuni.add_argument("--error-rate", type=float, default=0.0, help="frazione di richieste in errore")
+    comuni.add_argument("--section-error-rate", type=float, default=0.0,
+                        help="frazione di sezioni JSON restituite vuote (prova i nuovi tentativi)")
+    comuni.add_argument("--iterations", type=int, default=20)
+    comuni.add_argument("--duration", type=float, default=10, help="secondi di audio simulato")
+    comuni.add_argument("--output", help="salva il risultato JSON su file")
+    comuni.add_argument("--baseline", help="JSON di un'esecuzione precedente da confrontare")
+    comuni.add_argument("--tolerance", type=float, default=TOLLERANZA)
+
+    for nome, aiuto in (("generazione", "latenza relazione e pulizia appunti"),
+                        ("prompt", "prefisso del prompt identico tra le visite"),
+                        ("ratelimit", "429 e attese con piu' processi sulla stessa chiave"),
+                        ("ocr", "foto lette al secondo"),
+                        ("audio", "CPU e ritardo dell'invio audio"),
+                        ("update", "controllo e download aggiornamenti"),
+                        ("pool", "connessioni HTTP dell'updater: 304, redirect, gzip, keep-alive"),
+                        ("all", "tutti i benchmark tranne manager")):
+        sub.add_parser(nome, help=aiuto, parents=[comuni])
+
+    p_manager = sub.add_parser("manager", help="carico del TranscriptionManager", parents=[comuni])
+    p_manager.add_argument("--max-sessions", type=int, default=200)
+    p_manager.add_argument("--step", type=int, default=20)
+
+    args = parser.parse_args(argv)
+    opzioni = {"latenza": args.latency, "throughput": args.throughput, "errori": args.error_rate,
+               "errori_sezione": args.section_error_rate}
+
+    benchmark = {
+        "generazione": lambda: bench_generazione(opzioni, args.iterations),
+        "prompt": lambda: verifica_prefisso_prompt(),
+        "ratelimit": lambda: bench_ratelimit(opzioni),
+        "ocr": lambda: bench_ocr(opzioni, args.iterations),
+        "audio": lambda: bench_audio(opzioni, args.duration),
+        "update": lambda: bench_update(opzioni),
+        "pool": lambda: verifica_pool_http(),
+        "manager": lambda: bench_manager(args.max_sessions, args.step, args.duration),
+    }
+    if args.comando == "all":
+        da_eseguire = ["prompt", "pool", "generazione", "ratelimit", "ocr", "audio", "update"]
+    else:
+        da_eseguire = [args.comando]
+
+    risultato = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "versions": _versioni_moduli(),
+        "options": opzioni,
+    }
+    for nome in da_eseguire:
+        print(f"[benchmark] {nome}...", file=sys.stderr)
+        try:
+            # I moduli stampano i loro messaggi: stdout resta al solo JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                risultato[nome] = benchmark[nome]()
+        except Exception as e:
+            risultato[nome] = {"error": f"{type(e).__name__}: {e}"}
+
+    codice = 0
+    if risultato.get("prompt", {}).get("ok") is False:
+        codice = 1
+        print(f"[benchmark] PREFISSO PROMPT NON STABILE: {risultato['prompt']['problems']}", file=sys.stderr)
+    if risultato.get("pool", {}).get("ok") is False:
+        codice = 1
+        print(f"[benchmark] POOL HTTP DELL'UPDATER: {risultato['pool']['problems']}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            riferimento = json.load(f)
+        risultato["regressions"] = confronta_con_riferimento(risultato, riferimento, args.tolerance)
+        if risultato["regressions"]:
+            codice = 1
+            for r in risultato["regressions"]:
+                print(f"[benchmark] REGRESSIONE {r['metric']}: {r['baseline']} -> {r['current']} "
+                      f"({r['change'] * 100:+.0f}%)", file=sys.stderr)
+
+    testo = json.dumps(risultato, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(testo)
+    print(testo)
+    return codice
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+﻿__version__ = "1.0"
+# rate_limiter.py - Coda condivisa delle richieste AI rispetto ai limiti del provider
+# CODICE UNIVERSALE - Aggiornabile da GitHub
+# Piu' processi sulla stessa macchina (app, batch_relazioni, ...) con la stessa
+# chiave condividono un file di stato protetto da lock: bucket di richieste e
+# token stimati, aggiornati dagli header x-ratelimit-* del provider, e una coda
+# con priorita' (le relazioni interattive passano prima del lavoro batch).
+# Tra postazioni diverse il coordinamento avviene tramite gli header stessi:
+# ognuna vede quanto resta davvero sulla chiave.
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+    import msvcrt
+
+# =============================================================================
+# CONFIGURAZIONE
+# =============================================================================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PRIORITA = {
+    "interattiva": 0,
+    "batch": 10,
+}
+
+ATTESA_MAX = {                  # secondi in coda prima di rinunciare (None = senza limite)
+    "interattiva": 60,
+    "batch": None,
+}
+POLLING_MIN = 0.02              # secondi tra due controlli della coda
+POLLING_MAX = 0.25
+HEARTBEAT_SCADUTO = 10          # un posto in coda non aggiornato da tanto e' di un processo morto
+TOKEN_PER_CARATTERE = 0.25      # stima prudente per l'italiano (~4 caratteri per token)
+RITMO_TOKEN_DEFAULT = 1 / 60    # se manca il reset: capacita' ricaricata in un minuto (TPM)
+RITMO_RICHIESTE_DEFAULT = 1 / 86400   # richieste al giorno (RPD)
+
+
+class AttesaScaduta(Exception):
+    """La richiesta e' rimasta in coda oltre il tempo massimo."""
+
+
+def stima_token(messages, max_tokens):
+    """Token che la richiesta puo' consumare: prompt stimato dai caratteri + massimo della risposta."""
+    caratteri = sum(len(m.get("content") or "") for m in messages)
+    return int(caratteri * TOKEN_PER_CARATTERE) + (max_tokens or 0)
+
+
+def _durata_in_secondi(valore):
+    """Converte '7.66s', '2m59.56s', '1h2m3s', '250ms' o '12' in secondi."""
+    if valore is None:
+        return None
+    valore = str(valore).strip()
+    try:
+        return float(valore)
+    except ValueError:
+        pass
+    totale = 0.0
+    trovato = False
+    for numero, unita in re.findall(r"([\d.]+)(ms|h|m|s)", valore):
+        trovato = True
+        totale += float(numero) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unita]
+    return totale if trovato else None
+
+
+# =============================================================================
+# LOCK SU FILE (tra processi)
+# =============================================================================
+
+class _LockFile:
+    """Lock esclusivo su un file: flock su Linux/macOS, msvcrt.locking su Windows."""
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._fd = os.open(self.percorso, os.O_RDWR | os.O_CREAT, 0o644)
+            if HAS_FCNTL:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                while True:
+                    try:
+                        msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue    # LK_LOCK rinuncia dopo ~10 s: si riprova
+        except BaseException:
+            self._rilascia()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self._rilascia()
+        return False
+
+    def _rilascia(self):
+        try:
+            if self._fd is not None:
+                if HAS_FCNTL:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+                os.close(self._fd)
+        except OSError:
+            pass
+        finally:
+            self._fd = None
+            self._thread_lock.release()
+
+
+# =============================================================================
+# RATE LIMITER
+# =============================================================================
+
+def _ricarica(bucket, adesso):
+    if bucket.get("capacita") is None:
+        return
+    trascorso = max(0.0, adesso - bucket["t"])
+    bucket["disponibili"] = min(bucket["capacita"], bucket["disponibili"] + trascorso * bucket["ritmo"])
+    bucket["t"] = adesso
+
+
+def _attesa_bucket(bucket, necessari):
+    """Secondi da attendere perche' il bucket abbia 'necessari' unita' (0 = subito)."""
+    if bucket.get("capacita") is None:
+        return 0.0
+    # Una richiesta piu' grande della capacita' passa a bucket pieno
+    necessari = min(necessari, bucket["capacita"])
+    mancano = necessari - bucket["disponibili"]
+    if mancano <= 0:
+        return 0.0
+    return mancano / bucket["ritmo"] if bucket["ritmo"] > 0 else POLLING_MAX
+
+
+class RateLimiter:
+    """Bucket di richieste e token condivisi (file di stato + lock) con coda a priorita'."""
+
+    def __init__(self, nome, cartella=None):
+        cartella = cartella or BASE_DIR
+        self.percorso = os.path.join(cartella, f"ratelimit_{nome}.json")
+        self._lock = _LockFile(self.percorso + ".lock")
+        self.statistiche = {"richieste": 0, "attese": 0, "attesa_totale_s": 0.0, "errori_429": 0}
+
+    # --- stato su file ---
+
+    def _leggi(self):
+        try:
+            with open(self.percorso, "r", encoding="utf-8") as f:
+                stato = json.load(f)
+        except (OSError, ValueError):
+            stato = {}
+        stato.setdefault("richieste", {"capacita": None})
+        stato.setdefault("token", {"capacita": None})
+        stato.setdefault("coda", {})
+        stato.setdefault("bloccato_fino", 0.0)
+        stato.setdefault("sequenza", 0)
+        return stato
+
+    def _scrivi(self, stato):
+        tmp = f"{self.percorso}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(stato, f)
+            os.replace(tmp, self.percorso)
+        except OSError as e:
+            print(f"Warning: stato rate limit non salvato: {e}")
+
+    # --- API ---
+
+    def acquisisci(self, token_stimati, priorita="interattiva", timeout="default"):
+        """Attende il proprio turno e prenota 1 richiesta + token_stimati. Ritorna i secondi attesi."""
+        if timeout == "default":
+            timeout = ATTESA_MAX.get(priorita)
+        livello = PRIORITA.get(priorita, PRIORITA["batch"])
+        posto = uuid.uuid4().hex
+        t0 = time.time()
+        in_coda = False
+        try:
+            while True:
+                with self._lock:
+                    adesso = time.time()
+                    stato = self._leggi()
+                    coda = stato["coda"]
+                    if not in_coda:
+                        stato["sequenza"] += 1
+                        coda[posto] = {"p": livello, "n": stato["sequenza"], "pid": os.getpid()}
+                        in_coda = True
+                    coda[posto]["hb"] = adesso
+                    for chiave in [k for k, v in coda.items() if adesso - v.get("hb", 0) > HEARTBEAT_SCADUTO]:
+                        del coda[chiave]
+
+                    # Passa solo il primo della coda (priorita', poi ordine di arrivo)
+                    primo = min(coda, key=lambda k: (coda[k]["p"], coda[k]["n"]))
+                    _ricarica(stato["richieste"], adesso)
+                    _ricarica(stato["token"], adesso)
+                    attesa = max(stato["bloccato_fino"] - adesso,
+                                 _attesa_bucket(stato["richieste"], 1),
+                                 _attesa_bucket(stato["token"], token_stimati))
+                    if primo == posto and attesa <= 0:
+                        for nome, quanti in (("richieste", 1), ("token", token_stimati)):
+                            bucket = stato[nome]
+                            if bucket.get("capacita") is not None:
+                                bucket["disponibili"] -= min(quanti, bucket["capacita"])
+                        del coda[posto]
+                        in_coda = False
+                        self._scrivi(stato)
+                        break
+                    self._scrivi(stato)
+
+                if timeout is not None and time.time() - t0 > timeout:
+                    raise AttesaScaduta(f"limite di richieste del provider: in coda da oltre {timeout} s")
+                time.sleep(min(max(attesa, POLLING_MIN), POLLING_MAX))
+        finally:
+            if in_coda:
+                with self._lock:
+                    stato = self._leggi()
+                    stato["coda"].pop(posto, None)
+                    self._scrivi(stato)
+
+        attesa_totale = time.time() - t0
+        self.statistiche["richieste"] += 1
+        if attesa_totale > POLLING_MIN:
+            self.statistiche["attese"] += 1
+            self.statistiche["attesa_totale_s"] += attesa_totale
+        return attesa_totale
+
+    def aggiorna_da_headers(self, headers):
+        """Allinea i bucket a quanto riportato dal provider (x-ratelimit-*)."""
+        if headers is None:
+            return
+        letti = {}
+        for nome, default in (("requests", RITMO_RICHIESTE_DEFAULT), ("tokens", RITMO_TOKEN_DEFAULT)):
+            try:
+                limite = float(headers.get(f"x-ratelimit-limit-{nome}"))
+                rimasti = float(headers.get(f"x-ratelimit-remaining-{nome}"))
+            except (TypeError, ValueError):
+                continue
+            reset = _durata_in_secondi(headers.get(f"x-ratelimit-reset-{nome}"))
+            if reset and limite > rimasti:
+                ritmo = (limite - rimasti) / reset
+            else:
+                ritmo = limite * default
+            letti["richieste" if nome == "requests" else "token"] = (limite, rimasti, ritmo)
+        if not letti:
+            return
+        with self._lock:
+            adesso = time.time()
+            stato = self._leggi()
+            for nome, (limite, rimasti, ritmo) in letti.items():
+                stato[nome] = {"capacita": limite, "disponibili": rimasti, "ritmo": ritmo, "t": adesso}
+            self._scrivi(stato)
+
+    def segnala_429(self, retry_after=None):
+        """Il provider ha rifiutato per limite: tutti i processi aspettano retry-after."""
+        attesa = _durata_in_secondi(retry_after) or 1.0
+        self.statistiche["errori_429"] += 1
+        with self._lock:
+            stato = self._leggi()
+            stato["bloccato_fino"] = max(stato["bloccato_fino"], time.time() + attesa)
+            self._scrivi(stato)
+        return attesa
+
+    def get_statistiche(self):
+        stato = self._leggi()
+        return dict(self.statistiche,
+                    in_coda=len(stato["coda"]),
+                    token_disponibili=stato["token"].get("disponibili"),
+                    richieste_disponibili=stato["richieste"].get("disponibili"))
+
+
+_LIMITER = {}
+_LIMITER_LOCK = threading.Lock()
+
+
+def limiter_per_chiave(provider, api_key, cartella=None):
+    """Un RateLimiter per chiave API (nel nome del file solo un hash della chiave)."""
+    nome = f"{provider}_{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}"
+    with _LIMITER_LOCK:
+        if nome not in _LIMITER:
+            _LIMITER[nome] = RateLimiter(nome, cartella)
+        return _LIMITER[nome]
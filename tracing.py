@@ -0,0 +1,523 @@
+﻿__version__ = "1.1"
+# tracing.py - Tracce della pipeline (registrazione -> OCR -> pulizia -> relazione)
+# CODICE UNIVERSALE - Aggiornabile da GitHub
+# Nessuna dipendenza esterna. Spento di default: ogni span costa una chiamata a vuoto.
+#
+# Attivazione:
+#   - variabile d'ambiente DOCAI_TRACE=1 (oppure il percorso di una cartella)
+#   - oppure tracing.abilita(cartella=None, otlp_endpoint=None)
+# Ogni visita ha un trace ID: la apre la registrazione (Transcriber) se non e'
+# gia' aperta, la chiude genera_relazione. Piu' visite insieme (worker batch,
+# sessioni parallele) usano in_visita() o apri_visita() + usa_visita(), legate
+# al proprio contesto. Gli span finiscono in traces/trace_AAAAMMGG.jsonl
+# (una riga JSON per span) e, se configurato, vengono inviati in formato
+# OTLP/JSON a un collector OpenTelemetry (es. http://localhost:4318/v1/traces).
+#
+# Uso da riga di comando:
+#   python tracing.py riepilogo [file.jsonl] [--visita TRACE_ID]
+#   python tracing.py otlp file.jsonl uscita.json
+
+import os
+import sys
+import json
+import time
+import uuid
+import functools
+import threading
+import contextlib
+import contextvars
+from datetime import datetime
+from urllib import request
+
+# =============================================================================
+# CONFIGURAZIONE
+# =============================================================================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_TRACCE = os.path.join(BASE_DIR, "traces")
+
+NOME_SERVIZIO = "docai"
+OTLP_BATCH = 256          # span accumulati prima di un invio al collector
+OTLP_TIMEOUT = 5          # secondi
+
+_ABILITATO = False
+_cartella = CARTELLA_TRACCE
+_otlp_endpoint = None
+
+_lock = threading.Lock()
+_file = None
+_file_giorno = None
+_da_inviare = []
+
+# Visite aperte (trace ID -> span radice). Gli span senza genitore si agganciano
+# alla visita legata al proprio contesto (usa_visita); se non ce n'e' una, a
+# quella predefinita aperta da nuova_visita(), la visita dell'app interattiva
+# che vale anche per i thread senza contesto (es. quelli del Transcriber).
+_visite = {}
+_visita = contextvars.ContextVar("docai_visita", default=None)
+_visita_predefinita = None
+
+# Span corrente nel contesto (thread / task) che sta eseguendo
+_corrente = contextvars.ContextVar("docai_span_corrente", default=None)
+
+
+# =============================================================================
+# SPAN
+# =============================================================================
+
+class _SpanNullo:
+    """Span usato quando il tracciamento e' spento: ogni metodo non fa nulla."""
+
+    trace_id = None
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def imposta(self, **attributi):
+        pass
+
+    def termina(self, errore=None, **attributi):
+        pass
+
+
+NULLO = _SpanNullo()
+
+
+class Span:
+    """Un intervallo di tempo con nome, attributi e genitore."""
+
+    def __init__(self, nome, genitore=None, inizio=None, **attributi):
+        if isinstance(genitore, str):
+            genitore = _visite.get(genitore)
+        elif genitore is None:
+            genitore = _corrente.get() or _visita_attiva()
+        self.nome = nome
+        self.trace_id = genitore.trace_id if genitore else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = genitore.span_id if genitore else None
+        self.attributi = attributi
+        self.stato = "ok"
+        self.messaggio = None
+        self.thread = threading.current_thread().name
+
+        # Orologio di sistema per l'esportazione, perf_counter per la durata
+        self._t0 = time.perf_counter() if inizio is None else inizio
+        self.inizio_ns = time.time_ns() - int((time.perf_counter() - self._t0) * 1e9)
+        self.durata_ms = None
+        self._token = None
+        self.chiusura_rimandata = None   # solo radici: attributi di chiudi_visita() chiamata dentro uno span
+
+    def __enter__(self):
+        self._token = _corrente.set(self)
+        return self
+
+    def __exit__(self, tipo, valore, tb):
+        if self._token is not None:
+            _corrente.reset(self._token)
+            self._token = None
+        self.termina(errore=valore)
+        radice = _visite.get(self.trace_id)
+        if radice is not None and radice.chiusura_rimandata is not None:
+            corrente = _corrente.get()
+            if corrente is None or corrente.trace_id != self.trace_id:
+                _chiudi_visita_ora(radice, radice.chiusura_rimandata)
+        return False
+
+    def imposta(self, **attributi):
+        self.attributi.update(attributi)
+
+    def termina(self, errore=None, **attributi):
+        """Chiude lo span (una sola volta) e lo esporta."""
+        if self.durata_ms is not None:
+            return
+        self.durata_ms = (time.perf_counter() - self._t0) * 1000
+        self.attributi.update(attributi)
+        if errore is not None:
+            self.stato = "errore"
+            self.messaggio = f"{type(errore).__name__}: {errore}"
+        _esporta(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.nome,
+            "start_ns": self.inizio_ns,
+            "duration_ms": round(self.durata_ms, 3),
+            "status": self.stato,
+            "message": self.messaggio,
+            "thread": self.thread,
+            "attributes": self.attributi,
+        }
+
+
+# =============================================================================
+# API
+# =============================================================================
+
+def abilitato():
+    return _ABILITATO
+
+
+def abilita(cartella=None, otlp_endpoint=None):
+    """Attiva il tracciamento. cartella=None usa traces/ accanto ai moduli."""
+    global _ABILITATO, _cartella, _otlp_endpoint
+    with _lock:
+        _chiudi_file()
+        _cartella = cartella or CARTELLA_TRACCE
+        _otlp_endpoint = otlp_endpoint
+        _ABILITATO = True
+
+
+def disabilita():
+    global _ABILITATO
+    for visita in list(_visite.values()):
+        _chiudi_visita_ora(visita, {})
+    _invia_otlp()
+    with _lock:
+        _ABILITATO = False
+        _chiudi_file()
+
+
+def span(nome, genitore=None, **attributi):
+    """Span da usare con 'with': diventa il genitore degli span aperti dentro."""
+    if not _ABILITATO:
+        return NULLO
+    return Span(nome, genitore, **attributi)
+
+
+def apri_span(nome, genitore=None, inizio=None, **attributi):
+    """Span aperto a mano (es. tra start e stop della registrazione): chiuderlo con termina()."""
+    if not _ABILITATO:
+        return NULLO
+    return Span(nome, genitore, inizio, **attributi)
+
+
+def evento(nome, genitore=None, inizio=None, errore=None, **attributi):
+    """Span gia' concluso: istantaneo, oppure da 'inizio' (valore di time.perf_counter()) a adesso."""
+    if not _ABILITATO:
+        return
+    Span(nome, genitore, inizio, **attributi).termina(errore=errore)
+
+
+def traccia(nome=None, **attributi):
+    """Decoratore: la funzione gira dentro uno span (di default col suo nome)."""
+    def decoratore(funzione):
+        nome_span = nome or funzione.__name__
+
+        @functools.wraps(funzione)
+        def wrapper(*args, **kwargs):
+            if not _ABILITATO:
+                return funzione(*args, **kwargs)
+            with Span(nome_span, **attributi):
+                return funzione(*args, **kwargs)
+        return wrapper
+    return decoratore
+
+
+def imposta(**attributi):
+    """Aggiunge attributi allo span corrente."""
+    if not _ABILITATO:
+        return
+    corrente = _corrente.get()
+    if corrente is not None:
+        corrente.imposta(**attributi)
+
+
+def _visita_attiva():
+    """Visita legata al contesto corrente, altrimenti quella predefinita (None se chiusa)."""
+    visita = _visita.get() or _visita_predefinita
+    return visita if visita is not None and visita.trace_id in _visite else None
+
+
+def apri_visita(etichetta=None):
+    """Apre una visita senza legarla al contesto (es. una sessione di TranscriptionManager).
+
+    Ritorna il trace ID (None se spento): usa_visita() la lega al thread che ci lavora.
+    """
+    if not _ABILITATO:
+        return None
+    attributi = {"etichetta": etichetta} if etichetta else {}
+    # La radice non ha genitore anche se chiamata dentro un altro span
+    radice = Span("visita", **attributi)
+    radice.trace_id, radice.parent_id = uuid.uuid4().hex, None
+    with _lock:
+        _visite[radice.trace_id] = radice
+    return radice.trace_id
+
+
+def nuova_visita(etichetta=None):
+    """Chiude la visita in corso e ne apre una nuova, che diventa anche la predefinita.
+
+    E' la visita dell'app interattiva (una alla volta). Ritorna il trace ID (None se spento).
+    """
+    global _visita_predefinita
+    if not _ABILITATO:
+        return None
+    precedente = _visita_attiva()
+    if precedente is not None:
+        _chiudi_visita_ora(precedente, {})
+    trace_id = apri_visita(etichetta)
+    _visita_predefinita = _visite[trace_id]
+    return trace_id
+
+
+@contextlib.contextmanager
+def usa_visita(trace_id):
+    """Lega una visita aperta al contesto corrente per la durata del blocco with.
+
+    Anche dopo la chiusura gli span del blocco non passano alla visita predefinita.
+    """
+    token = _visita.set(_visite.get(trace_id) if trace_id else None)
+    try:
+        yield trace_id
+    finally:
+        _visita.reset(token)
+
+
+@contextlib.contextmanager
+def in_visita(etichetta=None):
+    """Visita del solo contesto corrente (es. un worker batch), chiusa all'uscita dal blocco."""
+    trace_id = apri_visita(etichetta)
+    try:
+        with usa_visita(trace_id):
+            yield trace_id
+    except BaseException:
+        if trace_id:
+            chiudi_visita(trace_id, esito="errore")
+        raise
+    if trace_id:
+        chiudi_visita(trace_id)
+
+
+def assicura_visita():
+    """Trace ID della visita in corso, aprendone una nuova se non c'e'."""
+    return visita_corrente() or nuova_visita()
+
+
+def visita_corrente():
+    """Trace ID della visita in corso, None se non ce n'e' una."""
+    visita = _visita_attiva()
+    return visita.trace_id if visita else None
+
+
+def chiudi_visita(trace_id=None, **attributi):
+    """Chiude la visita (di default quella in corso) e invia gli span al collector, se configurato.
+
+    Se chiamata dentro uno span della visita (es. da genera_relazione), la
+    chiusura avviene quando lo span piu' esterno termina, cosi' entra nella visita.
+    """
+    visita = _visite.get(trace_id) if trace_id else _visita_attiva()
+    if visita is None:
+        return
+    corrente = _corrente.get()
+    if corrente is not None and corrente.trace_id == visita.trace_id:
+        visita.chiusura_rimandata = attributi
+        return
+    _chiudi_visita_ora(visita, attributi)
+
+
+def _chiudi_visita_ora(visita, attributi):
+    global _visita_predefinita
+    with _lock:
+        if _visite.pop(visita.trace_id, None) is None:
+            return
+        if _visita_predefinita is visita:
+            _visita_predefinita = None
+    visita.chiusura_rimandata = None
+    visita.termina(**attributi)
+    if _otlp_endpoint:
+        threading.Thread(target=_invia_otlp, daemon=True).start()
+
+
+def puo_ricaricare():
+    """La ricarica a caldo azzererebbe le visite in corso: si aspetta che finiscano."""
+    return not _visite
+
+
+# =============================================================================
+# ESPORTAZIONE
+# =============================================================================
+
+def _chiudi_file():
+    global _file, _file_giorno
+    if _file is not None:
+        try:
+            _file.close()
+        except OSError:
+            pass
+    _file = None
+    _file_giorno = None
+
+
+def _esporta(span_chiuso):
+    global _file, _file_giorno
+    riga = json.dumps(span_chiuso.to_dict(), ensure_ascii=False, default=str)
+    invia = False
+    with _lock:
+        if not _ABILITATO:
+            return
+        giorno = datetime.now().strftime("%Y%m%d")
+        try:
+            if _file is None or _file_giorno != giorno:
+                _chiudi_file()
+                os.makedirs(_cartella, exist_ok=True)
+                _file = open(os.path.join(_cartella, f"trace_{giorno}.jsonl"), "a", encoding="utf-8")
+                _file_giorno = giorno
+            _file.write(riga + "\n")
+            _file.flush()
+        except OSError as e:
+            print(f"Tracing: impossibile scrivere la traccia: {e}")
+            _chiudi_file()
+        if _otlp_endpoint:
+            _da_inviare.append(span_chiuso.to_dict())
+            invia = len(_da_inviare) >= OTLP_BATCH
+    if invia:
+        threading.Thread(target=_invia_otlp, daemon=True).start()
+
+
+def _valore_otlp(valore):
+    if isinstance(valore, bool):
+        return {"boolValue": valore}
+    if isinstance(valore, int):
+        return {"intValue": str(valore)}
+    if isinstance(valore, float):
+        return {"doubleValue": valore}
+    return {"stringValue": str(valore)}
+
+
+def in_otlp(spans):
+    """Converte span (dict come nelle righe JSONL) nel formato OTLP/JSON di OpenTelemetry."""
+    convertiti = []
+    for s in spans:
+        fine = s["start_ns"] + int(s["duration_ms"] * 1e6)
+        convertito = {
+            "traceId": s["trace_id"],
+            "spanId": s["span_id"],
+            "name": s["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(s["start_ns"]),
+            "endTimeUnixNano": str(fine),
+            "attributes": [{"key": k, "value": _valore_otlp(v)}
+                           for k, v in dict(s.get("attributes") or {}, thread=s.get("thread")).items()
+                           if v is not None],
+            "status": {"code": 2, "message": s.get("message") or ""} if s.get("status") == "errore" else {"code": 1},
+        }
+        if s.get("parent_id"):
+            convertito["parentSpanId"] = s["parent_id"]
+        convertiti.append(convertito)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": NOME_SERVIZIO}}]},
+            "scopeSpans": [{
+                "scope": {"name": "docai.tracing", "version": __version__},
+                "spans": convertiti,
+            }],
+        }]
+    }
+
+
+def _invia_otlp():
+    with _lock:
+        endpoint = _otlp_endpoint
+        spans = _da_inviare[:]
+        del _da_inviare[:]
+    if not endpoint or not spans:
+        return
+    corpo = json.dumps(in_otlp(spans)).encode("utf-8")
+    req = request.Request(endpoint, data=corpo, method="POST",
+                          headers={"Content-Type": "application/json"})
+    try:
+        with request.urlopen(req, timeout=OTLP_TIMEOUT) as response:
+            response.read()
+    except Exception as e:
+        print(f"Tracing: invio OTLP fallito ({len(spans)} span persi): {e}")
+
+
+# =============================================================================
+# LETTURA E RIEPILOGO
+# =============================================================================
+
+def leggi_jsonl(percorso):
+    """Legge un file di tracce; le righe illeggibili (es. scrittura interrotta) vengono saltate."""
+    spans = []
+    with open(percorso, "r", encoding="utf-8") as f:
+        for riga in f:
+            try:
+                spans.append(json.loads(riga))
+            except ValueError:
+                continue
+    return spans
+
+
+def riepilogo(spans, trace_id=None):
+    """Albero testuale degli span di una visita (l'ultima se trace_id e' None)."""
+    if not spans:
+        return "Nessuna traccia"
+    if trace_id is None:
+        trace_id = max(spans, key=lambda s: s["start_ns"])["trace_id"]
+    visita = sorted((s for s in spans if s["trace_id"] == trace_id), key=lambda s: s["start_ns"])
+    if not visita:
+        return f"Visita {trace_id} non trovata"
+
+    figli = {}
+    ids = {s["span_id"] for s in visita}
+    for s in visita:
+        genitore = s["parent_id"] if s["parent_id"] in ids else None
+        figli.setdefault(genitore, []).append(s)
+
+    inizio = visita[0]["start_ns"]
+    righe = [f"Visita {trace_id}"]
+
+    def _stampa(genitore, livello):
+        for s in figli.get(genitore, []):
+            offset = (s["start_ns"] - inizio) / 1e6
+            stato = "" if s["status"] == "ok" else f"  [{s['message']}]"
+            righe.append(f"{'  ' * livello}{s['name']:<{40 - 2 * livello}} "
+                         f"+{offset:9.1f} ms {s['duration_ms']:10.1f} ms{stato}")
+            _stampa(s["span_id"], livello + 1)
+
+    _stampa(None, 1)
+    return "\n".join(righe)
+
+
+def _file_piu_recente():
+    # La cartella attiva (DOCAI_TRACE o abilita(cartella)), non sempre traces/
+    if not os.path.isdir(_cartella):
+        return None
+    nomi = sorted(n for n in os.listdir(_cartella) if n.endswith(".jsonl"))
+    return os.path.join(_cartella, nomi[-1]) if nomi else None
+
+
+# Attivazione da variabile d'ambiente
+_env = os.environ.get("DOCAI_TRACE")
+if _env:
+    abilita(cartella=None if _env == "1" else _env,
+            otlp_endpoint=os.environ.get("DOCAI_TRACE_OTLP"))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["riepilogo"]:
+        trace_id = None
+        if "--visita" in args:
+            i = args.index("--visita")
+            trace_id = args[i + 1]
+            del args[i:i + 2]
+        percorso = args[1] if len(args) > 1 else _file_piu_recente()
+        if not percorso:
+            print("Nessun file di tracce trovato")
+            sys.exit(1)
+        print(riepilogo(leggi_jsonl(percorso), trace_id))
+    elif args[:1] == ["otlp"] and len(args) == 3:
+        with open(args[2], "w", encoding="utf-8") as f:
+            json.dump(in_otlp(leggi_jsonl(args[1])), f)
+        print(f"Convertito in {args[2]}")
+    else:
+        print("Uso: python tracing.py riepilogo [file.jsonl] [--visita TRACE_ID]")
+        print("     python tracing.py otlp file.jsonl uscita.json")
+        sys.exit(1)
@@ -1,21 +1,51 @@
-﻿__version__ = "1.2"
+﻿__version__ = "1.9"
 # transcriber.py - DEEPGRAM REAL-TIME
 # CODICE UNIVERSALE - Parametri tecnici qui dentro (aggiornabili da GitHub)
 
+import os
 import threading
 import queue
+import time
+import wave
+import shutil
+import mimetypes
+import urllib.request
+import selectors
+import itertools
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
 import json
 import websocket
 import ssl
+import struct
+
+from ai_module import funzioni_tracing
+
+evento, assicura_visita, apri_visita, chiudi_visita = funzioni_tracing(
+    "evento", "assicura_visita", "apri_visita", "chiudi_visita")
+
+# certifi e' opzionale: se presente i suoi certificati si aggiungono a quelli di sistema
+try:
+    import certifi
+    HAS_CERTIFI = True
+except ImportError:
+    HAS_CERTIFI = False
 
 # =============================================================================
 # PARAMETRI TECNICI (aggiornabili da GitHub - MAI in config.py)
 # =============================================================================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 SAMPLE_RATE = 16000
 CHANNELS = 1
 
+DEEPGRAM_URL = "wss://api.deepgram.com/v1/listen"
+DEEPGRAM_URL_FILE = "https://api.deepgram.com/v1/listen"   # trascrizione di file (REST)
+TIMEOUT_FILE = 300
+
 DEEPGRAM_CONFIG = {
     "model": "nova-2",
     "language": "it",
@@ -25,9 +55,364 @@ DEEPGRAM_CONFIG = {
     "endpointing": 400,
 }
 
+# Connessione pre-riscaldata: Deepgram chiude dopo ~10 s senza dati,
+# quindi la connessione in attesa viene tenuta viva con messaggi KeepAlive
+KEEPALIVE_INTERVAL = 5
+
+# TranscriptionManager: piu' sessioni su un unico thread di I/O
+MANAGER_TICK = 0.02               # secondi tra due giri del loop
+MANAGER_MAX_BUFFER_CHUNKS = 200   # chunk in attesa per sessione (~20 s a 100 ms/chunk)
+MANAGER_CLOSE_TIMEOUT = 5         # attesa dei risultati finali dopo CloseStream
+MANAGER_CONNECT_WORKERS = 4       # connessioni aperte in parallelo
+MANAGER_MAX_USCITA = 64 * 1024    # byte di frame in attesa del socket (~2 s di audio), poi si aspetta
+MANAGER_INVIO_BLOCCATO = 5        # secondi senza che il socket accetti byte: sessione chiusa
+
+# Archivio locale dell'audio inviato a Deepgram (per ritrascriverlo, es. con un modello migliore)
+ARCHIVIO_AUDIO = False                    # opt-in: Transcriber(archivia=True) o qui per tutti
+CARTELLA_ARCHIVIO = os.path.join(BASE_DIR, "archivio_audio")
+ARCHIVIO_BLOCCO_BYTES = 1024 * 1024       # scritture grandi: ~32 s di audio a 16 kHz
+ARCHIVIO_CODA_MAX = 600                   # chunk in attesa di scrittura (~60 s), oltre si scartano
+ARCHIVIO_SPAZIO_MIN_MB = 500              # sotto questo spazio libero l'archivio si ferma
+ARCHIVIO_ATTESA_CHIUSURA = 30             # secondi di attesa del file completo prima di trascriverlo
+
+# Istanze vive: dopo un aggiornamento update_from_github le ricollega alla nuova classe
+_ISTANZE = weakref.WeakSet()
+
+
+def puo_ricaricare():
+    """False finche' c'e' una registrazione in corso (la ricarica a caldo viene rimandata)."""
+    for istanza in list(_ISTANZE):
+        if isinstance(istanza, TranscriptionManager):
+            if istanza.get_metrics()["active"]:
+                return False
+        elif getattr(istanza, "is_running", False):
+            return False
+    return True
+
+
+# =============================================================================
+# TLS (contesto unico, riusato da tutte le sessioni)
+# =============================================================================
+_ssl_context = None
+_ssl_lock = threading.Lock()
+
+
+def _get_ssl_context():
+    """Contesto TLS con verifica dei certificati, creato una sola volta."""
+    global _ssl_context
+    with _ssl_lock:
+        if _ssl_context is None:
+            context = ssl.create_default_context()
+            if HAS_CERTIFI:
+                try:
+                    context.load_verify_locations(cafile=certifi.where())
+                except Exception as e:
+                    print(f"Warning: certificati certifi non caricati: {e}")
+            _ssl_context = context
+        return _ssl_context
+
+
+def _build_deepgram_url(config, sample_rate):
+    """Costruisce URL Deepgram dai parametri di DEEPGRAM_CONFIG."""
+    params = [
+        f"model={config.get('model', 'nova-2')}",
+        f"language={config.get('language', 'it')}",
+        f"punctuate={'true' if config.get('punctuate', True) else 'false'}",
+        f"smart_format={'true' if config.get('smart_format', True) else 'false'}",
+        f"interim_results={'true' if config.get('interim_results', False) else 'false'}",
+        f"endpointing={config.get('endpointing', 400)}",
+        f"sample_rate={sample_rate}",
+        "encoding=linear16",
+        "channels=1"
+    ]
+    return f"{DEEPGRAM_URL}?{'&'.join(params)}"
+
+
+def _audio_to_bytes(audio_chunk):
+    """Converte un chunk (float32/int o bytes) in PCM int16 pronto per Deepgram."""
+    if isinstance(audio_chunk, np.ndarray):
+        if audio_chunk.dtype == np.float32:
+            audio_int16 = (audio_chunk * 32767).astype(np.int16)
+        else:
+            audio_int16 = audio_chunk.astype(np.int16)
+        return audio_int16.tobytes()
+    return audio_chunk
+
+
+def _build_deepgram_url_file(config):
+    """URL REST per un file: formato e sample rate li legge Deepgram dall'intestazione."""
+    params = [
+        f"model={config.get('model', 'nova-2')}",
+        f"language={config.get('language', 'it')}",
+        f"punctuate={'true' if config.get('punctuate', True) else 'false'}",
+        f"smart_format={'true' if config.get('smart_format', True) else 'false'}",
+    ]
+    return f"{DEEPGRAM_URL_FILE}?{'&'.join(params)}"
+
+
+def _estrai_testo_finale(message):
+    """Ritorna il testo di un risultato finale Deepgram, None per tutto il resto."""
+    data = json.loads(message)
+
+    if data.get("type") == "Results":
+        channel = data.get("channel", {})
+        alternatives = channel.get("alternatives", [])
+
+        if alternatives:
+            transcript = alternatives[0].get("transcript", "").strip()
+            is_final = data.get("is_final", False)
+
+            if transcript and is_final:
+                return transcript
+    return None
+
+
+class _ConnessioneDeepgram:
+    """Una connessione websocket a Deepgram con il suo thread e il KeepAlive."""
+
+    def __init__(self, transcriber):
+        self.transcriber = transcriber
+        self.aperta = threading.Event()
+        self.chiusa = threading.Event()
+        self.t_apertura = time.perf_counter()
+        self.app = websocket.WebSocketApp(
+            transcriber._get_deepgram_url(),
+            header={"Authorization": f"Token {transcriber.api_key}"},
+            on_message=transcriber._on_message,
+            on_error=transcriber._on_error,
+            on_close=self._on_close,
+            on_open=self._on_open
+        )
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.keepalive_thread = threading.Thread(target=self._keepalive, daemon=True)
+        self.keepalive_thread.start()
+
+    def _run(self):
+        try:
+            self.app.run_forever(sslopt={"context": _get_ssl_context()})
+        finally:
+            self.aperta.clear()
+            self.chiusa.set()
+
+    def _on_open(self, ws):
+        self.aperta.set()
+        # Le connessioni pre-riscaldate vengono tracciate all'avvio della registrazione
+        if self.transcriber.conn is self:
+            evento("deepgram.connessione", inizio=self.t_apertura, riscaldata=False)
+        self.transcriber._on_open(ws)
+
+    def _on_close(self, ws, close_status, close_msg):
+        self.aperta.clear()
+        self.transcriber._on_close(ws, close_status, close_msg)
+
+    def _keepalive(self):
+        while not self.chiusa.wait(KEEPALIVE_INTERVAL):
+            if not self.aperta.is_set():
+                continue
+            try:
+                self.app.send(json.dumps({"type": "KeepAlive"}))
+            except Exception:
+                break
+
+    def attiva(self):
+        """True se la connessione e' aperta o ancora in fase di apertura."""
+        return not self.chiusa.is_set()
+
+    def chiudi(self):
+        try:
+            if self.aperta.is_set():
+                self.app.send(json.dumps({"type": "CloseStream"}))
+        except Exception:
+            pass
+        try:
+            self.app.close()
+        except Exception:
+            pass
+
+
+# =============================================================================
+# ARCHIVIO AUDIO (copia locale di quanto inviato a Deepgram)
+# =============================================================================
+
+# Archivi ancora in scrittura (percorso -> ArchivioAudio): trascrivi_file aspetta che finiscano
+_archivi_in_scrittura = {}
+_lock_archivi = threading.Lock()
+
+
+def _percorso_archivio(etichetta=None):
+    """Nome con i millisecondi, riservato creando il file: due registrazioni non si sovrascrivono."""
+    nome = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+    if etichetta:
+        nome += f"_{etichetta}"
+    try:
+        os.makedirs(CARTELLA_ARCHIVIO, exist_ok=True)
+    except OSError:
+        pass   # l'errore lo segnala ArchivioAudio
+    for numero in itertools.count(1):
+        percorso = os.path.join(CARTELLA_ARCHIVIO, (nome if numero == 1 else f"{nome}_{numero}") + ".wav")
+        try:
+            open(percorso, "xb").close()
+            return percorso
+        except FileExistsError:
+            continue
+        except OSError:
+            return percorso
+
+
+class ArchivioAudio:
+    """
+    WAV (PCM 16 bit mono) scritto da un thread dedicato a blocchi grandi.
+    scrivi() non blocca mai: con la coda piena o il disco quasi pieno i chunk
+    vengono scartati e contati, la trascrizione in tempo reale prosegue.
+    """
+
+    def __init__(self, percorso, sample_rate=SAMPLE_RATE, trace_id=None):
+        self.percorso = percorso
+        self.sample_rate = sample_rate
+        self.trace_id = trace_id     # visita della sessione (None: quella in corso)
+        self.stato = "attivo"   # attivo -> chiuso | spazio_esaurito | errore
+        self.errore = None
+        self.metrics = {"bytes_written": 0, "writes": 0, "chunks_dropped": 0}
+        self._coda = queue.Queue(maxsize=ARCHIVIO_CODA_MAX)
+        self._chiuso = False
+        self._thread = threading.Thread(target=self._scrivi_in_background, daemon=True)
+        # Controllato subito: chi crea l'archivio sa gia' se il file ci sara'
+        if self._spazio_sufficiente():
+            with _lock_archivi:
+                _archivi_in_scrittura[os.path.abspath(percorso)] = self
+        else:
+            self.stato = "spazio_esaurito"
+            print(f"Archivio audio disattivato: meno di {ARCHIVIO_SPAZIO_MIN_MB} MB liberi")
+        self._thread.start()
+
+    def scrivi(self, audio_bytes):
+        """Accoda PCM int16 per la scrittura (non bloccante)."""
+        if self._chiuso:
+            return
+        if self.stato != "attivo":
+            self.metrics["chunks_dropped"] += 1
+            return
+        try:
+            self._coda.put_nowait(audio_bytes)
+        except queue.Full:
+            self.metrics["chunks_dropped"] += 1
+
+    def chiudi(self, timeout=None):
+        """Scrive quanto resta e chiude il file; con timeout attende la fine della scrittura."""
+        self._chiuso = True
+        if timeout is not None:
+            self._thread.join(timeout)
+
+    def attendi(self, timeout=None):
+        """Aspetta che il file sia completo (dopo chiudi()). True se lo e'."""
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _spazio_sufficiente(self):
+        try:
+            libero = shutil.disk_usage(os.path.dirname(self.percorso)).free
+        except OSError:
+            return True
+        return libero >= ARCHIVIO_SPAZIO_MIN_MB * 1024 * 1024
+
+    def _scrivi_in_background(self):
+        t_inizio = time.perf_counter()
+        wav = None
+        try:
+            if self.stato != "attivo":
+                return
+            os.makedirs(os.path.dirname(self.percorso), exist_ok=True)
+            wav = wave.open(self.percorso, "wb")
+            wav.setnchannels(CHANNELS)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+
+            blocco = bytearray()
+            fine = False
+            while not fine:
+                try:
+                    blocco += self._coda.get(timeout=0.2)
+                except queue.Empty:
+                    fine = self._chiuso
+                if blocco and (fine or len(blocco) >= ARCHIVIO_BLOCCO_BYTES):
+                    if not self._spazio_sufficiente():
+                        self.stato = "spazio_esaurito"
+                        print(f"Archivio audio interrotto: meno di {ARCHIVIO_SPAZIO_MIN_MB} MB liberi")
+                        return
+                    # writeframes aggiorna anche l'intestazione: il file resta leggibile se l'app si chiude male
+                    wav.writeframes(bytes(blocco))
+                    self.metrics["bytes_written"] += len(blocco)
+                    self.metrics["writes"] += 1
+                    blocco.clear()
+        except (OSError, wave.Error) as e:
+            self.stato = "errore"
+            self.errore = str(e)
+            print(f"Errore archivio audio {self.percorso}: {e}")
+        finally:
+            if wav is not None:
+                try:
+                    wav.close()
+                except (OSError, wave.Error):
+                    pass
+            if self.stato == "attivo":
+                self.stato = "chiuso"
+            elif self.metrics["bytes_written"] == 0:
+                # Disattivato prima del primo blocco: non resta un .wav vuoto (riservato da _percorso_archivio)
+                try:
+                    os.remove(self.percorso)
+                except OSError:
+                    pass
+            with _lock_archivi:
+                _archivi_in_scrittura.pop(os.path.abspath(self.percorso), None)
+            evento("archivio_audio", genitore=self.trace_id, inizio=t_inizio, stato=self.stato,
+                   byte=self.metrics["bytes_written"], scartati=self.metrics["chunks_dropped"])
+
+    def get_metrics(self):
+        m = dict(self.metrics)
+        m["stato"] = self.stato
+        m["percorso"] = self.percorso
+        return m
+
+
+def trascrivi_file(api_key, percorso, config=None):
+    """
+    Trascrive un file audio (es. dall'archivio) con l'API REST di Deepgram.
+    config sovrascrive DEEPGRAM_CONFIG (es. {"model": "nova-3"} per ritrascrivere).
+    Ritorna il testo, diviso in paragrafi se Deepgram li restituisce.
+    Se il file e' un archivio appena chiuso aspetta che la scrittura finisca.
+    """
+    with _lock_archivi:
+        archivio = _archivi_in_scrittura.get(os.path.abspath(percorso))
+    if archivio is not None:
+        if not archivio._chiuso:
+            raise RuntimeError(f"registrazione ancora in corso: {percorso}")
+        # Appena chiuso da stop_transcription (che non aspetta): gli ultimi blocchi stanno arrivando su disco
+        if not archivio.attendi(ARCHIVIO_ATTESA_CHIUSURA):
+            raise TimeoutError(f"archivio audio ancora in scrittura: {percorso}")
+    config = dict(DEEPGRAM_CONFIG, **(config or {}))
+    dimensione = os.path.getsize(percorso)
+    tipo = mimetypes.guess_type(percorso)[0] or "application/octet-stream"
+    t_inizio = time.perf_counter()
+    try:
+        with open(percorso, "rb") as f:
+            richiesta = urllib.request.Request(
+                _build_deepgram_url_file(config), data=f, method="POST",
+                headers={"Authorization": f"Token {api_key}", "Content-Type": tipo,
+                         "Content-Length": str(dimensione)})
+            with urllib.request.urlopen(richiesta, timeout=TIMEOUT_FILE, context=_get_ssl_context()) as risposta:
+                data = json.loads(risposta.read())
+        alternativa = data["results"]["channels"][0]["alternatives"][0]
+    except Exception as e:
+        evento("trascrizione_file", inizio=t_inizio, errore=e, byte=dimensione)
+        raise
+    testo = (alternativa.get("paragraphs") or {}).get("transcript") or alternativa.get("transcript", "")
+    evento("trascrizione_file", inizio=t_inizio, byte=dimensione, modello=config.get("model"))
+    return testo.strip()
+
 
 class Transcriber:
-    def __init__(self, api_key):
+    def __init__(self, api_key, archivia=None):
         print("")
         print("=" * 55)
         print("   DEEPGRAM REAL-TIME TRANSCRIPTION")
@@ -44,43 +429,49 @@ class Transcriber:
         self.full_transcription = []
         self.is_running = False
         self.ws = None
+        self.conn = None
         self.callback = None
         self.audio_queue = queue.Queue()
+
+        # Copia locale dell'audio (vedi ArchivioAudio); ultimo_archivio = file dell'ultima registrazione
+        self.archivia = ARCHIVIO_AUDIO if archivia is None else archivia
+        self.archivio = None
+        self.ultimo_archivio = None
+
+        # Connessione pre-riscaldata (opt-in tramite prewarm())
+        self.prewarm_enabled = False
+        self._warm = None
+        self._lock = threading.Lock()
+
+        # Tempo dalla pressione di "registra" al primo byte inviato (ms)
+        self.first_byte_ms = None
+        self._t_record = None
+        _ISTANZE.add(self)
+
+    def _dopo_ricarica(self):
+        """Dopo una ricarica a caldo: crea gli attributi che la versione precedente non aveva."""
+        if not hasattr(self, "archivia"):
+            self.archivia = ARCHIVIO_AUDIO
+            self.archivio = None
+            self.ultimo_archivio = None
         
     def _get_deepgram_url(self):
         """Costruisce URL Deepgram leggendo parametri da config.py."""
-        params = [
-            f"model={self.config.get('model', 'nova-2')}",
-            f"language={self.config.get('language', 'it')}",
-            f"punctuate={'true' if self.config.get('punctuate', True) else 'false'}",
-            f"smart_format={'true' if self.config.get('smart_format', True) else 'false'}",
-            f"interim_results={'true' if self.config.get('interim_results', False) else 'false'}",
-            f"endpointing={self.config.get('endpointing', 400)}",
-            f"sample_rate={self.sample_rate}",
-            "encoding=linear16",
-            "channels=1"
-        ]
-        return f"wss://api.deepgram.com/v1/listen?{'&'.join(params)}"
+        return _build_deepgram_url(self.config, self.sample_rate)
         
     def _on_message(self, ws, message):
         try:
-            data = json.loads(message)
+            transcript = _estrai_testo_finale(message)
             
-            if data.get("type") == "Results":
-                channel = data.get("channel", {})
-                alternatives = channel.get("alternatives", [])
+            if transcript:
+                timestamp = datetime.now().strftime("%H:%M:%S")
+                entry = f"[{timestamp}] {transcript}"
+                self.full_transcription.append(transcript)
+                evento("segmento_finale", caratteri=len(transcript),
+                       secondi=round(time.perf_counter() - self._t_record, 2) if self._t_record else None)
                 
-                if alternatives:
-                    transcript = alternatives[0].get("transcript", "").strip()
-                    is_final = data.get("is_final", False)
-                    
-                    if transcript and is_final:
-                        timestamp = datetime.now().strftime("%H:%M:%S")
-                        entry = f"[{timestamp}] {transcript}"
-                        self.full_transcription.append(transcript)
-                        
-                        if self.callback:
-                            self.callback(entry)
+                if self.callback:
+                    self.callback(entry)
                             
         except Exception as e:
             print(f"Errore messaggio: {e}")
@@ -94,68 +485,512 @@ class Transcriber:
     def _on_open(self, ws):
         print("Connesso a Deepgram!")
         
-        def send_audio():
-            while self.is_running:
-                try:
-                    audio_chunk = self.audio_queue.get(timeout=0.1)
-                    if audio_chunk is not None and len(audio_chunk) > 0:
-                        if isinstance(audio_chunk, np.ndarray):
-                            if audio_chunk.dtype == np.float32:
-                                audio_int16 = (audio_chunk * 32767).astype(np.int16)
-                            else:
-                                audio_int16 = audio_chunk.astype(np.int16)
-                            audio_bytes = audio_int16.tobytes()
-                        else:
-                            audio_bytes = audio_chunk
-                        ws.send(audio_bytes, opcode=websocket.ABNF.OPCODE_BINARY)
-                except queue.Empty:
-                    continue
-                except Exception as e:
-                    if self.is_running:
-                        print(f"Errore invio: {e}")
-                    break
+    def prewarm(self):
+        """Apre in anticipo la connessione (da chiamare quando appare la schermata di registrazione)."""
+        self.prewarm_enabled = True
+        with self._lock:
+            if self.is_running:
+                return
+            if self._warm is None or not self._warm.attiva():
+                self._warm = _ConnessioneDeepgram(self)
+
+        # La visita si apre: anche le connessioni verso Groq/Gemini (relazione e OCR a fine visita)
+        try:
+            from ai_module import warm_up
+        except ImportError:
+            return
+        warm_up()
+
+    def release_prewarm(self):
+        """Chiude la connessione pre-riscaldata (schermata di registrazione chiusa)."""
+        self.prewarm_enabled = False
+        with self._lock:
+            conn, self._warm = self._warm, None
+        if conn is not None:
+            conn.chiudi()
+
+    def _send_audio(self, conn):
+        t_inizio = time.perf_counter()
+        chunk_inviati = 0
+        byte_inviati = 0
+
+        # Attende l'apertura (immediata se la connessione era pre-riscaldata)
+        while self.is_running and self.conn is conn and not conn.aperta.wait(0.1):
+            if not conn.attiva():
+                evento("invio", inizio=t_inizio, errore=ConnectionError("connessione Deepgram non aperta"))
+                return
+
+        while self.is_running and self.conn is conn:
+            try:
+                audio_chunk = self.audio_queue.get(timeout=0.1)
+                if audio_chunk is not None and len(audio_chunk) > 0:
+                    audio_bytes = _audio_to_bytes(audio_chunk)
+                    conn.app.send(audio_bytes, opcode=websocket.ABNF.OPCODE_BINARY)
+                    chunk_inviati += 1
+                    byte_inviati += len(audio_bytes)
                     
-        self.send_thread = threading.Thread(target=send_audio, daemon=True)
-        self.send_thread.start()
+                    if self.first_byte_ms is None:
+                        self.first_byte_ms = (time.perf_counter() - self._t_record) * 1000
+                        print(f"Primo audio inviato dopo {self.first_byte_ms:.0f} ms")
+            except queue.Empty:
+                continue
+            except Exception as e:
+                if self.is_running:
+                    print(f"Errore invio: {e}")
+                    evento("invio", inizio=t_inizio, errore=e, chunk=chunk_inviati, byte=byte_inviati)
+                    return
+                break
+
+        evento("invio", inizio=t_inizio, chunk=chunk_inviati, byte=byte_inviati,
+               first_byte_ms=round(self.first_byte_ms, 1) if self.first_byte_ms is not None else None)
         
     def start_realtime_transcription(self, audio_recorder, callback=None):
+        self._t_record = time.perf_counter()
+        self.first_byte_ms = None
         self.is_running = True
         self.full_transcription = []
         self.callback = callback
+
+        # La registrazione apre la visita, se l'app non l'ha gia' aperta
+        assicura_visita()
         
+        # Usa la connessione pre-riscaldata se ancora valida, altrimenti ne apre una nuova
+        with self._lock:
+            conn, self._warm = self._warm, None
+        if conn is None or not conn.attiva():
+            conn = _ConnessioneDeepgram(self)
+        elif conn.aperta.is_set():
+            evento("deepgram.connessione", riscaldata=True)
+        self.conn = conn
+        self.ws = conn.app
+        self.ws_thread = conn.thread
+
+        archivio = None
+        if self.archivia:
+            archivio = ArchivioAudio(_percorso_archivio(), self.sample_rate)
+            # Senza spazio su disco l'archivio e' gia' disattivato: nessun file da trascrivere
+            self.ultimo_archivio = archivio.percorso if archivio.stato == "attivo" else None
+        self.archivio = archivio
+
         def audio_reader():
-            while self.is_running:
+            t_inizio = time.perf_counter()
+            chunk_letti = 0
+            coda_max = 0
+            while self.is_running and self.conn is conn:
                 chunk = audio_recorder.get_audio_chunk(timeout=0.5)
                 if chunk is not None:
+                    # Convertito qui: l'archivio riceve gli stessi byte anche se l'invio si interrompe
+                    chunk = _audio_to_bytes(chunk)
+                    if archivio is not None:
+                        archivio.scrivi(chunk)
                     self.audio_queue.put(chunk)
+                    chunk_letti += 1
+                    coda_max = max(coda_max, self.audio_queue.qsize())
+            evento("cattura", inizio=t_inizio, chunk=chunk_letti, coda_max=coda_max)
                     
         self.reader_thread = threading.Thread(target=audio_reader, daemon=True)
         self.reader_thread.start()
         
-        def run_websocket():
-            self.ws = websocket.WebSocketApp(
-                self._get_deepgram_url(),
-                header={"Authorization": f"Token {self.api_key}"},
-                on_message=self._on_message,
-                on_error=self._on_error,
-                on_close=self._on_close,
-                on_open=self._on_open
-            )
-            self.ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
-            
-        self.ws_thread = threading.Thread(target=run_websocket, daemon=True)
-        self.ws_thread.start()
+        self.send_thread = threading.Thread(target=self._send_audio, args=(conn,), daemon=True)
+        self.send_thread.start()
         
     def stop_transcription(self):
+        era_attiva = self.is_running
         self.is_running = False
-        if self.ws:
-            try:
-                self.ws.send(json.dumps({"type": "CloseStream"}))
-                self.ws.close()
-            except:
-                pass
+        if self.conn:
+            self.conn.chiudi()
+        archivio, self.archivio = self.archivio, None
+        if archivio is not None:
+            archivio.chiudi()
+            if archivio.stato in ("spazio_esaurito", "errore") and archivio.metrics["bytes_written"] == 0:
+                self.ultimo_archivio = None   # interrotto prima di scrivere: il file e' stato rimosso
+        if era_attiva:
+            evento("registrazione", inizio=self._t_record, segmenti=len(self.full_transcription))
+
+        # Ricicla: prepara subito la connessione per la prossima registrazione
+        if self.prewarm_enabled:
+            self.prewarm()
                 
     def get_full_transcription(self):
 
         return "\n".join(self.full_transcription)
 
+# =============================================================================
+# MULTI-SESSIONE (piu' ambulatori sulla stessa postazione)
+# =============================================================================
+
+class SessioneTrascrizione:
+    """Stato di una sessione gestita da TranscriptionManager."""
+
+    def __init__(self, session_id, callback=None, audio_recorder=None, archivio=None, trace_id=None):
+        self.session_id = session_id
+        self.trace_id = trace_id
+        self.callback = callback
+        self.audio_recorder = audio_recorder
+        self.archivio = archivio
+        self.full_transcription = []
+        self.ws = None
+        self.stato = "connessione"   # connessione -> attiva -> chiusura -> chiusa
+        self.errore = None
+
+        # Buffer limitato: se Deepgram rallenta si scartano i chunk piu' vecchi
+        self.buffer = deque(maxlen=MANAGER_MAX_BUFFER_CHUNKS)
+        # Frame websocket gia' pronti che il socket (non bloccante) non ha ancora accettato
+        self.in_uscita = bytearray()
+        self.eventi = None            # eventi registrati nel selector (None = non ancora)
+        self.ultimo_invio = time.monotonic()
+        self.ultimo_progresso = self.ultimo_invio
+        self.closestream_inviato = False
+        self.limite_chiusura = None
+
+        self.t_start = time.perf_counter()
+        self.metrics = {
+            "chunks_in": 0,
+            "chunks_sent": 0,
+            "chunks_dropped": 0,
+            "bytes_sent": 0,
+            "finals": 0,
+            "connect_ms": None,
+            "first_byte_ms": None,
+            "send_lag_ms_max": 0.0,
+            "send_lag_ms_sum": 0.0,
+        }
+
+    def feed(self, audio_chunk):
+        if audio_chunk is None or len(audio_chunk) == 0 or self.stato in ("chiusura", "chiusa"):
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.metrics["chunks_dropped"] += 1
+        audio_bytes = _audio_to_bytes(audio_chunk)
+        if self.archivio is not None:
+            self.archivio.scrivi(audio_bytes)
+        self.buffer.append((time.perf_counter(), audio_bytes))
+        self.metrics["chunks_in"] += 1
+
+    def get_full_transcription(self):
+        return "\n".join(self.full_transcription)
+
+    def get_metrics(self):
+        m = dict(self.metrics)
+        sent = m.pop("send_lag_ms_sum")
+        m["send_lag_ms_avg"] = sent / m["chunks_sent"] if m["chunks_sent"] else 0.0
+        m["buffered"] = len(self.buffer)
+        m["stato"] = self.stato
+        m["errore"] = self.errore
+        m["trace_id"] = self.trace_id
+        if self.archivio is not None:
+            m["archivio"] = self.archivio.get_metrics()
+        return m
+
+
+class TranscriptionManager:
+    """
+    Gestisce N sessioni Deepgram contemporanee con un solo thread di I/O.
+    Le connessioni vengono aperte da un piccolo pool, poi invio audio,
+    ricezione risultati e KeepAlive girano tutti nello stesso loop, su socket
+    non bloccanti: una connessione lenta non ferma le altre sessioni.
+    I callback sono chiamati dal thread di I/O: devono essere rapidi.
+    """
+
+    def __init__(self, api_key, config=None, sample_rate=SAMPLE_RATE, archivia=None):
+        self.api_key = api_key
+        self.config = config or DEEPGRAM_CONFIG
+        self.sample_rate = sample_rate
+        self.archivia = ARCHIVIO_AUDIO if archivia is None else archivia
+        self.sessions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._da_registrare = deque()
+        self._connect_pool = ThreadPoolExecutor(max_workers=MANAGER_CONNECT_WORKERS,
+                                                thread_name_prefix="deepgram-connect")
+        self._cpu_loop = 0.0
+        self.is_running = True
+        self._loop_thread = threading.Thread(target=self._loop, daemon=True)
+        self._loop_thread.start()
+        _ISTANZE.add(self)
+
+    def _dopo_ricarica(self):
+        """Dopo una ricarica a caldo: crea gli attributi che la versione precedente non aveva."""
+        if not hasattr(self, "archivia"):
+            self.archivia = ARCHIVIO_AUDIO
+        # Sessioni aperte dalla versione precedente (socket bloccanti): stesso loop, buffer di uscita vuoto
+        for sessione in list(self.sessions.values()):
+            if not hasattr(sessione, "in_uscita"):
+                sessione.in_uscita = bytearray()
+                registrata = sessione.ws is not None and sessione not in self._da_registrare
+                sessione.eventi = selectors.EVENT_READ if registrata else None
+                sessione.ultimo_progresso = time.monotonic()
+
+    # --- API pubblica ---
+
+    def start_session(self, callback=None, audio_recorder=None, session_id=None):
+        """Avvia una sessione e ritorna il suo id. L'audio arriva da feed() o da audio_recorder."""
+        with self._lock:
+            if session_id is None:
+                session_id = f"sessione-{next(self._ids)}"
+            if session_id in self.sessions:
+                raise ValueError(f"Sessione {session_id} gia' attiva")
+            # Ogni sessione ha la sua visita: le sessioni in parallelo non si mescolano
+            trace_id = apri_visita(session_id)
+            archivio = None
+            if self.archivia:
+                archivio = ArchivioAudio(_percorso_archivio(session_id), self.sample_rate, trace_id)
+            sessione = SessioneTrascrizione(session_id, callback, audio_recorder, archivio, trace_id)
+            self.sessions[session_id] = sessione
+        self._connect_pool.submit(self._connetti, sessione)
+        return session_id
+
+    def feed(self, session_id, audio_chunk):
+        """Accoda audio per una sessione (non bloccante)."""
+        sessione = self.sessions.get(session_id)
+        if sessione is not None:
+            sessione.feed(audio_chunk)
+
+    def stop_session(self, session_id):
+        """Chiede a Deepgram i risultati finali e chiude la sessione."""
+        sessione = self.sessions.get(session_id)
+        if sessione is not None and sessione.stato in ("connessione", "attiva"):
+            sessione.stato = "chiusura"
+
+    def get_full_transcription(self, session_id):
+        sessione = self.sessions.get(session_id)
+        return sessione.get_full_transcription() if sessione else ""
+
+    def get_trace_id(self, session_id):
+        """Visita della sessione: genera_relazione dentro tracing.usa_visita(trace_id) la chiude."""
+        sessione = self.sessions.get(session_id)
+        return sessione.trace_id if sessione else None
+
+    def get_metrics(self, session_id=None):
+        """Metriche di una sessione, oppure di tutte piu' quelle del loop."""
+        if session_id is not None:
+            sessione = self.sessions.get(session_id)
+            return sessione.get_metrics() if sessione else None
+        with self._lock:
+            sessioni = list(self.sessions.values())
+        return {
+            "sessions": {s.session_id: s.get_metrics() for s in sessioni},
+            "active": sum(1 for s in sessioni if s.stato in ("connessione", "attiva")),
+            "loop_cpu_s": self._cpu_loop,
+        }
+
+    def remove_session(self, session_id):
+        """Dimentica una sessione chiusa (metriche e trascrizione comprese)."""
+        with self._lock:
+            sessione = self.sessions.get(session_id)
+            if sessione is not None and sessione.stato == "chiusa":
+                del self.sessions[session_id]
+            else:
+                return
+        # Visita senza relazione: si chiude qui (le sessioni di prima di una ricarica non l'hanno)
+        trace_id = getattr(sessione, "trace_id", None)
+        if trace_id:
+            chiudi_visita(trace_id)
+
+    def shutdown(self, timeout=MANAGER_CLOSE_TIMEOUT):
+        """Chiude tutte le sessioni e ferma il loop."""
+        for session_id in list(self.sessions):
+            self.stop_session(session_id)
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite and any(s.stato != "chiusa" for s in list(self.sessions.values())):
+            time.sleep(MANAGER_TICK)
+        self.is_running = False
+        self._loop_thread.join(timeout=1)
+        self._connect_pool.shutdown(wait=False)
+        for sessione in list(self.sessions.values()):
+            trace_id = getattr(sessione, "trace_id", None)
+            if trace_id:
+                chiudi_visita(trace_id)
+
+    # --- Connessione (nel pool) ---
+
+    def _connetti(self, sessione):
+        try:
+            ws = websocket.create_connection(
+                _build_deepgram_url(self.config, self.sample_rate),
+                header=[f"Authorization: Token {self.api_key}"],
+                sslopt={"context": _get_ssl_context()},
+                timeout=10,
+                enable_multithread=True
+            )
+            # Da qui il socket lo usa solo il loop, senza mai bloccarsi: i frame
+            # di risposta della libreria (pong, chiusura) passano dal buffer di uscita
+            ws.sock.setblocking(False)
+            ws.pong = lambda dati: self._accoda(sessione, dati, websocket.ABNF.OPCODE_PONG)
+            ws.send_close = lambda *args, **kwargs: self._accoda_chiusura(sessione)
+            sessione.metrics["connect_ms"] = (time.perf_counter() - sessione.t_start) * 1000
+            evento("deepgram.connessione", genitore=sessione.trace_id, inizio=sessione.t_start, riscaldata=False)
+            sessione.ws = ws
+            self._da_registrare.append(sessione)
+        except Exception as e:
+            sessione.errore = f"Connessione fallita: {e}"
+            sessione.stato = "chiusa"
+            if sessione.archivio is not None:
+                sessione.archivio.chiudi()
+            print(f"Errore connessione {sessione.session_id}: {e}")
+
+    # --- Loop di I/O ---
+
+    def _loop(self):
+        while self.is_running:
+            t_cpu = time.thread_time()
+
+            while self._da_registrare:
+                sessione = self._da_registrare.popleft()
+                self._selector.register(sessione.ws.sock, selectors.EVENT_READ, sessione)
+                sessione.eventi = selectors.EVENT_READ
+                if sessione.stato == "connessione":
+                    sessione.stato = "attiva"
+
+            if self._selector.get_map():
+                eventi = self._selector.select(timeout=MANAGER_TICK)
+            else:
+                eventi = []
+                time.sleep(MANAGER_TICK)
+
+            for key, maschera in eventi:
+                if maschera & selectors.EVENT_READ:
+                    self._ricevi(key.data)
+                if maschera & selectors.EVENT_WRITE and key.data.stato != "chiusa":
+                    self._scrivi(key.data)
+
+            adesso = time.monotonic()
+            for sessione in list(self.sessions.values()):
+                if sessione.eventi is None or sessione.stato == "chiusa":
+                    continue
+                if sessione.audio_recorder is not None and sessione.stato == "attiva":
+                    self._leggi_recorder(sessione)
+                self._invia(sessione, adesso)
+
+            self._cpu_loop += time.thread_time() - t_cpu
+
+        for sessione in list(self.sessions.values()):
+            if sessione.stato != "chiusa":
+                self._chiudi(sessione)
+
+    def _leggi_recorder(self, sessione):
+        while True:
+            chunk = sessione.audio_recorder.get_audio_chunk(timeout=0)
+            if chunk is None:
+                return
+            sessione.feed(chunk)
+
+    def _invia(self, sessione, adesso):
+        try:
+            # Se il socket non smaltisce, l'audio resta nel buffer limitato (che scarta i piu' vecchi)
+            while sessione.buffer and len(sessione.in_uscita) < MANAGER_MAX_USCITA:
+                t_in, chunk = sessione.buffer.popleft()
+                audio_bytes = _audio_to_bytes(chunk)
+                self._accoda(sessione, audio_bytes, websocket.ABNF.OPCODE_BINARY)
+
+                t_out = time.perf_counter()
+                lag_ms = (t_out - t_in) * 1000
+                m = sessione.metrics
+                m["chunks_sent"] += 1
+                m["bytes_sent"] += len(audio_bytes)
+                m["send_lag_ms_sum"] += lag_ms
+                if lag_ms > m["send_lag_ms_max"]:
+                    m["send_lag_ms_max"] = lag_ms
+                if m["first_byte_ms"] is None:
+                    m["first_byte_ms"] = (t_out - sessione.t_start) * 1000
+                sessione.ultimo_invio = adesso
+
+            if sessione.stato == "chiusura":
+                if not sessione.closestream_inviato and not sessione.buffer:
+                    # Da qui si aspettano solo i risultati finali e la chiusura lato Deepgram
+                    self._accoda(sessione, json.dumps({"type": "CloseStream"}))
+                    sessione.closestream_inviato = True
+                    sessione.limite_chiusura = adesso + MANAGER_CLOSE_TIMEOUT
+                elif sessione.closestream_inviato and adesso > sessione.limite_chiusura:
+                    self._chiudi(sessione)
+                    return
+            elif adesso - sessione.ultimo_invio >= KEEPALIVE_INTERVAL:
+                self._accoda(sessione, json.dumps({"type": "KeepAlive"}))
+                sessione.ultimo_invio = adesso
+
+            self._scrivi(sessione)
+            if sessione.in_uscita and adesso - sessione.ultimo_progresso > MANAGER_INVIO_BLOCCATO:
+                raise TimeoutError(f"il socket non accetta dati da {MANAGER_INVIO_BLOCCATO} s")
+        except Exception as e:
+            sessione.errore = f"Errore invio: {e}"
+            print(f"Errore invio {sessione.session_id}: {e}")
+            self._chiudi(sessione)
+
+    def _accoda(self, sessione, dati, opcode=websocket.ABNF.OPCODE_TEXT):
+        """Aggiunge un frame al buffer di uscita della sessione (lo scrive _scrivi)."""
+        if not sessione.in_uscita:
+            sessione.ultimo_progresso = time.monotonic()
+        sessione.in_uscita += websocket.ABNF.create_frame(dati, opcode).format()
+
+    def _accoda_chiusura(self, sessione, status=websocket.STATUS_NORMAL):
+        sessione.ws.connected = False
+        self._accoda(sessione, struct.pack("!H", status), websocket.ABNF.OPCODE_CLOSE)
+
+    def _scrivi(self, sessione):
+        """Scrive quanto il socket accetta senza bloccare; il resto al prossimo EVENT_WRITE."""
+        while sessione.in_uscita:
+            try:
+                scritti = sessione.ws.sock.send(sessione.in_uscita[:MANAGER_MAX_USCITA])
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                break
+            del sessione.in_uscita[:scritti]
+            sessione.ultimo_progresso = time.monotonic()
+        # EVENT_WRITE solo finche' resta qualcosa da scrivere, altrimenti select tornerebbe subito
+        eventi = selectors.EVENT_READ | (selectors.EVENT_WRITE if sessione.in_uscita else 0)
+        if eventi != sessione.eventi:
+            self._selector.modify(sessione.ws.sock, eventi, sessione)
+            sessione.eventi = eventi
+
+    def _ricevi(self, sessione):
+        try:
+            while True:
+                opcode, data = sessione.ws.recv_data(control_frame=True)
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    # recv_data ha gia' risposto con il frame di chiusura
+                    self._chiudi(sessione, handshake=False)
+                    return
+                if opcode == websocket.ABNF.OPCODE_TEXT:
+                    transcript = _estrai_testo_finale(data)
+                    if transcript:
+                        sessione.full_transcription.append(transcript)
+                        sessione.metrics["finals"] += 1
+                        if sessione.callback:
+                            timestamp = datetime.now().strftime("%H:%M:%S")
+                            sessione.callback(f"[{timestamp}] {transcript}")
+                # Con TLS possono restare dati gia' decifrati che select non vede
+                pending = getattr(sessione.ws.sock, "pending", None)
+                if not pending or not pending():
+                    return
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Frame arrivato solo in parte: la libreria tiene il resto, si continua al prossimo evento
+            return
+        except Exception as e:
+            if sessione.stato != "chiusura":
+                sessione.errore = f"Errore ricezione: {e}"
+                print(f"Errore ricezione {sessione.session_id}: {e}")
+            self._chiudi(sessione)
+
+    def _chiudi(self, sessione, handshake=True):
+        # Nessuna attesa della risposta: il loop non deve mai bloccarsi su una sessione
+        if sessione.stato == "chiusa":
+            return
+        sessione.stato = "chiusa"
+        # Le sessioni create prima di una ricarica a caldo non hanno l'archivio
+        archivio = getattr(sessione, "archivio", None)
+        if archivio is not None:
+            archivio.chiudi()
+        try:
+            self._selector.unregister(sessione.ws.sock)
+        except Exception:
+            pass
+        try:
+            if handshake:
+                self._accoda_chiusura(sessione)
+            self._scrivi(sessione)
+        except Exception:
+            pass
+        try:
+            sessione.ws.shutdown()
+        except Exception:
+            pass
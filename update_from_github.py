@@ -1,13 +1,26 @@
-__version__ = "1.3"
+__version__ = "2.1"
 # update_from_github.py - Sistema aggiornamento file da GitHub
 # CODICE UNIVERSALE - Aggiornabile da GitHub
 # Controlla versioni remote e scarica aggiornamenti
 
 import os
 import re
+import sys
+import ssl
+import gzip
+import zlib
+import base64
 import json
+import random
+import shutil
+import hashlib
+import tempfile
 import threading
+import importlib
+import http.client
 from urllib import request, error
+from urllib.parse import urlsplit, unquote
+from concurrent.futures import ThreadPoolExecutor
 
 # =============================================================================
 # CONFIGURAZIONE GITHUB
@@ -15,32 +28,268 @@ from urllib import request, error
 import time
 GITHUB_BASE_URL = "https://raw.githubusercontent.com/MaxStar85/docai-updates/main/"
 
-def _no_cache_url(url):
-    """Aggiunge parametro per bypassare la cache di GitHub."""
-    return url + "?t=" + str(int(time.time()))
+USER_AGENT = "DOCai-Updater"
+DOWNLOAD_WORKERS = 4        # download in parallelo
+MAX_CONNESSIONI_HOST = 4    # connessioni keep-alive tenute aperte per host
+BLOCCO_DOWNLOAD = 64 * 1024 # byte letti per volta quando si scarica su file
+
+# Controllo periodico in background (vedi avvia_scheduler)
+INTERVALLO_CONTROLLO = 6 * 3600   # secondi tra due controlli riusciti
+RITARDO_AVVIO = 60                # il primo controllo non parte prima (avvio libero)
+BACKOFF_BASE = 60                 # attesa dopo il primo errore, poi raddoppia
+JITTER = 0.2                      # +/- 20% per non sincronizzare tutte le postazioni
+
+# Manifest con versione, SHA-256 e dimensione di ogni file (versions.txt resta per i client vecchi)
+MANIFEST_FILE = "manifest.json"
 
 FILE_AGGIORNABILI = {
     "ai_generator": "ai_generator.py",
     "ai_module": "ai_module.py",
     "transcriber": "transcriber.py",
     "update_from_github": "update_from_github.py",
+    "tracing": "tracing.py",
+    "batch_relazioni": "batch_relazioni.py",
+    "rate_limiter": "rate_limiter.py",
 }
 
 # Cartella locale dove stanno i file
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Stato locale: ETag / Last-Modified delle risorse gia' scaricate
+STATE_FILE = os.path.join(BASE_DIR, "update_state.json")
+
+
+# =============================================================================
+# CONNESSIONI HTTP (pool keep-alive + richieste condizionali)
+# =============================================================================
+
+class _PoolConnessioni:
+    """Connessioni HTTP(S) keep-alive riusate tra richieste e thread."""
+
+    def __init__(self, max_per_host=MAX_CONNESSIONI_HOST):
+        self.max_per_host = max_per_host
+        self._libere = {}
+        self._lock = threading.Lock()
+        self._ssl = ssl.create_default_context()
+        self.stats = {"nuove": 0, "riusate": 0, "richieste": 0}
+
+    def _crea(self, chiave, timeout):
+        scheme, host, port = chiave
+        if scheme != "https":
+            return http.client.HTTPConnection(host, port, timeout=timeout)
+
+        # Proxy di sistema (come faceva urlopen): tunnel CONNECT verso GitHub
+        proxy = request.getproxies().get("https")
+        if proxy and not request.proxy_bypass(host):
+            p = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+            conn = http.client.HTTPSConnection(p.hostname, p.port or 8080, timeout=timeout, context=self._ssl)
+            headers = {}
+            if p.username:
+                credenziali = f"{unquote(p.username)}:{unquote(p.password or '')}".encode("utf-8")
+                headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credenziali).decode("ascii")
+            conn.set_tunnel(host, port, headers=headers)
+            return conn
+        return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl)
+
+    def _prendi(self, chiave, timeout):
+        with self._lock:
+            libere = self._libere.get(chiave)
+            if libere:
+                conn = libere.pop()
+                self.stats["riusate"] += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.stats["nuove"] += 1
+        return self._crea(chiave, timeout), False
+
+    def _rilascia(self, chiave, conn):
+        with self._lock:
+            libere = self._libere.setdefault(chiave, [])
+            if len(libere) < self.max_per_host:
+                libere.append(conn)
+                return
+        conn.close()
+
+    def get(self, url, headers=None, timeout=10, max_redirect=3, destinazione=None):
+        """
+        GET con riuso della connessione. Ritorna (status, headers, corpo decompresso).
+        Se destinazione e' una funzione, un corpo 200 le viene passato a blocchi
+        (senza tenerlo in memoria) e il corpo ritornato e' None.
+        """
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", USER_AGENT)
+        headers.setdefault("Accept-Encoding", "gzip")
+
+        for _ in range(max_redirect + 1):
+            parti = urlsplit(url)
+            porta = parti.port or (443 if parti.scheme == "https" else 80)
+            chiave = (parti.scheme, parti.hostname, porta)
+            percorso = (parti.path or "/") + ("?" + parti.query if parti.query else "")
+
+            for tentativo in range(2):
+                conn, riusata = self._prendi(chiave, timeout)
+                try:
+                    conn.request("GET", percorso, headers=headers)
+                    risposta = conn.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    # Una connessione keep-alive puo' essere stata chiusa dal server: si riprova una volta
+                    if riusata and tentativo == 0:
+                        continue
+                    raise
+
+            gzip_encoded = risposta.headers.get("Content-Encoding", "").lower() == "gzip"
+            try:
+                if destinazione is not None and risposta.status == 200:
+                    decompressore = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzip_encoded else None
+                    while True:
+                        blocco = risposta.read(BLOCCO_DOWNLOAD)
+                        if not blocco:
+                            break
+                        destinazione(decompressore.decompress(blocco) if decompressore else blocco)
+                    if decompressore:
+                        destinazione(decompressore.flush())
+                    corpo = None
+                else:
+                    corpo = risposta.read()
+                    if gzip_encoded and corpo:
+                        corpo = gzip.decompress(corpo)
+            except Exception:
+                conn.close()
+                raise
+
+            with self._lock:
+                self.stats["richieste"] += 1
+            if risposta.will_close:
+                conn.close()
+            else:
+                self._rilascia(chiave, conn)
+
+            if risposta.status in (301, 302, 303, 307, 308) and risposta.headers.get("Location"):
+                url = request.urljoin(url, risposta.headers["Location"])
+                continue
+
+            return risposta.status, risposta.headers, corpo
+
+        raise error.URLError(f"Troppi redirect per {url}")
+
+    def chiudi(self):
+        with self._lock:
+            tutte = [c for libere in self._libere.values() for c in libere]
+            self._libere = {}
+        for conn in tutte:
+            conn.close()
+
+
+_POOL = _PoolConnessioni()
+
+_stato_lock = threading.Lock()
+
+
+def _carica_stato():
+    """Legge lo stato locale (vuoto se assente o illeggibile)."""
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            stato = json.load(f)
+        if isinstance(stato, dict):
+            return stato
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def _salva_stato(stato):
+    """Scrive lo stato in modo atomico (file temporaneo + os.replace)."""
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(stato, f, indent=1)
+        os.replace(tmp, STATE_FILE)
+    except OSError as e:
+        print(f"Warning: stato aggiornamenti non salvato: {e}")
+
+
+def _aggiorna_cache_http(url, headers, **extra):
+    """Memorizza ETag / Last-Modified di una risposta 200."""
+    voce = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    voce.update(extra)
+    with _stato_lock:
+        stato = _carica_stato()
+        stato.setdefault("http", {})[url] = voce
+        _salva_stato(stato)
+
+
+def _modifica_stato(funzione):
+    """Legge, modifica (funzione(stato)) e salva lo stato sotto lock."""
+    with _stato_lock:
+        stato = _carica_stato()
+        funzione(stato)
+        _salva_stato(stato)
+
+
+def _leggi_cache_http(url):
+    with _stato_lock:
+        return _carica_stato().get("http", {}).get(url)
+
+
+def _headers_condizionali(voce):
+    headers = {}
+    if voce:
+        if voce.get("etag"):
+            headers["If-None-Match"] = voce["etag"]
+        if voce.get("last_modified"):
+            headers["If-Modified-Since"] = voce["last_modified"]
+    return headers
+
+
+def _sha256(contenuto):
+    return hashlib.sha256(contenuto).hexdigest()
+
+
+def _leggi_locale(filename):
+    """Contenuto del file locale senza BOM (None se non esiste)."""
+    try:
+        with open(os.path.join(BASE_DIR, filename), "rb") as f:
+            contenuto = f.read()
+    except OSError:
+        return None
+    if contenuto.startswith(b'\xef\xbb\xbf'):
+        contenuto = contenuto[3:]
+    return contenuto
+
 
 # =============================================================================
 # FUNZIONI DI LETTURA VERSIONI
 # =============================================================================
 
+def _get_testo_remoto(nome, timeout):
+    """Scarica un file di testo da GitHub; se invariato (304) usa la copia in cache."""
+    url = GITHUB_BASE_URL + nome
+    cache = _leggi_cache_http(url)
+    headers = {}
+    if cache and cache.get("corpo") is not None:
+        headers.update(_headers_condizionali(cache))
+
+    status, risposta_headers, corpo = _POOL.get(url, headers=headers, timeout=timeout)
+    if status == 304:
+        return cache["corpo"]
+    if status != 200:
+        raise error.HTTPError(url, status, f"HTTP {status}", risposta_headers, None)
+    content = corpo.decode("utf-8-sig")
+    _aggiorna_cache_http(url, risposta_headers, corpo=content)
+    return content
+
+
 def get_remote_versions(timeout=10):
-    """Scarica versions.txt da GitHub e ritorna dict delle versioni."""
-    url = _no_cache_url(GITHUB_BASE_URL + "versions.txt")
+    """Scarica versions.txt da GitHub e ritorna dict delle versioni (304 se invariato)."""
     try:
-        req = request.Request(url, headers={"User-Agent": "DOCai-Updater", "Cache-Control": "no-cache"})
-        with request.urlopen(req, timeout=timeout) as response:
-            content = response.read().decode("utf-8")
+        content = _get_testo_remoto("versions.txt", timeout)
         
         versions = {}
         for line in content.strip().split("\n"):
@@ -55,6 +304,30 @@ def get_remote_versions(timeout=10):
         return None
 
 
+def get_remote_manifest(timeout=10):
+    """
+    Scarica il manifest da GitHub. Ritorna dict
+    {"ai_generator": {"file": "ai_generator.py", "version": "2.3", "sha256": "...", "size": 1234}, ...}
+    oppure None se non disponibile (si usera' versions.txt).
+    """
+    try:
+        manifest = json.loads(_get_testo_remoto(MANIFEST_FILE, timeout))
+        files = manifest["files"]
+        for key, voce in files.items():
+            if not all(k in voce for k in ("file", "version", "sha256", "size")):
+                raise ValueError(f"voce incompleta per {key}")
+        return files
+    except Exception as e:
+        print(f"Manifest non disponibile ({e}), uso versions.txt")
+        return None
+
+
+def get_local_hash(filename):
+    """SHA-256 del file locale (senza BOM), None se non esiste."""
+    contenuto = _leggi_locale(filename)
+    return _sha256(contenuto) if contenuto is not None else None
+
+
 def get_local_version(filename):
     """Legge __version__ da un file locale."""
     filepath = os.path.join(BASE_DIR, filename)
@@ -73,11 +346,37 @@ def get_local_version(filename):
     return None
 
 
+def _info_locali():
+    """
+    Versione e hash di tutti i file aggiornabili. I file vengono riletti solo
+    se mtime o dimensione sono cambiati rispetto allo stato salvato.
+    """
+    with _stato_lock:
+        locali = _carica_stato().get("locali", {})
+    info = {}
+    cambiati = {}
+    for filename in FILE_AGGIORNABILI.values():
+        try:
+            st = os.stat(os.path.join(BASE_DIR, filename))
+        except OSError:
+            continue
+        chiave = [st.st_mtime_ns, st.st_size]
+        voce = locali.get(filename)
+        if not voce or voce.get("chiave") != chiave:
+            voce = {"chiave": chiave, "version": get_local_version(filename), "sha256": get_local_hash(filename)}
+            cambiati[filename] = voce
+        info[filename] = voce
+    if cambiati:
+        _modifica_stato(lambda stato: stato.setdefault("locali", {}).update(cambiati))
+    return info
+
+
 def get_local_versions():
     """Legge le versioni di tutti i file aggiornabili."""
     versions = {}
+    info = _info_locali()
     for key, filename in FILE_AGGIORNABILI.items():
-        ver = get_local_version(filename)
+        ver = info.get(filename, {}).get("version")
         if ver:
             versions[key] = ver
     return versions
@@ -96,153 +395,451 @@ def parse_version(v):
 # CONTROLLO AGGIORNAMENTI
 # =============================================================================
 
-def check_updates():
-    """
-    Confronta versioni locali con remote.
-    Ritorna dict:
-    {
-        "available": True/False,
-        "updates": [
-            {"nome": "ai_generator", "file": "ai_generator.py", 
-             "locale": "2.0", "remota": "2.1"}
-        ],
-        "error": None o stringa errore
-    }
-    """
+def _confronta(remote):
+    """Confronta le voci remote {nome: {"version", ["sha256", "size"]}} con i file locali."""
     result = {
         "available": False,
         "updates": [],
         "error": None
     }
     
-    # Scarica versioni remote
-    remote = get_remote_versions()
-    if remote is None:
-        result["error"] = "Impossibile connettersi a GitHub.\nVerifica la connessione internet."
-        return result
-    
     # Leggi versioni locali
-    local = get_local_versions()
+    info = _info_locali()
     
     # Confronta
     for key, filename in FILE_AGGIORNABILI.items():
-        remote_ver = remote.get(key)
-        local_ver = local.get(key)
+        voce = remote.get(key)
+        remote_ver = voce["version"] if voce else None
+        local_ver = info.get(filename, {}).get("version")
         
         if remote_ver and local_ver:
             if parse_version(remote_ver) > parse_version(local_ver):
-                result["updates"].append({
+                # Contenuto gia' identico a quello remoto: niente da scaricare
+                if voce.get("sha256") and info[filename]["sha256"] == voce["sha256"]:
+                    continue
+                update = {
                     "nome": key,
                     "file": filename,
                     "locale": local_ver,
                     "remota": remote_ver
-                })
+                }
+                if voce.get("sha256"):
+                    update.update(sha256=voce["sha256"], size=voce["size"])
+                result["updates"].append(update)
         elif remote_ver and not local_ver:
             # File non esiste localmente
-            result["updates"].append({
+            update = {
                 "nome": key,
                 "file": filename,
                 "locale": "non installato",
                 "remota": remote_ver
-            })
+            }
+            if voce.get("sha256"):
+                update.update(sha256=voce["sha256"], size=voce["size"])
+            result["updates"].append(update)
     
     result["available"] = len(result["updates"]) > 0
     return result
 
 
+_controllo_lock = threading.Lock()
+
+
+def _controlla_remoto():
+    """Controllo via rete: aggiorna lo stato salvato e ritorna il risultato come check_updates."""
+    with _controllo_lock:
+        # Scarica versioni remote (manifest con hash, altrimenti versions.txt)
+        remote = get_remote_manifest()
+        if remote is None:
+            versions = get_remote_versions()
+            if versions is not None:
+                remote = {key: {"version": ver} for key, ver in versions.items()}
+        
+        adesso = time.time()
+        if remote is None:
+            def _fallito(stato):
+                check = stato.setdefault("check", {})
+                check["fallimenti"] = check.get("fallimenti", 0) + 1
+                check["ultimo_tentativo"] = adesso
+            _modifica_stato(_fallito)
+            return {
+                "available": False,
+                "updates": [],
+                "error": "Impossibile connettersi a GitHub.\nVerifica la connessione internet."
+            }
+        
+        def _riuscito(stato):
+            stato["check"] = {"ultimo": adesso, "ultimo_tentativo": adesso, "fallimenti": 0, "remote": remote}
+        _modifica_stato(_riuscito)
+        
+        result = _confronta(remote)
+        result["controllato_il"] = adesso
+        return result
+
+
+def check_updates(forza=False):
+    """
+    Confronta versioni locali con remote.
+    Senza forza risponde subito dall'ultimo controllo salvato (nessun accesso
+    alla rete); se non c'e' ancora un controllo, o e' scaduto, ne avvia uno in
+    background. Con forza=True controlla subito via rete.
+    Ritorna dict:
+    {
+        "available": True/False,
+        "updates": [
+            {"nome": "ai_generator", "file": "ai_generator.py", 
+             "locale": "2.0", "remota": "2.1",
+             "sha256": "...", "size": 1234}   # sha256/size solo se c'e' il manifest
+        ],
+        "error": None o stringa errore,
+        "controllato_il": timestamp del controllo remoto usato (None se mai fatto)
+    }
+    """
+    if forza:
+        return _controlla_remoto()
+    
+    with _stato_lock:
+        check = _carica_stato().get("check", {})
+    
+    if not check.get("remote"):
+        _controlla_in_background()
+        return {"available": False, "updates": [], "error": None, "controllato_il": None}
+    
+    if time.time() - check.get("ultimo", 0) > INTERVALLO_CONTROLLO and not scheduler_attivo():
+        _controlla_in_background()
+    
+    result = _confronta(check["remote"])
+    result["controllato_il"] = check.get("ultimo")
+    return result
+
+
+# =============================================================================
+# CONTROLLO PERIODICO IN BACKGROUND
+# =============================================================================
+
+_scheduler = None
+
+
+def _controlla_in_background():
+    """Un controllo remoto una tantum, se non ce n'e' gia' uno in corso."""
+    if _controllo_lock.locked():
+        return
+    threading.Thread(target=_controlla_remoto, daemon=True).start()
+
+
+def _prossima_attesa(intervallo):
+    """Secondi al prossimo controllo: intervallo dall'ultimo riuscito, backoff esponenziale dopo un errore."""
+    with _stato_lock:
+        check = _carica_stato().get("check", {})
+    fallimenti = check.get("fallimenti", 0)
+    if fallimenti:
+        attesa = min(intervallo, BACKOFF_BASE * 2 ** (fallimenti - 1))
+        riferimento = check.get("ultimo_tentativo", 0)
+    else:
+        attesa = intervallo
+        riferimento = check.get("ultimo", 0)
+    attesa *= random.uniform(1 - JITTER, 1 + JITTER)
+    return max(riferimento + attesa - time.time(), 0)
+
+
+def avvia_scheduler(callback=None, intervallo=INTERVALLO_CONTROLLO, ritardo_avvio=RITARDO_AVVIO):
+    """
+    Avvia i controlli periodici in background: non blocca mai l'avvio.
+    callback(result_dict) chiamato dopo ogni controllo riuscito.
+    """
+    global _scheduler
+    if scheduler_attivo():
+        return
+    stop = threading.Event()
+    
+    def _worker():
+        attesa = max(_prossima_attesa(intervallo), ritardo_avvio * random.uniform(1 - JITTER, 1 + JITTER))
+        while not stop.wait(attesa):
+            result = _controlla_remoto()
+            if callback and result["error"] is None:
+                try:
+                    callback(result)
+                except Exception as e:
+                    print(f"Errore callback aggiornamenti: {e}")
+            attesa = _prossima_attesa(intervallo)
+    
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+    _scheduler = (thread, stop)
+
+
+def ferma_scheduler():
+    """Ferma i controlli periodici."""
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler[1].set()
+        _scheduler = None
+
+
+def scheduler_attivo():
+    return _scheduler is not None and _scheduler[0].is_alive()
+
+
 # =============================================================================
 # DOWNLOAD E INSTALLAZIONE
 # =============================================================================
 
-def download_file(filename, timeout=15):
+def _scarica_in_temporaneo(update, timeout):
     """
-    Scarica un file da GitHub e sostituisce quello locale.
-    Ritorna (successo, messaggio).
+    Scarica un file in un temporaneo accanto a quello definitivo e lo verifica
+    (dimensione e SHA-256 dal manifest, altrimenti solo presenza di __version__).
+    Ritorna dict con "tmp" (None se il file locale e' gia' aggiornato) o "errore".
     """
+    filename = update["file"]
     url = GITHUB_BASE_URL + filename
-    local_path = os.path.join(BASE_DIR, filename)
-    backup_path = local_path + ".backup"
+    esito = {"update": update, "tmp": None, "versione": None, "sha256": None, "headers": None, "errore": None}
+    
+    locale = _leggi_locale(filename)
+    hash_locale = _sha256(locale) if locale is not None else None
+    if update.get("sha256") and hash_locale == update["sha256"]:
+        esito["versione"] = get_local_version(filename)
+        return esito
     
+    # Richiesta condizionale solo senza hash nel manifest e se il file locale e' ancora
+    # quello scaricato l'ultima volta (col manifest il locale e' gia' risultato diverso)
+    headers = {}
+    cache = _leggi_cache_http(url)
+    if not update.get("sha256") and cache and hash_locale is not None and cache.get("sha256") == hash_locale:
+        headers.update(_headers_condizionali(cache))
+    
+    fd, tmp = tempfile.mkstemp(prefix=f".{filename}.", suffix=".tmp", dir=BASE_DIR)
+    hasher = hashlib.sha256()
+    stato = {"size": 0, "inizio": True}
     try:
-        # Backup del file corrente
-        if os.path.exists(local_path):
-            try:
-                if os.path.exists(backup_path):
-                    os.remove(backup_path)
-                os.rename(local_path, backup_path)
-            except Exception as e:
-                print(f"Warning: backup fallito per {filename}: {e}")
+        with os.fdopen(fd, "wb") as f:
+            def _scrivi(blocco):
+                # Rimuovi BOM se presente
+                if stato["inizio"] and blocco:
+                    stato["inizio"] = False
+                    if blocco.startswith(b'\xef\xbb\xbf'):
+                        blocco = blocco[3:]
+                f.write(blocco)
+                hasher.update(blocco)
+                stato["size"] += len(blocco)
+            
+            status, risposta_headers, _ = _POOL.get(url, headers=headers, timeout=timeout, destinazione=_scrivi)
         
-        # Scarica il nuovo file
-        url = _no_cache_url(url)
-        req = request.Request(url, headers={"User-Agent": "DOCai-Updater", "Cache-Control": "no-cache"})
-        with request.urlopen(req, timeout=timeout) as response:
-            content = response.read()
+        if status == 304:
+            os.remove(tmp)
+            if update.get("sha256"):
+                # CDN non allineata col manifest: il file locale non e' quello atteso
+                raise ValueError("risposta 304 ma il file locale non corrisponde al manifest")
+            esito["versione"] = get_local_version(filename)
+            return esito
+        if status != 200:
+            raise error.HTTPError(url, status, f"HTTP {status}", risposta_headers, None)
         
-        # Salva il nuovo file (rimuovi BOM se presente)
-        if content.startswith(b'\xef\xbb\xbf'):
-            content = content[3:]  # Rimuovi BOM
-        with open(local_path, "wb") as f:
-            f.write(content)
+        sha256 = hasher.hexdigest()
+        if update.get("size") is not None and stato["size"] != update["size"]:
+            raise ValueError(f"dimensione {stato['size']} invece di {update['size']} byte (download incompleto?)")
+        if update.get("sha256") and sha256 != update["sha256"]:
+            raise ValueError("SHA-256 diverso dal manifest")
         
         # Verifica che il file sia valido (contiene __version__)
-        new_ver = get_local_version(filename)
-        if new_ver is None:
-            # File scaricato non valido, ripristina backup
-            if os.path.exists(backup_path):
-                os.remove(local_path)
-                os.rename(backup_path, local_path)
-            return False, f"File {filename} scaricato non valido"
+        versione = get_local_version(os.path.basename(tmp))
+        if versione is None:
+            raise ValueError("__version__ mancante")
+        if update.get("sha256") and versione != update.get("remota"):
+            raise ValueError(f"versione {versione} invece di {update.get('remota')}")
         
-        # Rimuovi backup
-        if os.path.exists(backup_path):
+        esito.update(tmp=tmp, versione=versione, sha256=sha256, headers=risposta_headers)
+        return esito
+    
+    except Exception as e:
+        if os.path.exists(tmp):
             try:
-                os.remove(backup_path)
-            except:
+                os.remove(tmp)
+            except OSError:
                 pass
-        
-        return True, f"{filename} aggiornato a v{new_ver}"
+        esito["errore"] = f"Errore download {filename}: {e}"
+        return esito
+
+
+def _installa(esiti, conserva_backup=False):
+    """
+    Installa tutti i temporanei verificati con os.replace, tutto-o-niente:
+    se una sostituzione fallisce i file gia' sostituiti tornano alla versione precedente.
+    Con conserva_backup i .backup restano come ultima versione funzionante fino alla
+    ricarica riuscita (servono al rollback, vedi ricarica_moduli); altrimenti si rimuovono.
+    """
+    installati = []
+    try:
+        for esito in esiti:
+            if esito["tmp"] is None:
+                continue
+            local_path = os.path.join(BASE_DIR, esito["update"]["file"])
+            backup_path = local_path + ".backup"
+            
+            # Backup del file corrente (il file vivo non sparisce mai)
+            if os.path.exists(backup_path):
+                os.remove(backup_path)
+            if os.path.exists(local_path):
+                shutil.copy2(local_path, backup_path)
+            else:
+                backup_path = None
+            
+            os.replace(esito["tmp"], local_path)
+            esito["tmp"] = None
+            installati.append((local_path, backup_path))
+    except Exception:
+        for local_path, backup_path in reversed(installati):
+            try:
+                if backup_path:
+                    os.replace(backup_path, local_path)
+                else:
+                    os.remove(local_path)
+            except OSError as e:
+                print(f"Errore ripristino {local_path}: {e}")
+        raise
     
-    except Exception as e:
-        # Ripristina backup in caso di errore
-        if os.path.exists(backup_path) and not os.path.exists(local_path):
+    if not conserva_backup:
+        # Senza ricarica un .backup rimasto sarebbe vecchio al prossimo rollback
+        for local_path, backup_path in installati:
+            if backup_path:
+                try:
+                    os.remove(backup_path)
+                except OSError as e:
+                    print(f"Warning: {backup_path} non rimosso: {e}")
+
+
+def _pulisci_temporanei_orfani(eta_minima=3600):
+    """Rimuove i temporanei lasciati da un aggiornamento interrotto."""
+    adesso = time.time()
+    for nome in os.listdir(BASE_DIR):
+        if not (nome.startswith(".") and nome.endswith(".tmp")):
+            continue
+        if not any(nome.startswith(f".{f}.") for f in FILE_AGGIORNABILI.values()):
+            continue
+        path = os.path.join(BASE_DIR, nome)
+        try:
+            if adesso - os.path.getmtime(path) > eta_minima:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _scarta_temporanei(esiti):
+    for esito in esiti:
+        if esito["tmp"] and os.path.exists(esito["tmp"]):
             try:
-                os.rename(backup_path, local_path)
-            except:
+                os.remove(esito["tmp"])
+            except OSError:
                 pass
-        return False, f"Errore download {filename}: {e}"
+        esito["tmp"] = None
+
+
+def download_file(filename, timeout=15):
+    """
+    Scarica un file da GitHub e sostituisce quello locale.
+    Ritorna (successo, messaggio).
+    """
+    update = {"nome": os.path.splitext(filename)[0], "file": filename}
+    successi, errori = download_updates([update], timeout=timeout)
+    if errori:
+        return False, errori[0]
+    return True, successi[0]
 
 
-def download_updates(updates_list, progress_callback=None):
+def download_updates(updates_list, progress_callback=None, timeout=15, conserva_backup=False):
     """
-    Scarica tutti gli aggiornamenti nella lista.
+    Scarica tutti gli aggiornamenti nella lista e li installa tutto-o-niente.
+    I file sono scaricati in parallelo su temporanei verificati; se anche uno
+    solo fallisce non viene modificato nessun file.
     progress_callback(nome, indice, totale, successo, messaggio)
+    conserva_backup=True se segue ricarica_moduli (che usa e poi rimuove i .backup).
     Ritorna (successi, errori) come liste di stringhe.
     """
-    successi = []
-    errori = []
     totale = len(updates_list)
+    callback_lock = threading.Lock()
+    _pulisci_temporanei_orfani()
     
-    for i, update in enumerate(updates_list):
-        filename = update["file"]
-        nome = update["nome"]
-        
+    def _notifica(*args):
         if progress_callback:
-            progress_callback(nome, i + 1, totale, None, f"Download {filename}...")
-        
-        success, msg = download_file(filename)
+            with callback_lock:
+                progress_callback(*args)
+    
+    def _scarica(i):
+        update = updates_list[i]
+        _notifica(update["nome"], i + 1, totale, None, f"Download {update['file']}...")
+        return _scarica_in_temporaneo(update, timeout)
+    
+    esiti = []
+    if totale:
+        with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, totale)) as pool:
+            esiti = list(pool.map(_scarica, range(totale)))
+    
+    fallito = next((e for e in esiti if e["errore"]), None)
+    if fallito is None:
+        try:
+            _installa(esiti, conserva_backup)
+        except Exception as e:
+            fallito = {"errore": f"Errore installazione: {e}"}
+    
+    successi = []
+    errori = []
+    for i, esito in enumerate(esiti):
+        update = esito["update"]
+        filename = update["file"]
         
-        if success:
-            successi.append(msg)
-        else:
+        if fallito is not None:
+            msg = esito["errore"] or f"{filename} non aggiornato: aggiornamento annullato ({fallito['errore']})"
             errori.append(msg)
+            _notifica(update["nome"], i + 1, totale, False, msg)
+            continue
         
-        if progress_callback:
-            progress_callback(nome, i + 1, totale, success, msg)
+        if esito["sha256"] is not None:
+            _aggiorna_cache_http(GITHUB_BASE_URL + filename, esito["headers"], sha256=esito["sha256"])
+            msg = f"{filename} aggiornato a v{esito['versione']}"
+        else:
+            msg = f"{filename} gia' aggiornato (v{esito['versione']})"
+        successi.append(msg)
+        _notifica(update["nome"], i + 1, totale, True, msg)
     
+    _scarta_temporanei(esiti)
     return successi, errori
 
 
+# =============================================================================
+# MANIFEST (da eseguire prima di pubblicare gli aggiornamenti)
+# =============================================================================
+
+def genera_manifest(path=None):
+    """Scrive manifest.json con versione, SHA-256 e dimensione dei file locali."""
+    path = path or os.path.join(BASE_DIR, MANIFEST_FILE)
+    files = {}
+    for key, filename in FILE_AGGIORNABILI.items():
+        contenuto = _leggi_locale(filename)
+        versione = get_local_version(filename)
+        if contenuto is None or versione is None:
+            print(f"Warning: {filename} mancante o senza __version__, escluso dal manifest")
+            continue
+        files[key] = {
+            "file": filename,
+            "version": versione,
+            "sha256": _sha256(contenuto),
+            "size": len(contenuto),
+        }
+    
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        json.dump({"files": files}, f, indent=2)
+        f.write("\n")
+    
+    # versions.txt deve restare allineato per i client che non conoscono il manifest
+    versions_path = os.path.join(os.path.dirname(path), "versions.txt")
+    if os.path.exists(versions_path):
+        with open(versions_path, "r", encoding="utf-8-sig") as f:
+            versions = dict(line.strip().split("=", 1) for line in f if "=" in line and not line.startswith("#"))
+        for key, voce in files.items():
+            if versions.get(key) != voce["version"]:
+                print(f"Warning: versions.txt ha {key}={versions.get(key)}, il file e' v{voce['version']}")
+    return files
+
+
 # =============================================================================
 # FUNZIONI ASINCRONE (per non bloccare la GUI)
 # =============================================================================
@@ -254,7 +851,7 @@ def check_updates_async(callback):
     """
     def _worker():
         try:
-            result = check_updates()
+            result = check_updates(forza=True)
             callback(result)
         except Exception as e:
             callback({"available": False, "updates": [], "error": str(e)})
@@ -263,25 +860,205 @@ def check_updates_async(callback):
     thread.start()
 
 
-def download_updates_async(updates_list, on_complete, on_progress=None):
+def download_updates_async(updates_list, on_complete, on_progress=None, ricarica=False):
     """
     Scarica aggiornamenti in background.
     on_complete(successi, errori) chiamato quando finisce.
     on_progress(nome, indice, totale, successo, msg) chiamato ad ogni file.
+    Con ricarica=True i moduli aggiornati vengono ricaricati subito (vedi ricarica_moduli).
     """
     def _worker():
-        successi, errori = download_updates(updates_list, progress_callback=on_progress)
+        successi, errori = download_updates(updates_list, progress_callback=on_progress, conserva_backup=ricarica)
+        if ricarica and not errori:
+            nomi = [u["nome"] for u in updates_list]
+            ricaricati, errori_ricarica = ricarica_moduli(nomi, installati=nomi)
+            successi += ricaricati
+            errori += errori_ricarica
         on_complete(successi, errori)
     
     thread = threading.Thread(target=_worker, daemon=True)
     thread.start()
 
 
+# =============================================================================
+# RICARICA A CALDO (senza riavviare l'applicazione)
+# =============================================================================
+
+# Ordine di ricarica: prima i moduli da cui dipendono gli altri.
+# update_from_github non ricarica se stesso: la nuova versione vale dal prossimo avvio.
+ORDINE_RICARICA = ["tracing", "rate_limiter", "ai_module", "ai_generator", "transcriber"]
+RICARICA_ATTESA_SECONDI = 2
+
+_ricarica_lock = threading.RLock()
+_ricariche_in_attesa = set()
+
+
+def _dipende_da(modulo, nomi):
+    """True se il modulo ha importato oggetti (o il modulo stesso) da uno dei moduli indicati."""
+    for valore in vars(modulo).values():
+        origine = valore.__name__ if isinstance(valore, type(sys)) else getattr(valore, "__module__", None)
+        if origine in nomi:
+            return True
+    return False
+
+
+def _ripristina_backup(nome):
+    """Rimette su disco la versione precedente (se il .backup esiste)."""
+    local_path = os.path.join(BASE_DIR, FILE_AGGIORNABILI[nome])
+    backup_path = local_path + ".backup"
+    if os.path.exists(backup_path):
+        try:
+            os.replace(backup_path, local_path)
+            return True
+        except OSError as e:
+            print(f"Errore ripristino {local_path}: {e}")
+    return False
+
+
+def _rimuovi_backup(nome):
+    """Dopo una ricarica riuscita il .backup non serve piu' (e non deve restare per il prossimo rollback)."""
+    backup_path = os.path.join(BASE_DIR, FILE_AGGIORNABILI[nome]) + ".backup"
+    try:
+        os.remove(backup_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: {backup_path} non rimosso: {e}")
+
+
+def _ricarica_gruppo(nomi, installati=()):
+    """
+    Ricarica i moduli con importlib e ricollega le istanze vive alle nuove classi
+    (il __dict__ resta lo stesso: client, template caricato e cache sono preservati).
+    Tutto-o-niente: se un modulo non si importa, tutti tornano alla versione precedente.
+    Su disco si ripristinano solo i file in installati (appena scaricati): gli altri
+    moduli del gruppo (dipendenti) non sono cambiati e un loro .backup sarebbe vecchio.
+    """
+    fatti = []   # (modulo, snapshot del dict, [(istanza, vecchia classe)])
+    try:
+        for nome in nomi:
+            modulo = sys.modules[nome]
+            snapshot = dict(vars(modulo))
+            istanze = list(getattr(modulo, "_ISTANZE", ()))
+            fatti.append((modulo, snapshot, []))
+
+            importlib.reload(modulo)
+
+            nuove_istanze = getattr(modulo, "_ISTANZE", None)
+            for istanza in istanze:
+                vecchia = type(istanza)
+                nuova = getattr(modulo, vecchia.__name__, None)
+                if isinstance(nuova, type) and nuova is not vecchia:
+                    istanza.__class__ = nuova
+                    fatti[-1][2].append((istanza, vecchia))
+                    dopo_ricarica = getattr(istanza, "_dopo_ricarica", None)
+                    if dopo_ricarica:
+                        dopo_ricarica()
+                if nuove_istanze is not None:
+                    nuove_istanze.add(istanza)
+        for nome in nomi:
+            if nome in installati:
+                _rimuovi_backup(nome)
+        return True, None
+    except Exception as e:
+        # Rollback in memoria (ordine inverso) e su disco
+        for modulo, snapshot, ricollegate in reversed(fatti):
+            vars(modulo).clear()
+            vars(modulo).update(snapshot)
+            for istanza, vecchia in ricollegate:
+                istanza.__class__ = vecchia
+        for nome in nomi:
+            if nome in installati:
+                _ripristina_backup(nome)
+        return False, f"{type(e).__name__}: {e}"
+
+
+def ricarica_moduli(nomi, on_rimandata=None, installati=None):
+    """
+    Ricarica in memoria i moduli aggiornati (chiavi di FILE_AGGIORNABILI).
+    installati: moduli i cui file sono stati appena installati (default: nomi);
+    solo questi tornano al .backup se la ricarica fallisce.
+    I moduli non ancora importati non serve ricaricarli. Se un modulo dichiara
+    puo_ricaricare() e ritorna False (es. registrazione in corso) la ricarica
+    viene rimandata e ritentata in background; on_rimandata(successi, errori)
+    viene chiamato quando avviene.
+    Ritorna (successi, errori) come liste di stringhe.
+    """
+    installati = set(nomi if installati is None else installati)
+    with _ricarica_lock:
+        richiesti = {n for n in nomi if n in sys.modules and n in ORDINE_RICARICA}
+        # Chi importa da un modulo ricaricato va ricaricato anche lui
+        for nome in ORDINE_RICARICA:
+            if nome in sys.modules and nome not in richiesti and _dipende_da(sys.modules[nome], richiesti):
+                richiesti.add(nome)
+        # Installati che non verranno ricaricati (non importati, o update_from_github): backup inutile
+        for nome in installati - richiesti:
+            if nome in FILE_AGGIORNABILI:
+                _rimuovi_backup(nome)
+
+        pronti = []
+        rimandati = []
+        for nome in ORDINE_RICARICA:
+            if nome not in richiesti:
+                continue
+            puo_ricaricare = getattr(sys.modules[nome], "puo_ricaricare", None)
+            if puo_ricaricare is not None and not puo_ricaricare():
+                rimandati.append(nome)
+            else:
+                pronti.append(nome)
+
+        successi = []
+        errori = []
+        if pronti:
+            ok, errore = _ricarica_gruppo(pronti, installati)
+            if ok:
+                successi += [f"{FILE_AGGIORNABILI[n]} ricaricato" for n in pronti]
+            else:
+                errori.append(f"Ricarica di {', '.join(pronti)} annullata, ripristinata la versione precedente ({errore})")
+
+        if rimandati:
+            successi += [f"{FILE_AGGIORNABILI[n]}: ricarica rimandata a fine registrazione" for n in rimandati]
+            _rimanda_ricarica(rimandati, on_rimandata, installati)
+
+        return successi, errori
+
+
+def _rimanda_ricarica(nomi, callback, installati=()):
+    nuovi = set(nomi) - _ricariche_in_attesa
+    if not nuovi:
+        return
+    _ricariche_in_attesa.update(nuovi)
+
+    def _worker():
+        while True:
+            time.sleep(RICARICA_ATTESA_SECONDI)
+            with _ricarica_lock:
+                if all(getattr(sys.modules[n], "puo_ricaricare", lambda: True)() for n in nuovi):
+                    ok, errore = _ricarica_gruppo([n for n in ORDINE_RICARICA if n in nuovi], installati)
+                    _ricariche_in_attesa.difference_update(nuovi)
+                    break
+        if ok:
+            successi, errori = [f"{FILE_AGGIORNABILI[n]} ricaricato" for n in nuovi], []
+        else:
+            successi, errori = [], [f"Ricarica di {', '.join(sorted(nuovi))} annullata, ripristinata la versione precedente ({errore})"]
+        for msg in successi + errori:
+            print(msg)
+        if callback:
+            callback(successi, errori)
+
+    threading.Thread(target=_worker, daemon=True).start()
+
+
 # =============================================================================
 # TEST (se eseguito direttamente)
 # =============================================================================
 
 if __name__ == "__main__":
+    if "--manifest" in sys.argv:
+        for key, voce in genera_manifest().items():
+            print(f"  {voce['file']}: v{voce['version']}  {voce['size']} byte  {voce['sha256'][:12]}")
+        sys.exit(0)
+    
     print("\n" + "=" * 60)
     print("  DOCai - Controllo Aggiornamenti")
     print("=" * 60 + "\n")
@@ -292,7 +1069,7 @@ if __name__ == "__main__":
         print(f"    {key}: {ver}")
     
     print("\n  Controllo versioni remote...")
-    result = check_updates()
+    result = check_updates(forza=True)
     
     if result["error"]:
         print(f"\n  ❌ Errore: {result['error']}")